@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import socket
+import struct
+import asyncio
+import logging
+from typing import Optional
+from config import AGENT_SOCKET, AGENT_IDLE_TIMEOUT, settings
+from metrics import registry, ACTION
+from auditlog import journal, OK, DENIED, NOT_FOUND, CONFLICT, FAILED
+
+logger = logging.getLogger(__name__)
+
+# Journal outcome of each error the agent answers with
+OUTCOMES = {"not found": NOT_FOUND, "locked": DENIED, "invalid master password": DENIED, "already exists": CONFLICT}
+
+# Upper bound for a single request line; requests are small JSON objects
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class Agent:
+    """Keeps the vault key in memory and serves requests over a Unix socket.
+
+    Works like ssh-agent: the vault is unlocked once, and clients of the same
+    user send newline-delimited JSON requests (get, list, add, lock, unlock,
+    status, stop) without paying the Argon2 cost again. Decrypted entries are
+    served from the manager's EntryCache. The key and the cache are wiped after
+    idle_timeout seconds without requests or on an explicit lock.
+    """
+
+    def __init__(self, manager, socket_path: str = None, idle_timeout: float = AGENT_IDLE_TIMEOUT):
+        self.manager = manager
+        self.socket_path = socket_path or AGENT_SOCKET
+        self.idle_timeout = idle_timeout
+        self._key: Optional[bytearray] = None
+        self._last_used = time.monotonic()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def locked(self) -> bool:
+        return self._key is None
+
+    def set_key(self, key: bytes):
+        """Stores the vault key in a buffer that lock() can wipe."""
+        self.lock()
+        self._key = bytearray(key)
+        self._last_used = time.monotonic()
+
+    def lock(self):
+        """Overwrites and drops the cached key and decrypted entries."""
+        self.manager.cache.clear()
+        if self._key is not None:
+            for i in range(len(self._key)):
+                self._key[i] = 0
+            self._key = None
+            logger.info("Agent locked")
+
+    async def unlock(self, master_password: str) -> bool:
+        """Runs Argon2 off the event loop and caches the resulting key."""
+        loop = asyncio.get_running_loop()
+        salt = self.manager.crypto.get_salt()
+        keys = await loop.run_in_executor(None, self.manager.unlock, master_password, salt)
+        if keys is None:
+            return False
+        self.set_key(keys.enc_key)
+        return True
+
+    def _peer_allowed(self, writer: asyncio.StreamWriter) -> bool:
+        """Accepts only connections from processes of the same user where the OS reports it."""
+        sock = writer.get_extra_info("socket")
+        if sock is None or not hasattr(socket, "SO_PEERCRED"):
+            return True
+        credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _, uid, _ = struct.unpack("3i", credentials)
+        return uid == os.getuid()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not self._peer_allowed(writer):
+            writer.close()
+            return
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    with registry.timer(ACTION, f"agent_{request.get('op')}"), \
+                            journal.action(f"agent_{request.get('op')}", vault=self.manager.vault_name,
+                                           service=request.get("service"), category=request.get("category")) as event:
+                        response = await self.dispatch(request)
+                        event["outcome"] = OK if response["ok"] else OUTCOMES.get(response.get("error"), FAILED)
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request: dict) -> dict:
+        """Executes one request and returns the response object."""
+        op = request.get("op")
+        if op == "status":
+            return {"ok": True, "locked": self.locked, "cache": self.manager.cache.stats()}
+        if op == "lock":
+            self.lock()
+            return {"ok": True}
+        if op == "stop":
+            self.lock()
+            self._server.close()
+            return {"ok": True}
+        if op == "unlock":
+            if await self.unlock(request["master_password"]):
+                return {"ok": True}
+            return {"ok": False, "error": "invalid master password"}
+        if op not in ("get", "list", "add"):
+            return {"ok": False, "error": f"unknown op: {op}"}
+        if self.locked:
+            return {"ok": False, "error": "locked"}
+        self._last_used = time.monotonic()
+
+        db, crypto = self.manager.db, self.manager.crypto
+        if op == "get":
+            entry = self.manager.get_entry(request["service"], request.get("category"), self._key)
+            if entry is None:
+                return {"ok": False, "error": "not found"}
+            return {"ok": True, "username": entry[0], "password": entry[1]}
+        if op == "list":
+            return {"ok": True, "entries": db.get_entries(request.get("category"))}
+        encrypted_password = crypto.encrypt_password(request["password"], self._key)
+        fingerprint = crypto.fingerprint(request["password"], self._key)
+        if not db.add_password(request["service"], request["username"], encrypted_password, request.get("category"),
+                               fingerprint):
+            return {"ok": False, "error": "already exists"}
+        return {"ok": True}
+
+    def apply_settings(self, changed: dict):
+        """Applies changed hot settings: the idle timeout and the cache limits."""
+        if "agent.idle_timeout" in changed:
+            self.idle_timeout = changed["agent.idle_timeout"]
+        if "cache.ttl" in changed:
+            self.manager.cache.ttl = changed["cache.ttl"]
+        if "cache.max_entries" in changed:
+            self.manager.cache.max_entries = changed["cache.max_entries"]
+        if changed:
+            logger.info(f"Agent settings reloaded: {changed}")
+
+    async def _lock_when_idle(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 5))
+            self.apply_settings(settings.reload())
+            self.manager.cache.purge_expired()
+            registry.flush()
+            if not self.locked and time.monotonic() - self._last_used > self.idle_timeout:
+                self.lock()
+
+    async def serve(self):
+        """Listens on the socket until a stop request arrives."""
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        old_umask = os.umask(0o077)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.socket_path,
+                                                           limit=MAX_REQUEST_SIZE)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0o600)
+        idle_task = asyncio.create_task(self._lock_when_idle())
+        logger.info(f"Agent listening on {self.socket_path}")
+        try:
+            async with self._server:
+                try:
+                    await self._server.serve_forever()
+                except asyncio.CancelledError:
+                    pass
+        finally:
+            idle_task.cancel()
+            self.lock()
+            registry.flush()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+class AgentClient:
+    """Blocking client for the agent protocol; one connection serves many requests."""
+
+    def __init__(self, socket_path: str = None, timeout: float = 30.0):
+        self.socket_path = socket_path or AGENT_SOCKET
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(self.socket_path)
+        self._reader = self.sock.makefile("rb")
+
+    @classmethod
+    def available(cls, socket_path: str = None) -> Optional["AgentClient"]:
+        """Returns a connected client if an unlocked agent is running, otherwise None."""
+        try:
+            client = cls(socket_path)
+        except OSError:
+            return None
+        try:
+            if not client.request("status")["locked"]:
+                return client
+        except (OSError, RuntimeError, ValueError):
+            pass
+        client.close()
+        return None
+
+    def request(self, op: str, **params) -> dict:
+        """Sends a request and returns the response, raising RuntimeError on failure."""
+        params["op"] = op
+        self.sock.sendall(json.dumps(params).encode() + b"\n")
+        line = self._reader.readline()
+        if not line:
+            raise RuntimeError("Agent closed the connection")
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise RuntimeError(response.get("error", "agent request failed"))
+        return response
+
+    def close(self):
+        self._reader.close()
+        self.sock.close()
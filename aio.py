@@ -0,0 +1,166 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+from config import AIO_MAX_PENDING, AIO_CRYPTO_WORKERS, AIO_BULK_CHUNK
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+PlainEntry = Tuple[str, str, str, Optional[str]]
+
+
+def _unlock(salt_file: str, master_hash_file: str, params: dict, keyfile_path: Optional[str], master_password: str):
+    """Verifies the master password in a worker process and returns the vault keys, or None."""
+    from crypto import Crypto
+    crypto = Crypto(salt_file, master_hash_file, params, keyfile_path)
+    return crypto.unlock(master_password, crypto.get_salt())
+
+
+def _derive_key(params: dict, master_password: str, salt: bytes) -> bytes:
+    from crypto import Crypto
+    return Crypto(params=params).derive_key(master_password, salt)
+
+
+def _encrypt_chunk(passwords: List[str], key: bytes) -> List[Tuple[bytes, bytes]]:
+    from crypto import Crypto
+    crypto = Crypto()
+    return list(zip(crypto.encrypt_many(passwords, key), crypto.fingerprint_many(passwords, key)))
+
+
+def _decrypt_chunk(blobs: List[bytes], key: bytes) -> List[str]:
+    from crypto import Crypto
+    return Crypto().decrypt_many(blobs, key)
+
+
+class AsyncVault:
+    """Awaitable access to a vault for code running on an asyncio event loop.
+
+    The blocking Database and Crypto stay the primary API; this facade only
+    moves their work off the loop. Database calls run one at a time on a
+    dedicated thread, which owns its reader connection and queues writes in
+    submission order. Argon2 and bulk encryption run in a process pool, so
+    neither the memory-hard KDF nor a large batch holds the loop or the GIL.
+    Single-entry AES-GCM takes microseconds and stays on the loop.
+
+    At most max_pending operations are admitted at once; further callers
+    wait for a slot, so a burst of requests queues in the caller instead of
+    piling up work in the executors. Cancelling an operation that has not
+    started drops it. An operation already running on the database thread
+    finishes, and its transaction commits or rolls back as a whole, but the
+    caller no longer waits for it.
+    """
+
+    def __init__(self, db: Database, crypto, key: Optional[bytes] = None, max_pending: int = AIO_MAX_PENDING,
+                 crypto_workers: int = AIO_CRYPTO_WORKERS, bulk_chunk: int = AIO_BULK_CHUNK):
+        self.db = db
+        self.crypto = crypto
+        self.key = key
+        self.crypto_workers = max(1, crypto_workers)
+        self.bulk_chunk = bulk_chunk
+        self._slots = asyncio.Semaphore(max(1, max_pending))
+        self._db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aio-db")
+        self._processes: Optional[ProcessPoolExecutor] = None
+
+    async def __aenter__(self) -> "AsyncVault":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(max_workers=self.crypto_workers)
+        return self._processes
+
+    def _require_key(self) -> bytes:
+        if self.key is None:
+            raise RuntimeError("Vault is locked")
+        return self.key
+
+    async def _run_db(self, func, *args):
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._db_thread, functools.partial(func, *args))
+
+    async def _run_process(self, func, *args):
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._process_pool(), functools.partial(func, *args))
+
+    async def unlock(self, master_password: str) -> bool:
+        """Verifies the master password in a worker process and keeps the encryption key."""
+        keys = await self._run_process(_unlock, self.crypto.salt_file, self.crypto.master_hash_file,
+                                       self.crypto.params, self.crypto.keyfile_path, master_password)
+        if keys is None:
+            return False
+        self.key = keys.enc_key
+        return True
+
+    def lock(self):
+        self.key = None
+
+    async def derive_key(self, master_password: str, salt: bytes) -> bytes:
+        """Derives an encryption key with Argon2 in a worker process."""
+        return await self._run_process(_derive_key, self.crypto.params, master_password, salt)
+
+    async def get(self, service: str, category: str = None) -> Optional[Tuple[str, str]]:
+        """Returns (username, password) of an entry, or None."""
+        key = self._require_key()
+        entry = await self._run_db(self.db.get_password, service, category)
+        if entry is None:
+            return None
+        return entry["username"], self.crypto.decrypt_password(entry["encrypted_password"], key)
+
+    async def add(self, service: str, username: str, password: str, category: str = None) -> bool:
+        """Adds an entry; returns False when the service already exists in the category."""
+        key = self._require_key()
+        encrypted_password = self.crypto.encrypt_password(password, key)
+        fingerprint = self.crypto.fingerprint(password, key)
+        return await self._run_db(self.db.add_password, service, username, encrypted_password, category, fingerprint)
+
+    async def update(self, service: str, password: str, category: str = None) -> bool:
+        """Replaces the password of an entry; the previous one is kept in history."""
+        key = self._require_key()
+        encrypted_password = self.crypto.encrypt_password(password, key)
+        fingerprint = self.crypto.fingerprint(password, key)
+        return await self._run_db(self.db.update_password, service, encrypted_password, category, fingerprint)
+
+    async def delete(self, service: str, category: str = None) -> bool:
+        return await self._run_db(self.db.delete_password, service, category)
+
+    async def list(self, category: str = None) -> List[Tuple[str, str, Optional[str]]]:
+        """Returns (service, username, category) of all entries or one category."""
+        return await self._run_db(self.db.get_entries, category)
+
+    async def encrypt_many(self, passwords: List[str]) -> List[Tuple[bytes, bytes]]:
+        """Returns (ciphertext, fingerprint) pairs, encrypting chunks in worker processes."""
+        key = self._require_key()
+        chunks = await asyncio.gather(*(self._run_process(_encrypt_chunk, chunk, key)
+                                        for chunk in self._chunks(passwords)))
+        return [pair for chunk in chunks for pair in chunk]
+
+    async def decrypt_many(self, blobs: List[bytes]) -> List[str]:
+        """Decrypts ciphertexts in chunks in worker processes, keeping their order."""
+        key = self._require_key()
+        chunks = await asyncio.gather(*(self._run_process(_decrypt_chunk, chunk, key)
+                                        for chunk in self._chunks(blobs)))
+        return [password for chunk in chunks for password in chunk]
+
+    def _chunks(self, items: Iterable) -> List[list]:
+        items = list(items)
+        return [items[start:start + self.bulk_chunk] for start in range(0, len(items), self.bulk_chunk)]
+
+    async def add_many(self, entries: List[PlainEntry]) -> bool:
+        """Adds (service, username, password, category) entries in one transaction; nothing is added on a conflict."""
+        sealed = await self.encrypt_many([entry[2] for entry in entries])
+        rows = [(service, username, encrypted_password, category, fingerprint)
+                for (service, username, _, category), (encrypted_password, fingerprint) in zip(entries, sealed)]
+        return await self._run_db(self.db.add_passwords, rows)
+
+    def close(self):
+        """Waits for running operations, then stops the database thread and the worker processes."""
+        self._db_thread.shutdown(wait=True, cancel_futures=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=True, cancel_futures=True)
+            self._processes = None
+        logger.info("Async vault closed")
@@ -0,0 +1,108 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from typing import Dict, List, Optional, Tuple
+from config import AUDIT_WORKERS, AUDIT_CHUNK_SIZE, WEAK_PASSWORD_BITS
+from db import Database
+from generator import estimate_entropy
+
+logger = logging.getLogger(__name__)
+
+AuditEntry = Tuple[str, str, Optional[str]]
+WeakEntry = Tuple[str, str, Optional[str], float]
+
+# Per-process state of scoring workers, set by _init_worker
+_worker: Dict[str, object] = {}
+
+
+def _init_worker(key: bytes):
+    from crypto import Crypto
+    _worker["crypto"] = Crypto()
+    _worker["key"] = key
+
+
+def _score(blobs: List[bytes]) -> List[float]:
+    """Decrypts a chunk in a worker process and returns entropy estimates; plaintext never leaves the worker."""
+    passwords = _worker["crypto"].decrypt_many(blobs, _worker["key"])
+    return [estimate_entropy(password) for password in passwords]
+
+
+class AuditReport:
+    """Entries sharing a password and, when strength was checked, entries with weak passwords."""
+
+    def __init__(self, total: int, reused: List[List[AuditEntry]], weak: Optional[List[WeakEntry]] = None):
+        self.total = total
+        self.reused = reused
+        self.weak = weak
+
+    @property
+    def reused_entries(self) -> int:
+        return sum(len(group) for group in self.reused)
+
+
+class Auditor:
+    """Finds reused and weak passwords.
+
+    Reuse comes from the keyed fingerprint column: equal passwords have equal
+    fingerprints, so a GROUP BY over its index finds them without decrypting
+    anything. Only entries written before fingerprints existed are decrypted
+    once to fill the column in. Strength scoring does decrypt, and only runs
+    when asked: chunks of ciphertexts go to worker processes holding the key,
+    and only entropy estimates come back.
+    """
+
+    def __init__(self, db: Database, crypto, key: Optional[bytes],
+                 workers: int = AUDIT_WORKERS, chunk_size: int = AUDIT_CHUNK_SIZE):
+        self.db = db
+        self.crypto = crypto
+        self.key = key
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+
+    def needs_key(self, strength: bool = False) -> bool:
+        """Tells whether the audit has to decrypt: for strength scoring or for missing fingerprints."""
+        return strength or bool(self.db.get_unfingerprinted(1))
+
+    def refresh_fingerprints(self) -> int:
+        """Fingerprints entries stored without one and returns how many there were."""
+        refreshed = 0
+        while True:
+            rows = self.db.get_unfingerprinted(self.chunk_size)
+            if not rows:
+                break
+            passwords = self.crypto.decrypt_many((blob for _, blob in rows), self.key)
+            fingerprints = self.crypto.fingerprint_many(passwords, self.key)
+            self.db.set_fingerprints(zip(fingerprints, (entry_id for entry_id, _ in rows)))
+            refreshed += len(rows)
+        if refreshed:
+            logger.info(f"Fingerprinted {refreshed} entries")
+        return refreshed
+
+    def reused(self, category: str = None) -> List[List[AuditEntry]]:
+        """Returns groups of entries sharing a password, largest first."""
+        rows = self.db.get_reused(category)
+        groups = [[entry[1:] for entry in group] for _, group in groupby(rows, key=lambda row: row[0])]
+        return sorted(groups, key=len, reverse=True)
+
+    def weak(self, category: str = None, threshold: float = WEAK_PASSWORD_BITS) -> List[WeakEntry]:
+        """Returns entries whose estimated entropy is below threshold bits, weakest first."""
+        rows = self.db.get_encrypted_entries(category)
+        chunks = [[row[3] for row in rows[start:start + self.chunk_size]]
+                  for start in range(0, len(rows), self.chunk_size)]
+        if self.workers == 1 or len(chunks) < 2:
+            scores = [[estimate_entropy(p) for p in self.crypto.decrypt_many(chunk, self.key)] for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(chunks)), initializer=_init_worker,
+                                     initargs=(bytes(self.key),)) as pool:
+                scores = list(pool.map(_score, chunks))
+        weak = [row[:3] + (bits,) for row, bits in zip(rows, (bits for chunk in scores for bits in chunk))
+                if bits < threshold]
+        return sorted(weak, key=lambda entry: entry[3])
+
+    def run(self, category: str = None, strength: bool = False,
+            threshold: float = WEAK_PASSWORD_BITS) -> AuditReport:
+        """Fills in missing fingerprints when the key is known and returns the report."""
+        if self.key is not None:
+            self.refresh_fingerprints()
+        weak = self.weak(category, threshold) if strength else None
+        return AuditReport(self.db.count_entries(category), self.reused(category), weak)
@@ -0,0 +1,395 @@
+import os
+import hmac
+import json
+import time
+import queue
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+from config import (LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, JOURNAL_FILE, JOURNAL_ENABLED, JOURNAL_MAX_BYTES,
+                    JOURNAL_ROTATE_SECONDS, JOURNAL_BACKUPS, JOURNAL_BATCH, JOURNAL_HMAC_KEY_FILE)
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; writers in several processes are then not serialized
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+JOURNAL_LOGGER = "passman.journal"
+
+# Outcomes of journaled operations
+OK = "ok"
+DENIED = "denied"
+NOT_FOUND = "not_found"
+CONFLICT = "conflict"
+RATE_LIMITED = "rate_limited"
+FAILED = "failed"
+ERROR = "error"
+
+MAC_FIELD = "mac"
+# Bytes read from the end of a journal file to find the MAC of its last record
+TAIL_SIZE = 64 * 1024
+
+
+def _dumps(event: dict) -> str:
+    return json.dumps(event, sort_keys=True, separators=(",", ":"))
+
+
+def chain_mac(key: bytes, previous: str, body: str) -> str:
+    """Returns the MAC of a record: HMAC-SHA256 over the previous record's MAC and this record without its MAC."""
+    return hmac.new(key, previous.encode() + b"\n" + body.encode(), hashlib.sha256).hexdigest()
+
+
+def _split_mac(line: str) -> Tuple[str, Optional[str]]:
+    """Splits a journal line into the record without its MAC and the MAC, or None for an unsigned record."""
+    event = json.loads(line)
+    mac = event.pop(MAC_FIELD, None)
+    return _dumps(event), mac
+
+
+def load_key(path: str) -> bytes:
+    """Reads the journal HMAC key, creating a random one readable by the owner only on first use."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32))
+    with open(path, "rb") as f:
+        key = f.read()
+    if len(key) < 16:
+        raise RuntimeError(f"Journal key {path} is too short")
+    return key
+
+
+def journal_files(path: str) -> List[str]:
+    """Returns the existing journal files, oldest first."""
+    rotated = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        rotated.append(f"{path}.{index}")
+        index += 1
+    return rotated[::-1] + ([path] if os.path.exists(path) else [])
+
+
+def verify(path: str, key: bytes) -> Tuple[int, bool, Optional[str]]:
+    """Checks the HMAC chain over the journal and its rotated files.
+
+    Returns the number of verified records, whether the chain reaches back
+    to its first record (older files may have been rotated away) and the
+    location of the first record that breaks the chain, or None.
+    """
+    previous: Optional[str] = None
+    genesis = False
+    checked = 0
+    for file_path in journal_files(path):
+        with open(file_path, "r") as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    body, mac = _split_mac(line)
+                except ValueError:
+                    return checked, genesis, f"{file_path}:{number}: malformed record"
+                if mac is None:
+                    if previous is None:
+                        continue
+                    return checked, genesis, f"{file_path}:{number}: unsigned record"
+                if previous is None:
+                    # The first signed record either starts the chain or follows records rotated away
+                    genesis = hmac.compare_digest(chain_mac(key, "", body), mac)
+                elif not hmac.compare_digest(chain_mac(key, previous, body), mac):
+                    return checked, genesis, f"{file_path}:{number}: MAC mismatch"
+                previous = mac
+                checked += 1
+    return checked, genesis, None
+
+
+class JournalHandler(logging.Handler):
+    """Appends journal events to a JSON-lines file in batches, rotating it by size and age.
+
+    Runs on the listener thread. Events are collected until the queue is
+    empty or batch events are waiting, then written with a single append,
+    so a burst of operations costs one write. Writers in other processes
+    are serialized with a lock file; each batch reopens the file when
+    another process rotated it and continues the HMAC chain from the last
+    record on disk.
+    """
+
+    def __init__(self, path: str, events: queue.SimpleQueue, max_bytes: int = JOURNAL_MAX_BYTES,
+                 rotate_seconds: float = JOURNAL_ROTATE_SECONDS, backups: int = JOURNAL_BACKUPS,
+                 batch: int = JOURNAL_BATCH, key: Optional[bytes] = None):
+        super().__init__()
+        self.path = path
+        self.events = events
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.batch = batch
+        self.key = key
+        self._pending: List[dict] = []
+        self._fd: Optional[int] = None
+        self._inode: Optional[int] = None
+        self._started: Optional[float] = None
+        # MAC of the last record written here, valid while the file still ends where that write ended
+        self._mac: Optional[str] = None
+        self._end: Optional[int] = None
+
+    def emit(self, record: logging.LogRecord):
+        self._pending.append(record.event)
+        if len(self._pending) >= self.batch or self.events.empty():
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if not self._pending:
+                return
+            events, self._pending = self._pending, []
+            try:
+                with self._file_lock():
+                    self._write(events)
+            except (OSError, ValueError) as e:
+                logger.error(f"Audit journal write failed: {e}")
+        finally:
+            self.release()
+
+    def _write(self, events: List[dict]):
+        self._open()
+        size = os.fstat(self._fd).st_size
+        if size and ((self.max_bytes and size >= self.max_bytes) or
+                     (self.rotate_seconds and self._started is not None and
+                      time.time() - self._started >= self.rotate_seconds)):
+            self._rotate()
+            self._open()
+            size = 0
+        lines = []
+        previous = self._last_mac(size) if self.key is not None else None
+        for event in events:
+            body = _dumps(event)
+            if self.key is not None:
+                previous = chain_mac(self.key, previous, body)
+                body = f'{body[:-1]},"{MAC_FIELD}":"{previous}"}}'
+            lines.append(body)
+        data = ("\n".join(lines) + "\n").encode()
+        written = 0
+        while written < len(data):
+            written += os.write(self._fd, data[written:])
+        if self._started is None:
+            self._started = events[0]["ts"]
+        self._mac, self._end = previous, size + len(data)
+
+    def _open(self):
+        """Opens the journal file, or reopens it after another process rotated it."""
+        if self._fd is not None:
+            try:
+                if os.stat(self.path).st_ino == self._inode:
+                    return
+            except FileNotFoundError:
+                pass
+            self._close_file()
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._inode = os.fstat(self._fd).st_ino
+        self._started = self._first_time()
+
+    def _first_time(self) -> Optional[float]:
+        with open(self.path, "r") as f:
+            line = f.readline()
+        return json.loads(line)["ts"] if line else None
+
+    def _rotate(self):
+        self._close_file()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _last_mac(self, size: int) -> str:
+        """Returns the MAC of the last record on disk, looking into the rotated file when the journal is empty."""
+        if self._mac is not None and self._end == size:
+            return self._mac
+        for path in (self.path, f"{self.path}.1"):
+            if not os.path.exists(path) or not os.path.getsize(path):
+                continue
+            with open(path, "rb") as f:
+                f.seek(max(0, os.path.getsize(path) - TAIL_SIZE))
+                lines = f.read().splitlines()
+            return _split_mac(lines[-1].decode())[1] or ""
+        return ""
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _close_file(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd, self._inode, self._mac = None, None, None
+
+    def close(self):
+        self.flush()
+        self._close_file()
+        super().close()
+
+
+class _EventQueueHandler(logging.handlers.QueueHandler):
+    """Queues journal records as they are: the event dict needs no formatting and no copy of the record."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class AuditLog:
+    """Journal of vault operations: which action touched which entry, how long it took and how it ended.
+
+    Records carry the vault, service and category names, the outcome and
+    the duration, never usernames or passwords. record() costs the caller a
+    few microseconds: it only hands a log record to a QueueHandler. A
+    QueueListener thread started on first use writes the records through
+    a JournalHandler, and the queue is drained when the process exits.
+    With a key file set, each record carries an HMAC over itself and the
+    previous record's MAC, so editing, inserting or deleting records
+    breaks the chain (see verify()).
+    """
+
+    def __init__(self, path: str = None, enabled: bool = JOURNAL_ENABLED, max_bytes: int = JOURNAL_MAX_BYTES,
+                 rotate_seconds: float = JOURNAL_ROTATE_SECONDS, backups: int = JOURNAL_BACKUPS,
+                 batch: int = JOURNAL_BATCH, key_file: str = JOURNAL_HMAC_KEY_FILE):
+        self.path = path or JOURNAL_FILE
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.batch = batch
+        self.key_file = key_file
+        # A logger outside the logging hierarchy, so journal records never reach the application log;
+        # it only builds records, which go straight to the queue handler
+        self._logger = logging.Logger(JOURNAL_LOGGER, logging.INFO)
+        self._handler: Optional[logging.Handler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            # The listener thread does not survive fork; a child starts its own on first use
+            os.register_at_fork(after_in_child=self._forget)
+
+    def _start(self):
+        with self._lock:
+            if self._handler is not None:
+                return
+            events = queue.SimpleQueue()
+            key = load_key(self.key_file) if self.key_file else None
+            handler = JournalHandler(self.path, events, self.max_bytes, self.rotate_seconds, self.backups,
+                                     self.batch, key)
+            self._handler = _EventQueueHandler(events)
+            self._listener = logging.handlers.QueueListener(events, handler)
+            self._listener.start()
+            atexit.register(self.close)
+
+    def _forget(self):
+        self._lock = threading.Lock()
+        self._listener = None
+        self._handler = None
+
+    def record(self, action: str, outcome: str = OK, duration: Optional[float] = None, **fields):
+        """Queues one journal record; fields with None values are left out."""
+        if not self.enabled:
+            return
+        handler = self._handler
+        if handler is None:
+            self._start()
+            handler = self._handler
+        event = {"ts": time.time(), "pid": os.getpid(), "action": action, "outcome": outcome}
+        if duration is not None:
+            event["ms"] = round(duration * 1000, 3)
+        event.update((name, value) for name, value in fields.items() if value is not None)
+        # makeRecord() skips Logger.info()'s caller lookup, which would cost more than the rest of the call
+        log_record = self._logger.makeRecord(JOURNAL_LOGGER, logging.INFO, "", 0, action, None, None)
+        log_record.event = event
+        handler.handle(log_record)
+
+    @contextmanager
+    def action(self, name: str, **fields) -> Iterator[dict]:
+        """Journals the enclosed operation with its duration.
+
+        The yielded dict holds the record's fields; the caller sets
+        "outcome" (OK by default) and may add fields, such as the service
+        once it is known. An exception is recorded as ERROR with its type.
+        """
+        fields["outcome"] = OK
+        start = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields["outcome"] = ERROR
+            fields["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(name, duration=time.perf_counter() - start, **fields)
+
+    def close(self):
+        """Writes the queued records and stops the listener thread."""
+        with self._lock:
+            listener, self._listener = self._listener, None
+            self._handler = None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+
+
+journal = AuditLog()
+
+_log_handler: Optional[logging.Handler] = None
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(log_file: str = LOG_FILE, level: int = logging.INFO):
+    """Sends application log records to stderr and, through a listener thread, to a rotating log file.
+
+    The file handler opens the log only when the first record arrives, and
+    callers never wait for its writes.
+    """
+    global _log_handler, _log_listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    formatter = logging.Formatter(LOG_FORMAT)
+    if _log_handler is None:
+        stream = logging.StreamHandler()
+        stream.setFormatter(formatter)
+        root.addHandler(stream)
+        if hasattr(os, "register_at_fork"):
+            # The listener thread does not survive fork; the child gets a queue and listener of its own
+            os.register_at_fork(after_in_child=lambda: configure_logging(log_file, level))
+        atexit.register(_stop_logging)
+    else:
+        root.removeHandler(_log_handler)
+    records = queue.SimpleQueue()
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                                        delay=True)
+    file_handler.setFormatter(formatter)
+    _log_handler = logging.handlers.QueueHandler(records)
+    root.addHandler(_log_handler)
+    _log_listener = logging.handlers.QueueListener(records, file_handler)
+    _log_listener.start()
+
+
+def _stop_logging():
+    global _log_listener
+    listener, _log_listener = _log_listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
@@ -0,0 +1,363 @@
+import os
+import json
+import time
+import shutil
+import logging
+import sqlite3
+import hashlib
+import datetime
+import contextlib
+from typing import List, Optional, Tuple
+from config import DB_PATH, BACKUP_DIR, BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP, BACKUP_RETENTION
+
+logger = logging.getLogger(__name__)
+
+FULL = "full"
+DIFFERENTIAL = "differential"
+INCREMENTAL = "incremental"
+
+# Each changed page in a delta file is stored as a 4-byte page number followed by the page
+PAGE_NUMBER_SIZE = 4
+# Extensions of the files a backup may consist of, besides its manifest
+BACKUP_FILES = ("db", "pages", "salt", "verifier")
+
+
+class BackupManager:
+    """Creates, restores and prunes online backups of the vault database.
+
+    Full backups are consistent copies made with the SQLite online backup API.
+    Differential backups store the pages changed since the last full backup,
+    incremental backups the pages changed since the previous backup of any kind;
+    they hash the live database file inside a read transaction and write only
+    the pages whose hash differs from the base, without copying the database.
+    Every backup has a JSON manifest with per-page hashes and the SHA-256 of the
+    complete database image, which restore checks before replacing anything.
+
+    key_files names the vault's salt and verifier files. Backups then keep
+    copies of both and record the verifier's SHA-256, so restoring over the
+    live database can tell whether its entries still decrypt under the
+    current master password.
+    """
+
+    def __init__(self, db_path: str = None, backup_dir: str = None, pages_per_step: int = BACKUP_PAGES_PER_STEP,
+                 step_sleep: float = BACKUP_STEP_SLEEP, retention: int = BACKUP_RETENTION,
+                 key_files: Optional[Tuple[str, str]] = None):
+        self.db_path = db_path or DB_PATH
+        self.backup_dir = backup_dir or BACKUP_DIR
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.retention = retention
+        self.key_files = key_files
+
+    def _path(self, name: str, extension: str) -> str:
+        return os.path.join(self.backup_dir, f"{name}.{extension}")
+
+    def _snapshot(self, target_path: str):
+        """Copies the live database page by page, sleeping between steps so writers are not starved."""
+        source = sqlite3.connect(self.db_path)
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(
+                target,
+                pages=self.pages_per_step,
+                progress=lambda status, remaining, total: time.sleep(self.step_sleep)
+            )
+        finally:
+            target.close()
+            source.close()
+
+    @staticmethod
+    def _page_size(path: str) -> int:
+        """Reads the page size from the SQLite file header."""
+        with open(path, "rb") as f:
+            header = f.read(18)
+        page_size = int.from_bytes(header[16:18], "big")
+        return 65536 if page_size == 1 else page_size
+
+    @staticmethod
+    def _hash_pages(path: str, page_size: int) -> List[str]:
+        hashes = []
+        with open(path, "rb") as f:
+            while True:
+                page = f.read(page_size)
+                if not page:
+                    break
+                hashes.append(hashlib.sha256(page).hexdigest())
+        return hashes
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _write_manifest(self, manifest: dict):
+        tmp_file = self._path(manifest["name"], "json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, self._path(manifest["name"], "json"))
+
+    def load_manifest(self, name: str) -> dict:
+        """Returns the manifest of a backup."""
+        with open(self._path(name, "json"), "r") as f:
+            return json.load(f)
+
+    def list_backups(self) -> List[dict]:
+        """Returns all backup manifests, oldest first."""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        manifests = [self.load_manifest(file_name[:-5]) for file_name in os.listdir(self.backup_dir)
+                     if file_name.endswith(".json")]
+        return sorted(manifests, key=lambda m: m["created"])
+
+    def _base_for(self, kind: str) -> Optional[dict]:
+        backups = self.list_backups()
+        if kind == INCREMENTAL:
+            return backups[-1] if backups else None
+        fulls = [m for m in backups if m["kind"] == FULL]
+        return fulls[-1] if fulls else None
+
+    @contextlib.contextmanager
+    def _consistent_image(self, scratch_path: str):
+        """Yields (path, page_size, page_count) of a file that holds one consistent state of the database.
+
+        A read transaction keeps the database file unchanged: in rollback mode
+        writers cannot commit, in WAL mode checkpoints stop at its snapshot. If
+        a checkpoint then copies the whole WAL into the file, the file is that
+        snapshot and is read in place. Otherwise (another reader holds back
+        the checkpoint) the database is copied to scratch_path first.
+        """
+        reader = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            reader.execute("BEGIN")
+            reader.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            page_size = reader.execute("PRAGMA page_size").fetchone()[0]
+            page_count = reader.execute("PRAGMA page_count").fetchone()[0]
+            checkpointer = sqlite3.connect(self.db_path)
+            try:
+                busy, log, checkpointed = checkpointer.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            finally:
+                checkpointer.close()
+            if busy == 0 and log == checkpointed:
+                yield self.db_path, page_size, page_count
+                return
+        finally:
+            reader.close()
+        self._snapshot(scratch_path)
+        try:
+            page_size = self._page_size(scratch_path)
+            yield scratch_path, page_size, os.path.getsize(scratch_path) // page_size
+        finally:
+            os.remove(scratch_path)
+
+    def create(self, kind: str = FULL) -> str:
+        """Creates a backup and returns its name; delta kinds fall back to full without a base."""
+        if kind not in (FULL, DIFFERENTIAL, INCREMENTAL):
+            raise ValueError(f"Unknown backup kind: {kind}")
+        os.makedirs(self.backup_dir, mode=0o700, exist_ok=True)
+        base = self._base_for(kind) if kind != FULL else None
+        created = datetime.datetime.now()
+        stamp = created.strftime('%Y%m%d_%H%M%S_%f')
+        manifest = None
+        name = f"{kind}-{stamp}"
+        try:
+            if base:
+                manifest = self._create_delta(name, kind, base)
+            if manifest is None:
+                name = f"{FULL}-{stamp}"
+                snapshot_path = self._path(name, "db")
+                self._snapshot(snapshot_path)
+                page_size = self._page_size(snapshot_path)
+                hashes = self._hash_pages(snapshot_path, page_size)
+                manifest = {
+                    "name": name,
+                    "kind": FULL,
+                    "base": None,
+                    "page_size": page_size,
+                    "page_count": len(hashes),
+                    "pages": hashes,
+                    "sha256": self._hash_file(snapshot_path)
+                }
+            manifest["created"] = created.isoformat()
+            manifest["verifier"] = self._save_keys(name)
+            self._write_manifest(manifest)
+            return name
+        except Exception as e:
+            for extension in BACKUP_FILES + ("snapshot",):
+                if os.path.exists(self._path(name, extension)):
+                    os.remove(self._path(name, extension))
+            raise RuntimeError(f"Backup failed: {e}")
+
+    def _create_delta(self, name: str, kind: str, base: dict) -> Optional[dict]:
+        """Writes the pages that differ from base to the delta file; returns None if the page size changed."""
+        with self._consistent_image(self._path(name, "snapshot")) as (path, page_size, page_count):
+            if page_size != base["page_size"]:
+                return None
+            base_hashes = base["pages"]
+            hashes = []
+            changed = 0
+            digest = hashlib.sha256()
+            with open(path, "rb") as source, open(self._path(name, "pages"), "wb") as delta:
+                for page_number in range(page_count):
+                    page = source.read(page_size)
+                    if len(page) != page_size:
+                        raise RuntimeError(f"Database file ends at page {page_number} of {page_count}")
+                    digest.update(page)
+                    hashes.append(hashlib.sha256(page).hexdigest())
+                    if page_number < len(base_hashes) and base_hashes[page_number] == hashes[-1]:
+                        continue
+                    delta.write(page_number.to_bytes(PAGE_NUMBER_SIZE, "big"))
+                    delta.write(page)
+                    changed += 1
+        return {
+            "name": name,
+            "kind": kind,
+            "base": base["name"],
+            "page_size": page_size,
+            "page_count": len(hashes),
+            "pages": hashes,
+            "sha256": digest.hexdigest(),
+            "changed_pages": changed
+        }
+
+    def _save_keys(self, name: str) -> Optional[str]:
+        """Copies the vault's salt and verifier next to the backup and returns the verifier's SHA-256."""
+        if self.key_files is None or not os.path.exists(self.key_files[1]):
+            return None
+        for path, extension in zip(self.key_files, ("salt", "verifier")):
+            shutil.copyfile(path, self._path(name, extension))
+        return self._hash_file(self.key_files[1])
+
+    def _check_keys(self, manifest: dict, with_keys: bool) -> bool:
+        """Checks that the backup's entries decrypt under the current keys; returns whether to restore its keys."""
+        if self.key_files is None:
+            return False
+        name, verifier_file = manifest["name"], self.key_files[1]
+        if os.path.exists(verifier_file + ".pending"):
+            raise RuntimeError("A key switch of the vault was interrupted; unlock the vault before restoring")
+        if manifest.get("verifier") is None:
+            logger.warning(f"Backup {name} does not record the vault verifier; its keys are not checked")
+            return False
+        if os.path.exists(verifier_file) and self._hash_file(verifier_file) == manifest["verifier"]:
+            return False
+        if not with_keys:
+            raise RuntimeError(f"Backup {name} was made under another master password, Argon2 parameters "
+                               f"or keyfile; restore its salt and verifier with it")
+        for extension in ("salt", "verifier"):
+            if not os.path.exists(self._path(name, extension)):
+                raise RuntimeError(f"Backup {name} has no copy of the vault {extension}")
+        return True
+
+    @contextlib.contextmanager
+    def _exclusive(self, path: str):
+        """Holds an exclusive lock on the database, failing at once while another connection has it open.
+
+        Leaving WAL mode needs the only connection to the database, so this
+        also catches idle connections, which hold no lock in WAL mode.
+        """
+        connection = sqlite3.connect(path, timeout=0, isolation_level=None)
+        try:
+            try:
+                connection.execute("PRAGMA journal_mode=DELETE").fetchone()
+                connection.execute("BEGIN EXCLUSIVE")
+            except sqlite3.OperationalError as e:
+                raise RuntimeError(f"the database is in use, stop the agent and the API first ({e})")
+            yield
+        finally:
+            connection.close()
+
+    def _chain(self, name: str) -> List[dict]:
+        """Returns the manifests needed to rebuild a backup, starting from its full base."""
+        chain = [self.load_manifest(name)]
+        while chain[-1]["base"]:
+            chain.append(self.load_manifest(chain[-1]["base"]))
+        return list(reversed(chain))
+
+    def _rebuild(self, name: str, target_path: str) -> dict:
+        """Writes the database image of a backup to target_path and checks its hash."""
+        chain = self._chain(name)
+        manifest = chain[-1]
+        with open(self._path(chain[0]["name"], "db"), "rb") as source, open(target_path, "wb") as target:
+            for block in iter(lambda: source.read(1 << 20), b""):
+                target.write(block)
+        with open(target_path, "r+b") as target:
+            for delta in chain[1:]:
+                page_size = delta["page_size"]
+                with open(self._path(delta["name"], "pages"), "rb") as pages:
+                    while True:
+                        page_number = pages.read(PAGE_NUMBER_SIZE)
+                        if not page_number:
+                            break
+                        target.seek(int.from_bytes(page_number, "big") * page_size)
+                        target.write(pages.read(page_size))
+                target.truncate(delta["page_count"] * page_size)
+        if self._hash_file(target_path) != manifest["sha256"]:
+            raise RuntimeError(f"Backup {name} does not match its manifest")
+        return manifest
+
+    def verify(self, name: str) -> bool:
+        """Rebuilds a backup into a scratch file and checks it is byte-identical to the snapshot taken."""
+        scratch = self._path(name, "verify")
+        try:
+            self._rebuild(name, scratch)
+            return True
+        except Exception:
+            return False
+        finally:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+
+    def restore(self, name: str, target_path: str = None, with_keys: bool = False) -> Optional[str]:
+        """Restores a backup over the database (or target_path) after verifying it.
+
+        Over the live database the restore refuses to run while another
+        connection has the database open, and when the backup was made under
+        another verifier, unless with_keys restores its salt and verifier as
+        well. The current database is first saved as a full backup, whose name
+        is returned.
+        """
+        live = target_path is None
+        target_path = target_path or self.db_path
+        tmp_file = target_path + ".restore"
+        try:
+            manifest = self._rebuild(name, tmp_file)
+            if not live:
+                for suffix in ("-wal", "-shm"):
+                    if os.path.exists(target_path + suffix):
+                        os.remove(target_path + suffix)
+                os.replace(tmp_file, target_path)
+                return None
+            restore_keys = self._check_keys(manifest, with_keys)
+            previous = self.create(FULL) if os.path.exists(target_path) else None
+            with self._exclusive(target_path):
+                os.replace(tmp_file, target_path)
+                if restore_keys:
+                    for path, extension in zip(self.key_files, ("salt", "verifier")):
+                        shutil.copyfile(self._path(name, extension), path + ".restore")
+                        os.replace(path + ".restore", path)
+            return previous
+        except Exception as e:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise RuntimeError(f"Restore failed: {e}")
+
+    def prune(self) -> List[str]:
+        """Keeps the newest `retention` full backups with their deltas and deletes everything older."""
+        backups = self.list_backups()
+        fulls = [m["name"] for m in backups if m["kind"] == FULL]
+        kept = set(fulls[-self.retention:]) if self.retention > 0 else set()
+        by_name = {m["name"]: m for m in backups}
+        removed = []
+        for manifest in backups:
+            root = manifest
+            while root["base"] and root["base"] in by_name:
+                root = by_name[root["base"]]
+            if root["name"] in kept:
+                continue
+            for extension in BACKUP_FILES + ("json",):
+                if os.path.exists(self._path(manifest["name"], extension)):
+                    os.remove(self._path(manifest["name"], extension))
+            removed.append(manifest["name"])
+        return removed
@@ -0,0 +1,1323 @@
+"""Performance benchmarks for the password manager.
+
+Run ``python bench.py unlock`` to compare the legacy two-pass unlock with the
+single Argon2 pass used today, ``python bench.py crypto`` for bulk AES-GCM
+throughput, ``python bench.py pool`` for concurrent reads against a single writer,
+``python bench.py ndjson`` for streaming export/import time and peak memory,
+``python bench.py startup`` for cold-start time of each CLI subcommand,
+``python bench.py agent`` for per-request latency through the key-caching agent,
+``python bench.py search`` for search-as-you-type latency on a large vault,
+``python bench.py cache`` for decrypted-entry cache hit latency and hit rate,
+``python bench.py metrics`` for the overhead of the timing instrumentation,
+``python bench.py importers`` for browser CSV and KeePass XML import throughput,
+``python bench.py generator`` for bulk password generation,
+``python bench.py audit`` for reuse detection and parallel strength scoring,
+``python bench.py history`` for the write overhead of password history,
+``python bench.py vaults`` for cross-vault search and keyring unlock,
+``python bench.py sync`` for delta sync of a large vault with a few changes,
+``python bench.py backup`` for incremental backup size and time after a few changes to a large vault,
+``python bench.py aio`` for event-loop stalls of blocking versus AsyncVault calls,
+``python bench.py httpapi`` for lookups per second through the local HTTP secrets API,
+``python bench.py snapshot`` for open-and-lookup latency of a compiled snapshot versus the database,
+``python bench.py config`` for settings load time with and without the cached parse,
+``python bench.py usb`` for USB keyfile discovery with a cold and a cached mount table, or
+``python bench.py journal`` for the caller-side cost of queued audit records versus inline writes.
+
+``python bench.py suite --output results.json`` runs the core operations on a
+deterministic synthetic vault and writes the timings as JSON; with
+``--baseline old.json`` (or ``python bench.py compare new.json old.json``) it
+flags operations whose median got slower than the threshold and exits with 1.
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from argon2 import PasswordHasher
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from config import ARGON2_PARAMS, settings
+from backup import BackupManager, FULL, DIFFERENTIAL, INCREMENTAL
+from agent import AgentClient
+from cache import EntryCache
+from metrics import registry
+from auditlog import AuditLog, JournalHandler
+from crypto import Crypto
+from db import Database, SKIP
+from importers import Importer, CSV, KEEPASS
+from generator import PasswordGenerator, Policy
+from audit import Auditor
+from search import SearchIndex
+from vaults import Keyring, Vault, VaultSet
+from sync import DirectoryRemote, Replica, Synchronizer
+from aio import AsyncVault
+from httpapi import SecretsServer, TokenStore
+from snapshot import Snapshot, compile_snapshot
+from usb_key_check import MountTable
+
+CATEGORY_WORDS = ["mail", "bank", "git", "cloud", "shop", "news", "chat", "video", "music", "games", "travel", "work"]
+
+
+def synthetic_vault(db: Database, entries: int, categories: int = len(CATEGORY_WORDS), skew: float = 1.0,
+                    seed: int = 42, crypto: Optional[Crypto] = None, key: Optional[bytes] = None,
+                    batch: int = 10_000, reuse: float = 0.0):
+    """Fills db with a reproducible vault; the same arguments always give the same entries.
+
+    Services look like ``gitmail-17.example.com``. Entries are spread over
+    ``categories`` named categories plus "no category" with weights
+    1 / (rank + 1) ** skew, so 0 spreads them evenly and larger values
+    concentrate them in the first few. Passwords are encrypted with key when
+    one is given, otherwise random bytes of the same size are stored. A reuse
+    share of entries copies the password of another entry in the same batch.
+    Fingerprints are left empty.
+    """
+    rng = random.Random(seed)
+    names = [CATEGORY_WORDS[i] if i < len(CATEGORY_WORDS) else f"category-{i}" for i in range(categories)]
+    with db.transaction() as cursor:
+        cursor.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)", ((name,) for name in names))
+        cursor.execute("SELECT name, id FROM categories")
+        category_ids = dict(cursor.fetchall())
+    buckets = [0] + [category_ids[name] for name in names]
+    weights = [1 / (rank + 1) ** skew for rank in range(len(buckets))]
+
+    for start in range(0, entries, batch):
+        count = min(batch, entries - start)
+        services = [f"{rng.choice(CATEGORY_WORDS)}{rng.choice(CATEGORY_WORDS)}-{start + i}.example.com"
+                    for i in range(count)]
+        usernames = [f"user{rng.randrange(10 ** 6)}" for _ in range(count)]
+        passwords = [f"pw-{rng.getrandbits(64):016x}" for _ in range(count)]
+        if reuse:
+            for i in range(count):
+                if rng.random() < reuse:
+                    passwords[i] = passwords[rng.randrange(count)]
+        category_column = rng.choices(buckets, weights, k=count)
+        if key is not None:
+            blobs = (crypto or Crypto()).encrypt_many(passwords, key)
+        else:
+            blobs = [os.urandom(28 + len(password)) for password in passwords]
+        with db.transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO passwords (service, username, encrypted_password, category_id) VALUES (?, ?, ?, ?)",
+                zip(services, usernames, blobs, category_column)
+            )
+
+
+def sample_entries(db: Database, count: int, seed: int) -> List[Tuple[str, Optional[str]]]:
+    """Returns a reproducible sample of (service, category) pairs from a synthetic vault."""
+    connection = db.connect()
+    max_id = connection.execute("SELECT max(id) FROM passwords").fetchone()[0] or 0
+    rng = random.Random(seed)
+    ids = [rng.randint(1, max_id) for _ in range(count)] if max_id else []
+    sample = []
+    for entry_id in ids:
+        row = connection.execute(
+            "SELECT p.service, NULLIF(c.name, '') FROM passwords p JOIN categories c ON c.id = p.category_id "
+            "WHERE p.id = ?", (entry_id,)
+        ).fetchone()
+        if row:
+            sample.append(row)
+    return sample
+
+
+def measure(func: Callable[[], object], repeat: int) -> List[float]:
+    """Runs func repeat times and returns wall-clock durations in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name: str, timings: List[float]):
+    """Prints median and spread for a list of timings."""
+    print(f"{name:<44} median {statistics.median(timings) * 1000:9.2f} ms  "
+          f"min {min(timings) * 1000:9.2f} ms  max {max(timings) * 1000:9.2f} ms")
+
+
+def bench_unlock(repeat: int):
+    """Compares legacy verify+derive with the single-pass HKDF unlock."""
+    crypto = Crypto()
+    ph = PasswordHasher(**ARGON2_PARAMS)
+    password = "correct horse battery staple"
+    salt = os.urandom(16)
+    stored_hash = ph.hash(password.encode(), salt=salt)
+
+    def legacy_unlock():
+        ph.verify(stored_hash, password.encode())
+        return ph.hash(password.encode(), salt=salt).encode()[:32]
+
+    def single_pass_unlock():
+        return crypto.derive_keys(password, salt)
+
+    legacy = measure(legacy_unlock, repeat)
+    single = measure(single_pass_unlock, repeat)
+    report("legacy verify + derive_key", legacy)
+    report("single-pass derive_keys", single)
+    print(f"speedup: {statistics.median(legacy) / statistics.median(single):.2f}x")
+
+
+def bench_crypto(rows: int):
+    """Compares per-call Cipher objects with base64 against the batched AEAD engine."""
+    crypto = Crypto()
+    key = os.urandom(32)
+    passwords = [f"password-{i:08d}" for i in range(rows)]
+
+    def legacy_encrypt(password: str) -> str:
+        iv = os.urandom(12)
+        encryptor = Cipher(algorithms.AES(key), modes.GCM(iv)).encryptor()
+        encrypted = encryptor.update(password.encode()) + encryptor.finalize()
+        return base64.b64encode(iv + encryptor.tag + encrypted).decode()
+
+    def legacy_decrypt(encrypted_password: str) -> str:
+        data = base64.b64decode(encrypted_password)
+        decryptor = Cipher(algorithms.AES(key), modes.GCM(data[:12], data[12:28])).decryptor()
+        return (decryptor.update(data[28:]) + decryptor.finalize()).decode()
+
+    legacy_rows = []
+    batched_rows = []
+    legacy_enc = measure(lambda: legacy_rows.extend(legacy_encrypt(p) for p in passwords), 1)
+    legacy_dec = measure(lambda: [legacy_decrypt(e) for e in legacy_rows], 1)
+    batched_enc = measure(lambda: batched_rows.extend(crypto.encrypt_many(passwords, key)), 1)
+    batched_dec = measure(lambda: crypto.decrypt_many(batched_rows, key), 1)
+
+    report(f"legacy encrypt x{rows}", legacy_enc)
+    report(f"encrypt_many x{rows}", batched_enc)
+    report(f"legacy decrypt x{rows}", legacy_dec)
+    report(f"decrypt_many x{rows}", batched_dec)
+    print(f"storage: legacy {sum(len(e) for e in legacy_rows)} bytes, "
+          f"blob {sum(len(e) for e in batched_rows)} bytes")
+
+
+def bench_pool(readers: int, rows: int, seconds: float):
+    """Runs reader threads against one writer thread on a WAL vault and reports throughput."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "pool.db"))
+        db.init_db()
+        with db.transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO passwords (service, username, encrypted_password, category_id) VALUES (?, ?, ?, 0)",
+                ((f"service-{i}", f"user-{i}", os.urandom(44)) for i in range(rows))
+            )
+
+        stop = threading.Event()
+        read_latencies: List[List[float]] = [[] for _ in range(readers)]
+        write_latencies: List[float] = []
+        errors: List[Exception] = []
+
+        def reader(slot: int):
+            rng = random.Random(slot)
+            try:
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    db.get_password(f"service-{rng.randrange(rows)}")
+                    read_latencies[slot].append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(e)
+
+        def writer():
+            i = 0
+            try:
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    db.add_password(f"new-{i}", "writer", os.urandom(44))
+                    write_latencies.append(time.perf_counter() - start)
+                    i += 1
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reader, args=(slot,)) for slot in range(readers)]
+        threads.append(threading.Thread(target=writer))
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        db.close()
+
+    reads = sorted(t for slot in read_latencies for t in slot)
+    print(f"readers: {readers}, rows: {rows}, duration: {seconds:.1f} s, errors: {len(errors)}")
+    print(f"reads  {len(reads) / seconds:10.0f}/s  p50 {reads[len(reads) // 2] * 1e6:8.1f} us  "
+          f"p99 {reads[int(len(reads) * 0.99)] * 1e6:8.1f} us")
+    print(f"writes {len(write_latencies) / seconds:10.0f}/s  "
+          f"p50 {statistics.median(write_latencies) * 1e6:8.1f} us")
+    for error in errors[:5]:
+        print(f"error: {error}")
+
+
+def bench_ndjson(rows: int, chunk_size: int):
+    """Measures streaming export/import time and peak Python heap on a synthetic vault."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = Database(os.path.join(tmp_dir, "source.db"))
+        source.init_db()
+        with source.transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO passwords (service, username, encrypted_password, category_id) VALUES (?, ?, ?, 0)",
+                ((f"service-{i}", f"user-{i}", os.urandom(44)) for i in range(rows))
+            )
+        export_file = os.path.join(tmp_dir, "export.ndjson")
+        progressed = []
+
+        def run_pass(name: str) -> Tuple[float, float, int, int]:
+            target = Database(os.path.join(tmp_dir, f"{name}.db"))
+            target.init_db()
+            start = time.perf_counter()
+            source.export_data(export_file)
+            export_time = time.perf_counter() - start
+            start = time.perf_counter()
+            imported = target.import_data(export_file, chunk_size=chunk_size, progress=progressed.append)
+            import_time = time.perf_counter() - start
+            target.close()
+            return export_time, import_time, imported, os.path.getsize(export_file)
+
+        # Timings come from an untraced pass; tracemalloc slows Python code several-fold
+        export_time, import_time, imported, file_size = run_pass("timed")
+        tracemalloc.start()
+        source.export_data(export_file)
+        export_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        traced = Database(os.path.join(tmp_dir, "traced.db"))
+        traced.init_db()
+        traced.import_data(export_file, chunk_size=chunk_size)
+        import_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        traced.close()
+        source.close()
+
+    print(f"rows: {rows}, file: {file_size / 2 ** 20:.1f} MiB")
+    print(f"export  {export_time:8.2f} s  peak heap {export_peak / 2 ** 20:8.2f} MiB")
+    print(f"import  {import_time:8.2f} s  peak heap {import_peak / 2 ** 20:8.2f} MiB  "
+          f"imported {imported}, progress {sum(progressed)}/{file_size} bytes")
+
+
+def bench_startup(repeat: int):
+    """Measures wall-clock cold start of each CLI subcommand in a fresh process."""
+    manager_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manager.py")
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+
+        def run_cli(args: List[str], stdin: str = "") -> float:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, manager_script] + args, input=stdin.encode(), env=env, cwd=home,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            return time.perf_counter() - start
+
+        run_cli(["--password-stdin", "add", "seed", "user"], "master\nseed-password\n")
+        commands = {
+            "gen": (["gen"], ""),
+            "list": (["list"], ""),
+            "export": (["export"], ""),
+            "import": (["import"], ""),
+            "get --field username": (["get", "seed", "--field", "username"], ""),
+            "get (includes Argon2)": (["--password-stdin", "get", "seed"], "master\n"),
+        }
+        for name, (args, stdin) in commands.items():
+            report(name, [run_cli(args, stdin) for _ in range(repeat)])
+        report("python -c pass (baseline)", measure(
+            lambda: subprocess.run([sys.executable, "-c", "pass"], check=True), repeat))
+
+
+def bench_agent(clients: int, requests: int):
+    """Starts an agent on a throwaway vault and measures get latency from concurrent clients."""
+    manager_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manager.py")
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        socket_path = os.path.join(home, "agent.sock")
+        subprocess.run([sys.executable, manager_script, "--password-stdin", "add", "seed", "user"],
+                       input=b"master\nseed-password\n", env=env, cwd=home, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        agent = subprocess.Popen([sys.executable, manager_script, "--password-stdin", "--socket", socket_path,
+                                  "agent", "start"], stdin=subprocess.PIPE, env=env, cwd=home,
+                                 stderr=subprocess.DEVNULL)
+        agent.stdin.write(b"master\n")
+        agent.stdin.close()
+        try:
+            deadline = time.monotonic() + 30
+            while AgentClient.available(socket_path) is None:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("agent did not start")
+                time.sleep(0.05)
+
+            latencies: List[List[float]] = [[] for _ in range(clients)]
+
+            def client_loop(slot: int):
+                client = AgentClient(socket_path)
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    client.request("get", service="seed")
+                    latencies[slot].append(time.perf_counter() - start)
+                client.close()
+
+            threads = [threading.Thread(target=client_loop, args=(slot,)) for slot in range(clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            AgentClient(socket_path).request("stop")
+        finally:
+            agent.wait(timeout=10)
+
+    timings = sorted(t for slot in latencies for t in slot)
+    print(f"clients: {clients}, requests: {len(timings)}, throughput {len(timings) / elapsed:.0f}/s")
+    print(f"get p50 {timings[len(timings) // 2] * 1e6:8.1f} us  p99 {timings[int(len(timings) * 0.99)] * 1e6:8.1f} us")
+
+
+def bench_search(rows: int, repeat: int):
+    """Measures trigram search latency for typical as-you-type queries on a synthetic vault."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "search.db"))
+        db.init_db()
+        start = time.perf_counter()
+        synthetic_vault(db, rows)
+        print(f"rows: {rows}, populated in {time.perf_counter() - start:.1f} s")
+
+        index = SearchIndex(db)
+        queries = ["g", "gi", "git", "gitcl", "cloudmail-1234", "user4242", "gtihub", "zzzzqqq"]
+        for query in queries:
+            report(f"search {query!r}", measure(lambda: index.search(query), repeat))
+        for query, category in [("mail", "bank"), ("user42", "mail"), ("ample.com", "bank")]:
+            report(f"search {query!r} in category {category!r}", measure(lambda: index.search(query, category), repeat))
+        db.close()
+
+
+def bench_cache(entries: int, lookups: int):
+    """Compares a cache miss (index seek plus AES-GCM) with a hit, then replays a skewed access pattern."""
+    crypto = Crypto()
+    key = os.urandom(32)
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "cache.db"))
+        db.init_db()
+        encrypted = crypto.encrypt_many((f"password-{i}" for i in range(entries)), key)
+        with db.transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO passwords (service, username, encrypted_password) VALUES (?, ?, ?)",
+                ((f"service-{i}", f"user{i}", blob) for i, blob in enumerate(encrypted))
+            )
+        cache = EntryCache()
+
+        def view(service: str):
+            cached = cache.get(service)
+            if cached is not None:
+                return cached
+            entry = db.get_password(service)
+            password = crypto.decrypt_password(entry["encrypted_password"], key)
+            cache.put(service, None, entry["username"], password)
+            return entry["username"], password
+
+        def miss():
+            cache.clear()
+            view("service-1")
+
+        for name, func in [("miss", miss), ("hit", lambda: view("service-1"))]:
+            timings = measure(func, lookups)
+            print(f"view, cache {name:<5} median {statistics.median(timings) * 1e6:8.1f} us  "
+                  f"p99 {sorted(timings)[int(len(timings) * 0.99)] * 1e6:8.1f} us")
+
+        cache.clear()
+        cache.hits = cache.misses = 0
+        # Few entries are viewed often: sample services with a Pareto-like skew
+        for _ in range(lookups):
+            view(f"service-{min(int(rng.paretovariate(0.8)) - 1, entries - 1)}")
+        stats = cache.stats()
+        print(f"skewed lookups: {lookups}, hit rate {stats['hits'] / lookups:.1%}, "
+              f"evictions {stats['evictions']}, size {stats['size']}")
+        cache.clear()
+        db.close()
+
+
+def bench_metrics(lookups: int):
+    """Compares instrumented get_password calls with the registry enabled and disabled."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "metrics.db"))
+        db.init_db()
+        synthetic_vault(db, 1000)
+        sample = sample_entries(db, 100, 42)
+        enabled = registry.enabled
+        try:
+            results = {}
+            for state in (False, True, False, True):
+                registry.enabled = state
+                timings = measure(lambda: [db.get_password(s, c) for s, c in sample], lookups // len(sample))
+                results.setdefault(state, []).extend(t / len(sample) for t in timings)
+        finally:
+            registry.enabled = enabled
+            registry.discard()
+        db.close()
+    disabled, instrumented = statistics.median(results[False]), statistics.median(results[True])
+    print(f"get_password uninstrumented {disabled * 1e6:8.2f} us  instrumented {instrumented * 1e6:8.2f} us  "
+          f"overhead {(instrumented - disabled) * 1e6:6.2f} us ({instrumented / disabled - 1:+.1%})")
+
+
+def write_import_files(directory: str, rows: int, seed: int = 42) -> Dict[str, str]:
+    """Writes the same entries as a Chrome-style CSV and a KeePass XML export; about 5% repeat a service."""
+    from xml.sax.saxutils import escape
+    rng = random.Random(seed)
+    entries = []
+    for i in range(rows):
+        n = rng.randrange(i) if i and rng.random() < 0.05 else i
+        entries.append((f"site{n}.example.com", f"user{i}", f"pw-{rng.getrandbits(64):x}",
+                        CATEGORY_WORDS[n % len(CATEGORY_WORDS)]))
+    paths = {CSV: os.path.join(directory, "import.csv"), KEEPASS: os.path.join(directory, "import.xml")}
+    with open(paths[CSV], "w", newline="") as f:
+        f.write("name,url,username,password,folder\n")
+        for service, username, password, folder in entries:
+            f.write(f"{service},https://{service}/,{username},{password},{folder}\n")
+    with open(paths[KEEPASS], "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<KeePassFile><Meta></Meta><Root><Group><Name>Root</Name>\n')
+        for folder in CATEGORY_WORDS:
+            f.write(f"<Group><Name>{folder}</Name>\n")
+            for service, username, password, category in entries:
+                if category == folder:
+                    f.write("<Entry>" + "".join(
+                        f"<String><Key>{k}</Key><Value>{escape(v)}</Value></String>"
+                        for k, v in (("Title", service), ("UserName", username), ("Password", password))
+                    ) + "</Entry>\n")
+            f.write("</Group>\n")
+        f.write("</Group></Root></KeePassFile>\n")
+    return paths
+
+
+def bench_importers(rows: int, workers: List[int]):
+    """Times full imports of both formats into fresh vaults; dry runs also report peak Python memory."""
+    crypto = Crypto()
+    key = os.urandom(32)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_import_files(tmp_dir, rows)
+        runs = [(file_format, True, 1) for file_format in paths]
+        runs += [(file_format, False, count) for file_format in paths for count in workers]
+        for i, (file_format, dry_run, count) in enumerate(runs):
+            db = Database(os.path.join(tmp_dir, f"import{i}.db"))
+            db.init_db()
+            # tracemalloc slows allocation-heavy code down, so encrypted runs are timed without it
+            if dry_run:
+                tracemalloc.start()
+            start = time.perf_counter()
+            result = Importer(db, crypto, key, workers=count).import_file(paths[file_format], file_format,
+                                                                          SKIP, dry_run)
+            elapsed = time.perf_counter() - start
+            memory = ""
+            if dry_run:
+                memory = f"  peak {tracemalloc.get_traced_memory()[1] / 2**20:6.1f} MiB"
+                tracemalloc.stop()
+            name = f"{file_format} {'dry run' if dry_run else f'workers={count}'}"
+            print(f"{name:<22}{elapsed:8.2f} s  {rows / elapsed:10.0f} rows/s  "
+                  f"new {result.inserted}, skipped {result.skipped}{memory}")
+            db.close()
+
+
+def bench_generator(count: int):
+    """Compares one secrets.choice call per character with the policy generator."""
+    import secrets
+    import string
+    chars = string.ascii_letters + string.digits + "!@#$%^&*"
+
+    def legacy():
+        return ["".join(secrets.choice(chars) for _ in range(16)) for _ in range(count)]
+
+    policies = [("policy, 1 of each class", Policy.default()),
+                ("policy, no look-alikes", Policy(exclude_look_alikes=True)),
+                ("passphrase, 5 words", Policy(passphrase=True))]
+    start = time.perf_counter()
+    legacy()
+    print(f"{'secrets.choice per char':<26}{(time.perf_counter() - start) / count * 1e6:8.2f} us/password")
+    for name, policy in policies:
+        start = time.perf_counter()
+        PasswordGenerator(policy).generate_many(count)
+        print(f"{name:<26}{(time.perf_counter() - start) / count * 1e6:8.2f} us/password  "
+              f"{policy.entropy_bits():6.1f} bits")
+
+
+def bench_audit(entries: int, reuse: float, workers: List[int]):
+    """Compares reuse detection by decrypting every entry with the fingerprint GROUP BY, then times strength scoring."""
+    crypto = Crypto()
+    key = os.urandom(32)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "audit.db"))
+        db.init_db()
+        synthetic_vault(db, entries, crypto=crypto, key=key, reuse=reuse)
+        auditor = Auditor(db, crypto, key)
+
+        start = time.perf_counter()
+        auditor.refresh_fingerprints()
+        print(f"{'fingerprint backfill (once)':<32}{time.perf_counter() - start:8.3f} s")
+
+        def decrypt_all():
+            seen = {}
+            for service, username, category, blob in db.get_encrypted_entries():
+                seen.setdefault(crypto.decrypt_password(blob, key), []).append((service, username, category))
+            return [group for group in seen.values() if len(group) > 1]
+
+        for name, func in [("reuse, decrypt every entry", decrypt_all), ("reuse, fingerprint GROUP BY", auditor.reused)]:
+            timings = measure(func, 3)
+            print(f"{name:<32}{statistics.median(timings):8.3f} s  {sum(len(g) for g in func())} entries reused")
+        for count in workers:
+            auditor.workers = count
+            timings = measure(auditor.weak, 3)
+            print(f"{f'strength, {count} workers':<32}{statistics.median(timings):8.3f} s")
+        db.close()
+
+
+def bench_history(entries: int, updates: int):
+    """Measures the write overhead of password history and the amortized cost of pruning it.
+
+    The bare UPDATE and the history INSERT plus UPDATE run in the same
+    transaction-per-write loop; update_password adds timing and cache
+    notification on top. Hot entries are then edited past the per-entry
+    limit to show that batched pruning keeps the table bounded.
+    """
+    from config import HISTORY_PER_ENTRY, HISTORY_PRUNE_EVERY
+    from db import HOT_QUERIES, category_name
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "history.db"))
+        db.init_db()
+        synthetic_vault(db, entries)
+        sample = sample_entries(db, updates, seed=7)
+        rows = [(service, category_name(category), os.urandom(44), os.urandom(16)) for service, category in sample]
+
+        def raw_update():
+            for service, category, blob, fingerprint in rows:
+                with db.transaction() as cursor:
+                    cursor.execute(HOT_QUERIES["update_password"][0], (blob, fingerprint, service, category))
+
+        def raw_update_with_history():
+            for service, category, blob, fingerprint in rows:
+                with db.transaction() as cursor:
+                    cursor.execute(HOT_QUERIES["save_history"][0],
+                                   (time.time(), service, category, fingerprint, fingerprint))
+                    cursor.execute(HOT_QUERIES["update_password"][0], (blob, fingerprint, service, category))
+
+        def update_password():
+            for (service, category), (_, _, blob, fingerprint) in zip(sample, rows):
+                db.update_password(service, blob, category, fingerprint)
+
+        raw_update()  # warms the page cache
+        for name, func in [("UPDATE only", raw_update), ("history INSERT + UPDATE", raw_update_with_history),
+                           ("update_password", update_password)]:
+            # Fresh fingerprints each round, so every write saves a version
+            rows = [(service, category, blob, os.urandom(16)) for service, category, blob, _ in rows]
+            start = time.perf_counter()
+            func()
+            print(f"{name:<32}{(time.perf_counter() - start) / len(rows) * 1e6:8.1f} us/write")
+
+        hot = sample[:50]
+        start = time.perf_counter()
+        for _ in range(HISTORY_PER_ENTRY * 3):
+            for service, category in hot:
+                db.update_password(service, os.urandom(44), category, os.urandom(16))
+        elapsed = time.perf_counter() - start
+        writes = HISTORY_PER_ENTRY * 3 * len(hot)
+        kept = db.connect().execute(
+            "SELECT count(*) FROM password_history h JOIN passwords p ON p.id = h.entry_id "
+            "WHERE p.service IN (%s)" % ",".join("?" * len(hot)), [service for service, _ in hot]
+        ).fetchone()[0]
+        print(f"{'hot entries, pruned as it goes':<32}{elapsed / writes * 1e6:8.1f} us/write  "
+              f"{writes} versions written, {kept} kept (limit {HISTORY_PER_ENTRY} x {len(hot)} + {HISTORY_PRUNE_EVERY})")
+
+        with db.transaction() as cursor:
+            start = time.perf_counter()
+            since = cursor.execute("SELECT max(id) FROM password_history").fetchone()[0] - HISTORY_PRUNE_EVERY
+            Database._prune_history(cursor, HISTORY_PER_ENTRY, 10 ** 9, since)
+            batch = time.perf_counter() - start
+        start = time.perf_counter()
+        db.prune_history()
+        full = time.perf_counter() - start
+        total = db.connect().execute("SELECT count(*) FROM password_history").fetchone()[0]
+        print(f"{'batched prune':<32}{batch * 1000:8.2f} ms  {batch / HISTORY_PRUNE_EVERY * 1e6:.1f} us/write amortized")
+        print(f"{'full prune':<32}{full * 1000:8.2f} ms  {total} versions kept")
+        db.close()
+
+
+def bench_vaults(vaults: int, entries: int, lookups: int):
+    """Compares searching vaults one after another with the parallel VaultSet, then keyring with per-vault unlock."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        members = []
+        for i in range(vaults):
+            directory = os.path.join(tmp_dir, f"vault-{i}")
+            members.append(Vault(f"vault-{i}", os.path.join(directory, "passman.db"),
+                                 os.path.join(directory, "salt.bin"), os.path.join(directory, "master.hash"),
+                                 os.path.join(directory, "backups"), os.path.join(directory, "agent.sock")))
+            members[-1].create_dir()
+            db = Database(members[-1].db_path)
+            db.init_db()
+            synthetic_vault(db, entries, seed=i)
+            db.close()
+        rng = random.Random(1)
+        queries = [rng.choice(CATEGORY_WORDS)[:rng.randint(3, 5)] + str(rng.randrange(10)) for _ in range(lookups)]
+
+        for name, workers in [("one vault after another", 1), ("parallel", vaults)]:
+            vault_set = VaultSet(members, workers)
+            for query in queries[:10]:
+                vault_set.search(query)
+            timings = measure(lambda: [vault_set.search(query) for query in queries], 3)
+            print(f"{f'search {vaults} vaults, {name}':<44}{statistics.median(timings) / lookups * 1000:8.2f} ms/query")
+            vault_set.close()
+
+        salts = []
+        for vault in members:
+            vault_crypto = Crypto(vault.salt_file, vault.master_hash_file)
+            salts.append(vault_crypto.get_salt())
+            vault_crypto.unlock("vault password", salts[-1])
+        keyring = Keyring(os.path.join(tmp_dir, "keyring"))
+        keyring.unlock("keyring password")
+        for vault in members:
+            keyring.add(vault, os.urandom(32))
+
+        def unlock_each():
+            for vault, salt in zip(members, salts):
+                Crypto(vault.salt_file, vault.master_hash_file).unlock("vault password", salt)
+
+        def unlock_keyring():
+            ring = Keyring(keyring.directory)
+            ring.unlock("keyring password")
+            return ring.keys(members)
+
+        report(f"unlock {vaults} vaults one by one", measure(unlock_each, 3))
+        report(f"unlock {vaults} vaults with the keyring", measure(unlock_keyring, 3))
+
+
+def bench_sync(entries: int, changes: int):
+    """Times the one-off tree build, then syncs of a copy after a few edits, inserts and deletes on both sides."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        salt_file, hash_file = os.path.join(tmp_dir, "salt.bin"), os.path.join(tmp_dir, "master.hash")
+        with open(salt_file, "wb") as f:
+            f.write(os.urandom(80))
+        with open(hash_file, "w") as f:
+            f.write("$passman-hkdf$bench")
+        db = Database(os.path.join(tmp_dir, "local.db"))
+        db.init_db()
+        start = time.perf_counter()
+        synthetic_vault(db, entries)
+        print(f"{'fill vault':<36}{time.perf_counter() - start:9.3f} s  {entries} entries")
+        local = Replica(db)
+        start = time.perf_counter()
+        local.refresh()
+        print(f"{'initial tree build':<36}{time.perf_counter() - start:9.3f} s")
+        start = time.perf_counter()
+        remote_db = DirectoryRemote(os.path.join(tmp_dir, "remote")).open(db, salt_file, hash_file)
+        print(f"{'create remote copy':<36}{time.perf_counter() - start:9.3f} s")
+        synchronizer = Synchronizer(local, Replica(remote_db))
+        report = synchronizer.run()
+        print(f"{'sync, no changes':<36}{report.seconds * 1000:9.2f} ms")
+
+        rng = random.Random(3)
+        for round_number in range(3):
+            for side in (db, remote_db):
+                sample = sample_entries(side, changes, seed=rng.randrange(10 ** 6))
+                for i, (service, category) in enumerate(sample):
+                    if i % 3 == 0:
+                        side.delete_password(service, category)
+                    else:
+                        side.update_password(service, os.urandom(44), category)
+                side.add_password(f"new-{round_number}-{rng.randrange(10 ** 9)}.example.com", "user", os.urandom(44))
+            report = synchronizer.run()
+            print(f"{f'sync, {changes} changes per side':<36}{report.seconds * 1000:9.2f} ms  {report.buckets} buckets, "
+                  f"{report.compared} keys compared, {report.pulled} pulled, {report.pushed} pushed, "
+                  f"{report.conflicts} conflicts")
+        start = time.perf_counter()
+        db.export_data(os.path.join(tmp_dir, "export.ndjson"))
+        print(f"{'full NDJSON export, for comparison':<36}{time.perf_counter() - start:9.3f} s")
+        remote_db.close()
+        db.close()
+
+
+def bench_backup(entries: int, changes: int):
+    """Times a full backup of a large vault, then incremental backups after a few updates each."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "vault.db"))
+        db.init_db()
+        synthetic_vault(db, entries)
+        backups = BackupManager(db.db_path, os.path.join(tmp_dir, "backups"), step_sleep=0)
+        start = time.perf_counter()
+        name = backups.create(FULL)
+        size = os.path.getsize(os.path.join(backups.backup_dir, f"{name}.db"))
+        print(f"{'full backup':<36}{time.perf_counter() - start:9.3f} s  {size / 2 ** 20:9.1f} MiB written")
+        rng = random.Random(5)
+        for _ in range(3):
+            for service, category in sample_entries(db, changes, seed=rng.randrange(10 ** 6)):
+                db.update_password(service, os.urandom(44), category)
+            start = time.perf_counter()
+            name = backups.create(INCREMENTAL)
+            elapsed = time.perf_counter() - start
+            manifest = backups.load_manifest(name)
+            delta_size = os.path.getsize(os.path.join(backups.backup_dir, f"{name}.pages"))
+            print(f"{f'incremental, {changes} updates':<36}{elapsed:9.3f} s  {delta_size / 2 ** 20:9.3f} MiB written, "
+                  f"{manifest['changed_pages']} of {manifest['page_count']} pages")
+        db.close()
+
+
+def bench_aio(entries: int, clients: int, requests: int, bulk: int):
+    """Measures the longest event-loop stall and the throughput of each workload, blocking calls versus AsyncVault.
+
+    A ticker coroutine sleeps 1 ms at a time; the longest gap between its
+    wake-ups is how long other coroutines of the service would have waited.
+    """
+    async def run(workload) -> Tuple[float, float]:
+        done = asyncio.Event()
+        stall = 0.0
+
+        async def ticker():
+            nonlocal stall
+            last = time.perf_counter()
+            while not done.is_set():
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                stall, last = max(stall, now - last), now
+
+        ticker_task = asyncio.create_task(ticker())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        await workload()
+        elapsed = time.perf_counter() - start
+        done.set()
+        await ticker_task
+        return elapsed, stall
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "bench.db"))
+        db.init_db()
+        crypto = Crypto(os.path.join(tmp_dir, "salt.bin"), os.path.join(tmp_dir, "master.hash"))
+        key = crypto.unlock("bench password", crypto.get_salt()).enc_key
+        synthetic_vault(db, entries, crypto=crypto, key=key)
+        keys = sample_entries(db, requests, seed=5)
+        plain = [(f"bulk-{i}.example.com", "user", f"password-{i}", None) for i in range(bulk)]
+
+        async def main():
+            vault = AsyncVault(db, crypto, key)
+            await vault.derive_key("warm up", os.urandom(16))
+
+            async def blocking_unlock():
+                crypto.unlock("bench password", crypto.get_salt())
+
+            async def blocking_gets():
+                async def client(part):
+                    for service, category in part:
+                        crypto.decrypt_password(db.get_password(service, category)["encrypted_password"], key)
+                        await asyncio.sleep(0)
+                await asyncio.gather(*(client(keys[i::clients]) for i in range(clients)))
+
+            async def async_gets():
+                async def client(part):
+                    for service, category in part:
+                        await vault.get(service, category)
+                await asyncio.gather(*(client(keys[i::clients]) for i in range(clients)))
+
+            async def blocking_bulk():
+                passwords = [entry[2] for entry in plain]
+                rows = [entry[:2] + (blob, entry[3], fingerprint) for entry, blob, fingerprint in
+                        zip(plain, crypto.encrypt_many(passwords, key), crypto.fingerprint_many(passwords, key))]
+                db.add_passwords(rows)
+
+            async def async_bulk():
+                await vault.add_many(plain)
+
+            workloads = [
+                ("unlock (Argon2)", blocking_unlock, lambda: vault.unlock("bench password")),
+                (f"{requests} gets, {clients} clients", blocking_gets, async_gets),
+                (f"add_many {bulk} entries", blocking_bulk, async_bulk),
+            ]
+            print(f"{'workload':<32}{'blocking':>22}{'AsyncVault':>22}")
+            for name, blocking, asynchronous in workloads:
+                cells = []
+                for workload in (blocking, asynchronous):
+                    elapsed, stall = await run(workload)
+                    cells.append(f"{elapsed * 1000:8.1f} ms, {stall * 1000:6.1f} stall")
+                    with db.transaction() as cursor:
+                        cursor.execute("DELETE FROM passwords WHERE service LIKE 'bulk-%'")
+                print(f"{name:<32}{cells[0]:>22}{cells[1]:>22}")
+            vault.close()
+
+        asyncio.run(main())
+        db.close()
+
+
+def _serve_api(db_path: str, salt_file: str, hash_file: str, tokens_file: str, port: int):
+    db = Database(db_path)
+    crypto = Crypto(salt_file, hash_file)
+    key = crypto.unlock("bench password", crypto.get_salt()).enc_key
+    SecretsServer(AsyncVault(db, crypto, key), "bench", TokenStore(tokens_file), port=port).run()
+
+
+def bench_httpapi(entries: int, connections: int, requests: int):
+    """Loads the secrets API from another process: keep-alive connections versus a new connection per request."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path, salt_file, hash_file = (os.path.join(tmp_dir, name) for name in ("bench.db", "salt.bin", "master.hash"))
+        db = Database(db_path)
+        db.init_db()
+        crypto = Crypto(salt_file, hash_file)
+        key = crypto.unlock("bench password", crypto.get_salt()).enc_key
+        synthetic_vault(db, entries, crypto=crypto, key=key)
+        keys = sample_entries(db, requests, seed=9)
+        db.close()
+        token = TokenStore(os.path.join(tmp_dir, "tokens.json")).create("bench", "load", rate=1e9, burst=10 ** 9)
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        server = multiprocessing.Process(target=_serve_api,
+                                         args=(db_path, salt_file, hash_file, os.path.join(tmp_dir, "tokens.json"), port))
+        server.start()
+
+        def request(service: str, category: Optional[str], keep_alive: bool) -> bytes:
+            query = f"?category={category}" if category else ""
+            connection = "" if keep_alive else "Connection: close\r\n"
+            return (f"GET /v1/secrets/{service}{query} HTTP/1.1\r\nHost: localhost\r\n"
+                    f"Authorization: Bearer {token}\r\n{connection}\r\n").encode()
+
+        async def client(part, keep_alive: bool, latencies: List[float]):
+            reader = writer = None
+            for service, category in part:
+                start = time.perf_counter()
+                if writer is None:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(request(service, category, keep_alive))
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+                await reader.readexactly(length)
+                assert head.startswith(b"HTTP/1.1 200"), head
+                if not keep_alive:
+                    writer.close()
+                    reader = writer = None
+                latencies.append(time.perf_counter() - start)
+            if writer is not None:
+                writer.close()
+
+        async def load(keep_alive: bool) -> Tuple[float, List[float]]:
+            latencies: List[float] = []
+            start = time.perf_counter()
+            await asyncio.gather(*(client(keys[i::connections], keep_alive, latencies) for i in range(connections)))
+            return time.perf_counter() - start, latencies
+
+        async def main():
+            for _ in range(100):
+                try:
+                    await asyncio.open_connection("127.0.0.1", port)
+                    break
+                except OSError:
+                    await asyncio.sleep(0.1)
+            await load(True)
+            for name, keep_alive in [("keep-alive", True), ("connection per request", False)]:
+                elapsed, latencies = await load(keep_alive)
+                latencies.sort()
+                print(f"{f'{name}, {connections} connections':<40}{len(latencies) / elapsed:9.0f} req/s  "
+                      f"p50 {latencies[len(latencies) // 2] * 1000:.2f} ms  "
+                      f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+
+        try:
+            asyncio.run(main())
+        finally:
+            server.terminate()
+            server.join()
+
+
+def bench_snapshot(entries: int, lookups: int):
+    """Compares reading one secret from a cold SQLite vault with a compiled snapshot, per open and per lookup."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.db")
+        db = Database(db_path)
+        db.init_db()
+        crypto = Crypto(os.path.join(tmp_dir, "salt.bin"), os.path.join(tmp_dir, "master.hash"))
+        key = crypto.unlock("bench password", crypto.get_salt()).enc_key
+        synthetic_vault(db, entries, crypto=crypto, key=key)
+        keys = sample_entries(db, lookups, seed=11)
+
+        snapshot_path = os.path.join(tmp_dir, "vault.snapshot")
+        start = time.perf_counter()
+        rows = db.get_encrypted_entries()
+        passwords = crypto.decrypt_many((row[3] for row in rows), key)
+        snapshot_key = compile_snapshot(snapshot_path, ((service, category, username, password) for
+                                                        (service, username, category, _), password in zip(rows, passwords)))
+        print(f"{'compile snapshot':<40}{time.perf_counter() - start:9.3f} s  "
+              f"{os.path.getsize(snapshot_path) / 2 ** 20:.1f} MiB, database {os.path.getsize(db_path) / 2 ** 20:.1f} MiB")
+        db.close()
+
+        def database_open_get(service, category):
+            vault_db = Database(db_path)
+            vault_db.init_db()
+            crypto.decrypt_password(vault_db.get_password(service, category)["encrypted_password"], key)
+            vault_db.close()
+
+        def snapshot_open_get(service, category):
+            with Snapshot(snapshot_path, snapshot_key) as snapshot:
+                snapshot.get(service, category)
+
+        open_db = Database(db_path)
+        snapshot = Snapshot(snapshot_path, snapshot_key)
+        cases = [
+            ("database: open, init_db, get, decrypt", database_open_get),
+            ("snapshot: open, get, decrypt", snapshot_open_get),
+            ("database: get, decrypt (open)",
+             lambda service, category: crypto.decrypt_password(open_db.get_password(service, category)["encrypted_password"], key)),
+            ("snapshot: get, decrypt (open)", snapshot.get),
+        ]
+        for name, func in cases:
+            sample = keys if "(open)" in name else keys[:200]
+            timings = measure(lambda: [func(service, category) for service, category in sample], 3)
+            print(f"{name:<40}{statistics.median(timings) / len(sample) * 10 ** 6:9.1f} us/lookup")
+        snapshot.close()
+        open_db.close()
+
+
+def bench_config(repeat: int):
+    """Times importing config in a fresh interpreter with a full settings file, parsing the YAML or reading the cache."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        import yaml
+        data = {}
+        for key, value, _, _ in settings.diagnostics():
+            section, name = key.split(".")
+            data.setdefault(section, {})[name] = value
+        with open(os.path.join(tmp_dir, ".passman_config.yaml"), "w") as f:
+            yaml.safe_dump(data, f)
+        env = dict(os.environ, PASSMAN_HOME=tmp_dir)
+        env.pop("PASSMAN_CONFIG", None)
+        cache_file = os.path.join(tmp_dir, ".passman_config.cache.json")
+        script = "import config; assert not config.settings.errors, config.settings.errors"
+
+        def load(cached: bool):
+            if not cached and os.path.exists(cache_file):
+                os.remove(cache_file)
+            subprocess.run([sys.executable, "-c", script], env=env, check=True)
+
+        baseline = measure(lambda: subprocess.run([sys.executable, "-c", "pass"], check=True), repeat)
+        report("interpreter start", baseline)
+        for name, cached in (("import config, YAML parse", False), ("import config, cached parse", True)):
+            load(True)
+            report(name, measure(lambda: load(cached), repeat))
+        start = time.perf_counter()
+        for _ in range(1000):
+            settings.reload()
+        print(f"{'reload() of an unchanged file':<44} per call {(time.perf_counter() - start) * 1000:9.2f} us")
+
+
+def bench_usb(lookups: int):
+    """Times finding USB mounts in /proc/self/mountinfo on a fresh table and on a cached one."""
+    def cold():
+        table = MountTable()
+        table.usb_mounts()
+        table.close()
+
+    report("mount table: parse and resolve", measure(cold, 200))
+    table = MountTable()
+    table.usb_mounts()
+    start = time.perf_counter()
+    for _ in range(lookups):
+        table.usb_mounts()
+    print(f"{'mount table: unchanged (poll)':<44} per call {(time.perf_counter() - start) / lookups * 10 ** 6:9.2f} us")
+    table.close()
+
+
+def bench_journal(records: int):
+    """Times audit records as seen by the caller: written inline one at a time versus queued to the listener."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, key in (("journal", None), ("HMAC journal", os.urandom(32))):
+            handler = JournalHandler(os.path.join(tmp_dir, f"inline-{key is None}.jsonl"), queue.SimpleQueue(),
+                                     batch=1, key=key)
+            start = time.perf_counter()
+            for _ in range(records):
+                record = logging.makeLogRecord({})
+                record.event = {"ts": time.time(), "pid": os.getpid(), "action": "get", "outcome": "ok",
+                                "vault": "vault", "service": "service", "category": "category"}
+                handler.handle(record)
+            elapsed = time.perf_counter() - start
+            handler.close()
+            print(f"{name + ': inline write':<44} per call {elapsed / records * 10 ** 6:9.2f} us")
+
+            key_file = ""
+            if key is not None:
+                key_file = os.path.join(tmp_dir, "key")
+                with open(key_file, "wb") as f:
+                    f.write(key)
+            log = AuditLog(os.path.join(tmp_dir, f"queued-{key is None}.jsonl"), key_file=key_file)
+            log.record("warmup")
+            start = time.perf_counter()
+            for _ in range(records):
+                log.record("get", vault="vault", service="service", category="category")
+            caller = time.perf_counter() - start
+            log.close()
+            total = time.perf_counter() - start
+            print(f"{name + ': queued record()':<44} per call {caller / records * 10 ** 6:9.2f} us")
+            print(f"{name + ': queued, until written':<44} per record {total / records * 10 ** 6:7.2f} us")
+
+
+def bench_suite(entries: int, categories: int, skew: float, seed: int, repeat: int) -> dict:
+    """Times the core vault operations on a synthetic vault and returns the results as a JSON-ready dict.
+
+    Every result is the median, minimum and maximum seconds per operation over
+    ``repeat`` runs; batched operations divide each run by its ``ops``.
+    """
+    # Imported here: manager configures file logging on import
+    from manager import PasswordManager
+
+    results: Dict[str, dict] = {}
+
+    def record(name: str, timings: List[float], ops: int = 1):
+        per_op = [t / ops for t in timings]
+        results[name] = {"median": statistics.median(per_op), "min": min(per_op), "max": max(per_op),
+                         "runs": len(per_op), "ops": ops}
+        report(name if ops == 1 else f"{name} (per op, x{ops})", per_op)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        crypto = Crypto(os.path.join(tmp_dir, "salt.bin"), os.path.join(tmp_dir, "master.hash"))
+        manager = PasswordManager(os.path.join(tmp_dir, "vault.db"), crypto, os.path.join(tmp_dir, "config.yaml"))
+        salt = crypto.get_salt()
+        record("Crypto.derive_key", measure(lambda: crypto.derive_key("master", salt), repeat))
+        key = manager.unlock("master", salt).enc_key
+
+        start = time.perf_counter()
+        synthetic_vault(manager.db, entries, categories, skew, seed, crypto, key)
+        record("synthetic_vault", [time.perf_counter() - start], entries)
+
+        batch = min(1000, entries) or 1
+        passwords = [f"pw-{i:016x}" for i in range(batch)]
+        blobs = crypto.encrypt_many(passwords, key)
+        record("Crypto.encrypt_password",
+               measure(lambda: [crypto.encrypt_password(p, key) for p in passwords], repeat), batch)
+        record("Crypto.decrypt_password",
+               measure(lambda: [crypto.decrypt_password(b, key) for b in blobs], repeat), batch)
+
+        sample = sample_entries(manager.db, batch, seed)
+        record("Database.get_password",
+               measure(lambda: [manager.db.get_password(s, c) for s, c in sample], repeat), len(sample) or 1)
+        runs = iter(range(repeat))
+
+        def add_batch():
+            run = next(runs)
+            for i, blob in enumerate(blobs):
+                manager.db.add_password(f"bench-{run}-{i}", "bench", blob)
+
+        record("Database.add_password", measure(add_batch, repeat), batch)
+        record("Database.get_all_services", measure(manager.db.get_all_services, repeat))
+
+        export_file = os.path.join(tmp_dir, "export.ndjson")
+        record("Database.export_data", measure(lambda: manager.db.export_data(export_file), repeat))
+        targets = iter(range(repeat))
+
+        def import_into_fresh_vault():
+            target = Database(os.path.join(tmp_dir, f"import-{next(targets)}.db"))
+            target.init_db()
+            target.import_data(export_file)
+            target.close()
+
+        record("Database.import_data", measure(import_into_fresh_vault, repeat))
+
+        backup_dir = os.path.join(tmp_dir, "backups")
+        record("Database.backup_db full", measure(lambda: manager.db.backup_db(FULL, backup_dir), repeat))
+        record("Database.backup_db differential",
+               measure(lambda: manager.db.backup_db(DIFFERENTIAL, backup_dir), repeat))
+
+        new_passwords = iter(["master-2", "master"] * repeat)
+
+        def change_master_password():
+            nonlocal key
+            _, new_keys = manager.change_master_password(key, salt, next(new_passwords))
+            key = new_keys.enc_key
+
+        record("PasswordManager.change_master_password", measure(change_master_password, repeat))
+        manager.cache.clear()
+        manager.db.close()
+
+    return {
+        "meta": {
+            "created": datetime.datetime.now().isoformat(),
+            "entries": entries,
+            "categories": categories,
+            "skew": skew,
+            "seed": seed,
+            "repeat": repeat,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform()
+        },
+        "results": results
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> int:
+    """Prints median changes against a baseline and returns the number of regressions."""
+    for field in ("entries", "categories", "skew", "seed"):
+        if current["meta"].get(field) != baseline["meta"].get(field):
+            print(f"warning: {field} differs ({current['meta'].get(field)} vs baseline "
+                  f"{baseline['meta'].get(field)}), timings are not comparable")
+    regressions = 0
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{'new':<10} {name}")
+            continue
+        before, after = baseline["results"][name]["median"], result["median"]
+        change = after / before - 1 if before else 0.0
+        if change > threshold:
+            status = "REGRESSED"
+            regressions += 1
+        elif change < -threshold:
+            status = "improved"
+        else:
+            status = "ok"
+        print(f"{status:<10} {name:<40} {before * 1000:10.4f} ms -> {after * 1000:10.4f} ms  {change:+7.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Password manager benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    unlock = subparsers.add_parser("unlock", help="Argon2 unlock latency")
+    unlock.add_argument("--repeat", type=int, default=5)
+    bulk_crypto = subparsers.add_parser("crypto", help="bulk AES-GCM throughput")
+    bulk_crypto.add_argument("--rows", type=int, default=100_000)
+    pool = subparsers.add_parser("pool", help="N reader threads against one writer")
+    pool.add_argument("--readers", type=int, default=4)
+    pool.add_argument("--rows", type=int, default=10_000)
+    pool.add_argument("--seconds", type=float, default=3.0)
+    ndjson = subparsers.add_parser("ndjson", help="streaming export/import")
+    ndjson.add_argument("--rows", type=int, default=100_000)
+    ndjson.add_argument("--chunk-size", type=int, default=1000)
+    startup = subparsers.add_parser("startup", help="cold-start milliseconds per CLI subcommand")
+    startup.add_argument("--repeat", type=int, default=5)
+    agent = subparsers.add_parser("agent", help="get latency through the agent socket")
+    agent.add_argument("--clients", type=int, default=8)
+    agent.add_argument("--requests", type=int, default=2000)
+    search = subparsers.add_parser("search", help="search-as-you-type latency")
+    search.add_argument("--rows", type=int, default=500_000)
+    search.add_argument("--repeat", type=int, default=20)
+    metrics = subparsers.add_parser("metrics", help="overhead of the timing instrumentation")
+    metrics.add_argument("--lookups", type=int, default=200_000)
+    suite = subparsers.add_parser("suite", help="core operations on a synthetic vault, JSON output")
+    suite.add_argument("--entries", type=int, default=10_000, help="vault size, 1k to 1M")
+    suite.add_argument("--categories", type=int, default=len(CATEGORY_WORDS))
+    suite.add_argument("--skew", type=float, default=1.0, help="0 spreads entries evenly over categories")
+    suite.add_argument("--seed", type=int, default=42)
+    suite.add_argument("--repeat", type=int, default=5)
+    suite.add_argument("--output", help="write results to this JSON file")
+    suite.add_argument("--baseline", help="compare against results stored earlier")
+    suite.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown of a median, 0.2 = 20%%")
+    compare_parser = subparsers.add_parser("compare", help="compare two suite result files")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+    cache = subparsers.add_parser("cache", help="decrypted-entry cache hit latency and hit rate")
+    cache.add_argument("--entries", type=int, default=10_000)
+    cache.add_argument("--lookups", type=int, default=10_000)
+    importers = subparsers.add_parser("importers", help="browser CSV and KeePass XML import throughput")
+    importers.add_argument("--rows", type=int, default=50_000)
+    importers.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    generator = subparsers.add_parser("generator", help="bulk password generation")
+    generator.add_argument("--count", type=int, default=100_000)
+    audit = subparsers.add_parser("audit", help="reuse detection and strength scoring")
+    audit.add_argument("--entries", type=int, default=100_000)
+    audit.add_argument("--reuse", type=float, default=0.05, help="share of entries reusing another's password")
+    audit.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    history = subparsers.add_parser("history", help="write overhead of password history")
+    history.add_argument("--entries", type=int, default=100_000)
+    history.add_argument("--updates", type=int, default=2_000)
+    vaults = subparsers.add_parser("vaults", help="cross-vault search and keyring unlock")
+    vaults.add_argument("--vaults", type=int, default=4)
+    vaults.add_argument("--entries", type=int, default=50_000)
+    vaults.add_argument("--lookups", type=int, default=200)
+    sync = subparsers.add_parser("sync", help="delta sync of a large vault with a few changes")
+    sync.add_argument("--entries", type=int, default=1_000_000)
+    sync.add_argument("--changes", type=int, default=10)
+    backup = subparsers.add_parser("backup", help="incremental backup of a large vault with a few changes")
+    backup.add_argument("--entries", type=int, default=500_000)
+    backup.add_argument("--changes", type=int, default=10)
+    aio = subparsers.add_parser("aio", help="event-loop stalls of blocking versus AsyncVault calls")
+    aio.add_argument("--entries", type=int, default=100_000)
+    aio.add_argument("--clients", type=int, default=16)
+    aio.add_argument("--requests", type=int, default=2_000)
+    aio.add_argument("--bulk", type=int, default=20_000)
+    httpapi = subparsers.add_parser("httpapi", help="lookups per second through the local HTTP secrets API")
+    httpapi.add_argument("--entries", type=int, default=100_000)
+    httpapi.add_argument("--connections", type=int, default=8)
+    httpapi.add_argument("--requests", type=int, default=20_000)
+    snapshot = subparsers.add_parser("snapshot", help="compiled snapshot versus database lookups")
+    snapshot.add_argument("--entries", type=int, default=100_000)
+    snapshot.add_argument("--lookups", type=int, default=2_000)
+    config_parser = subparsers.add_parser("config", help="settings load time, YAML parse versus cached parse")
+    config_parser.add_argument("--repeat", type=int, default=20)
+    usb = subparsers.add_parser("usb", help="USB keyfile discovery, cold and cached")
+    usb.add_argument("--lookups", type=int, default=100_000)
+    journal = subparsers.add_parser("journal", help="audit record cost, queued versus synchronous")
+    journal.add_argument("--records", type=int, default=100_000)
+    args = parser.parse_args()
+
+    if args.benchmark == "unlock":
+        bench_unlock(args.repeat)
+    elif args.benchmark == "crypto":
+        bench_crypto(args.rows)
+    elif args.benchmark == "pool":
+        bench_pool(args.readers, args.rows, args.seconds)
+    elif args.benchmark == "ndjson":
+        bench_ndjson(args.rows, args.chunk_size)
+    elif args.benchmark == "startup":
+        bench_startup(args.repeat)
+    elif args.benchmark == "agent":
+        bench_agent(args.clients, args.requests)
+    elif args.benchmark == "search":
+        bench_search(args.rows, args.repeat)
+    elif args.benchmark == "cache":
+        bench_cache(args.entries, args.lookups)
+    elif args.benchmark == "metrics":
+        bench_metrics(args.lookups)
+    elif args.benchmark == "importers":
+        bench_importers(args.rows, args.workers)
+    elif args.benchmark == "generator":
+        bench_generator(args.count)
+    elif args.benchmark == "audit":
+        bench_audit(args.entries, args.reuse, args.workers)
+    elif args.benchmark == "history":
+        bench_history(args.entries, args.updates)
+    elif args.benchmark == "vaults":
+        bench_vaults(args.vaults, args.entries, args.lookups)
+    elif args.benchmark == "sync":
+        bench_sync(args.entries, args.changes)
+    elif args.benchmark == "backup":
+        bench_backup(args.entries, args.changes)
+    elif args.benchmark == "aio":
+        bench_aio(args.entries, args.clients, args.requests, args.bulk)
+    elif args.benchmark == "httpapi":
+        bench_httpapi(args.entries, args.connections, args.requests)
+    elif args.benchmark == "snapshot":
+        bench_snapshot(args.entries, args.lookups)
+    elif args.benchmark == "config":
+        bench_config(args.repeat)
+    elif args.benchmark == "usb":
+        bench_usb(args.lookups)
+    elif args.benchmark == "journal":
+        bench_journal(args.records)
+    elif args.benchmark == "suite":
+        results = bench_suite(args.entries, args.categories, args.skew, args.seed, args.repeat)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            if compare(results, baseline, args.threshold):
+                raise SystemExit(1)
+    elif args.benchmark == "compare":
+        with open(args.current, "r") as f:
+            current = json.load(f)
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if compare(current, baseline, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
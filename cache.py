@@ -0,0 +1,105 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from config import CACHE_MAX_ENTRIES, CACHE_TTL
+
+CacheKey = Tuple[str, Optional[str]]
+
+
+class _CachedEntry:
+    __slots__ = ("username", "password", "expires")
+
+    def __init__(self, username: str, password: bytearray, expires: float):
+        self.username = username
+        self.password = password
+        self.expires = expires
+
+    def wipe(self):
+        for i in range(len(self.password)):
+            self.password[i] = 0
+
+
+class EntryCache:
+    """LRU cache of decrypted entries keyed by (service, category).
+
+    Passwords are kept as UTF-8 bytearrays and overwritten when an entry is
+    evicted for size, expires after ttl seconds, is invalidated by a write or
+    the whole cache is cleared on lock. Strings returned by get() are copies
+    the caller is responsible for; the cache only bounds how long plaintext
+    stays in its own buffers.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[CacheKey, _CachedEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, service: str, category: str = None) -> Optional[Tuple[str, str]]:
+        """Returns (username, password) if the entry is cached and fresh, otherwise None."""
+        key = (service, category or None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= self.clock():
+                self._discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.username, entry.password.decode()
+
+    def put(self, service: str, category: Optional[str], username: str, password: str):
+        """Caches a decrypted entry, evicting the least recently used ones above max_entries."""
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        key = (service, category or None)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = _CachedEntry(username, bytearray(password.encode()), self.clock() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, service: Optional[str] = None, category: str = None):
+        """Drops one entry, or every entry when service is None."""
+        if service is None:
+            self.clear()
+            return
+        with self._lock:
+            self._discard((service, category or None))
+
+    def purge_expired(self) -> int:
+        """Wipes entries whose TTL has passed and returns how many were dropped."""
+        now = self.clock()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry.expires <= now]
+            for key in expired:
+                self._discard(key)
+        return len(expired)
+
+    def clear(self):
+        """Wipes and drops all entries."""
+        with self._lock:
+            for entry in self._entries.values():
+                entry.wipe()
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit, miss and eviction counters and the current size."""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._entries)}
+
+    def _discard(self, key: CacheKey):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.wipe()
@@ -0,0 +1,960 @@
+"""Неинтерактивный интерфейс командной строки менеджера паролей.
+
+Команды не загружают rich, questionary и pyperclip, не показывают баннер и
+анимацию и подходят для скриптов:
+
+    python manager.py get github -c work --out-fd 3
+    python manager.py list
+"""
+import argparse
+import getpass
+import os
+import sys
+from contextlib import nullcontext
+from typing import Callable, List, Optional
+
+from config import (GENERATED_PASSWORD_LENGTH, EXPORT_FILE, IMPORT_CHUNK_SIZE, IMPORT_WORKERS, AGENT_IDLE_TIMEOUT,
+                    SEARCH_LIMIT, PROFILE_DIR, ARGON2_TARGET_SECONDS, ARGON2_MAX_MEMORY_KIB, PASSPHRASE_WORDS,
+                    PASSPHRASE_SYLLABLES, PASSPHRASE_SEPARATOR, WEAK_PASSWORD_BITS, AUDIT_WORKERS, DEFAULT_VAULT,
+                    API_HOST, API_PORT, API_RATE, API_BURST, API_IDLE_TIMEOUT, SNAPSHOT_KEY_ENV, KEYFILE_ENV)
+from metrics import registry, render_prometheus, summarize
+from auditlog import journal, OK, DENIED, FAILED
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_AUTH_FAILED = 2
+
+# Journal outcome of each exit code
+OUTCOMES = {EXIT_OK: OK, EXIT_ERROR: FAILED, EXIT_AUTH_FAILED: DENIED}
+
+
+def read_secret_line(args: argparse.Namespace, prompt: str) -> str:
+    """Читает строку со стандартного ввода (--password-stdin) или запрашивает ее без эха."""
+    if args.password_stdin:
+        line = sys.stdin.readline()
+        if not line:
+            raise ValueError("Стандартный ввод закрыт")
+        return line.rstrip("\n")
+    return getpass.getpass(prompt)
+
+
+def write_output(args: argparse.Namespace, text: str):
+    """Пишет результат в stdout или в файловый дескриптор, указанный в --out-fd."""
+    data = (text + "\n").encode()
+    fd = args.out_fd if args.out_fd is not None else sys.stdout.fileno()
+    sys.stdout.flush()
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def unlock(manager, args: argparse.Namespace) -> Optional[bytes]:
+    """Запрашивает мастер-пароль и возвращает ключ шифрования или None при ошибке.
+
+    С --keyring ключ хранилища берется из разблокированной связки ключей.
+    """
+    if args.keyring:
+        keyring = unlock_keyring(manager, args)
+        if keyring is None:
+            return None
+        key = keyring.key_for(manager.vault)
+        if key is None:
+            print(f"Ключа хранилища '{manager.vault.name}' нет в связке или он устарел", file=sys.stderr)
+        return key
+    master_password = read_secret_line(args, "Мастер-пароль: ")
+    if not master_password.strip():
+        print("Мастер-пароль не может быть пустым", file=sys.stderr)
+        return None
+    keys = manager.unlock(master_password, manager.crypto.get_salt())
+    if keys is None:
+        print("Неверный мастер-пароль", file=sys.stderr)
+        return None
+    return keys.enc_key
+
+
+def unlock_keyring(manager, args: argparse.Namespace):
+    """Запрашивает пароль связки ключей и возвращает разблокированную связку или None."""
+    from vaults import Keyring
+    keyring = Keyring(params=manager.argon2_params())
+    password = read_secret_line(args, "Пароль связки ключей: ")
+    if not password.strip():
+        print("Пароль связки ключей не может быть пустым", file=sys.stderr)
+        return None
+    if not keyring.unlock(password):
+        print("Неверный пароль связки ключей", file=sys.stderr)
+        return None
+    return keyring
+
+
+def format_entry(field: str, username: str, password: Optional[str]) -> str:
+    if field == "username":
+        return username
+    return password if field == "password" else f"{username}\t{password}"
+
+
+def cmd_get(manager, args: argparse.Namespace) -> int:
+    if args.all_vaults:
+        return get_all_vaults(manager, args)
+    if args.field != "username" and not args.no_agent:
+        from agent import AgentClient
+        client = AgentClient.available(args.socket)
+        if client is not None:
+            try:
+                entry = client.request("get", service=args.service, category=args.category)
+            finally:
+                client.close()
+            password = entry["password"]
+            write_output(args, password if args.field == "password" else f"{entry['username']}\t{password}")
+            return EXIT_OK
+
+    entry = manager.db.get_password(args.service, args.category)
+    if entry is None:
+        print(f"Запись '{args.service}' не найдена", file=sys.stderr)
+        return EXIT_ERROR
+    if args.field == "username":
+        write_output(args, entry["username"])
+        return EXIT_OK
+    key = unlock(manager, args)
+    if key is None:
+        return EXIT_AUTH_FAILED
+    # Read again: unlocking may have re-encrypted the vault with new Argon2 parameters
+    entry = manager.get_entry(args.service, args.category, key)
+    if entry is None:
+        print(f"Запись '{args.service}' не найдена", file=sys.stderr)
+        return EXIT_ERROR
+    username, password = entry
+    write_output(args, password if args.field == "password" else f"{username}\t{password}")
+    return EXIT_OK
+
+
+def get_all_vaults(manager, args: argparse.Namespace) -> int:
+    """Выводит запись из всех хранилищ, где она есть, строками 'хранилище<TAB>значение'.
+
+    Пароли расшифровываются ключами из связки: одна разблокировка на все хранилища.
+    """
+    from vaults import VaultSet, list_vaults
+    vault_set = VaultSet(list_vaults())
+    try:
+        found = vault_set.get_password(args.service, args.category)
+    finally:
+        vault_set.close()
+    if not found:
+        print(f"Запись '{args.service}' не найдена ни в одном хранилище", file=sys.stderr)
+        return EXIT_ERROR
+    keys = {}
+    if args.field != "username":
+        keyring = unlock_keyring(manager, args)
+        if keyring is None:
+            return EXIT_AUTH_FAILED
+        keys = keyring.keys([vault for vault, _ in found])
+    lines = []
+    for vault, entry in found:
+        password = None
+        if args.field != "username":
+            if vault.name not in keys:
+                print(f"Ключа хранилища '{vault.name}' нет в связке или он устарел", file=sys.stderr)
+                continue
+            password = manager.crypto.decrypt_password(entry["encrypted_password"], keys[vault.name])
+        lines.append(f"{vault.name}\t{format_entry(args.field, entry['username'], password)}")
+    if lines:
+        write_output(args, "\n".join(lines))
+    return EXIT_OK if len(lines) == len(found) else EXIT_ERROR
+
+
+def cmd_add(manager, args: argparse.Namespace) -> int:
+    key = unlock(manager, args)
+    if key is None:
+        return EXIT_AUTH_FAILED
+    if args.generate:
+        password = manager.generate_password(args.length, show_strength=False)
+    else:
+        password = read_secret_line(args, "Пароль: ")
+    if not manager.db.add_password(args.service, args.username, manager.crypto.encrypt_password(password, key),
+                                   args.category, manager.crypto.fingerprint(password, key)):
+        print(f"Сервис '{args.service}' уже существует в категории", file=sys.stderr)
+        return EXIT_ERROR
+    if args.generate:
+        write_output(args, password)
+    return EXIT_OK
+
+
+def cmd_list(manager, args: argparse.Namespace) -> int:
+    lines = [f"{service}\t{username}\t{category or ''}"
+             for service, username, category in manager.db.get_entries(args.category)]
+    if lines:
+        write_output(args, "\n".join(lines))
+    return EXIT_OK
+
+
+def cmd_search(manager, args: argparse.Namespace) -> int:
+    if args.all_vaults:
+        from vaults import VaultSet, list_vaults
+        vault_set = VaultSet(list_vaults())
+        try:
+            results = vault_set.search(args.text, args.category, args.limit)
+        finally:
+            vault_set.close()
+        if results:
+            write_output(args, "\n".join("\t".join(field or "" for field in row) for row in results))
+        return EXIT_OK
+    results = manager.search.search(args.text, args.category, args.limit)
+    if results:
+        write_output(args, "\n".join(f"{service}\t{username}\t{category or ''}"
+                                      for service, username, category in results))
+    return EXIT_OK
+
+
+def cmd_export(manager, args: argparse.Namespace) -> int:
+    print(manager.db.export_data(args.file), file=sys.stderr)
+    return EXIT_OK
+
+
+def cmd_import(manager, args: argparse.Namespace) -> int:
+    imported = manager.db.import_data(args.file, chunk_size=args.chunk_size)
+    print(f"Импортировано записей: {imported}", file=sys.stderr)
+    return EXIT_OK
+
+
+def cmd_import_from(manager, args: argparse.Namespace) -> int:
+    from importers import Importer
+    key = None
+    if not args.dry_run:
+        key = unlock(manager, args)
+        if key is None:
+            return EXIT_AUTH_FAILED
+    importer = Importer(manager.db, manager.crypto, key, workers=args.workers, chunk_size=args.chunk_size)
+    report = importer.import_file(args.file, args.format, args.on_conflict, args.dry_run)
+    prefix = "Будет импортировано" if args.dry_run else "Импортировано"
+    print(f"Прочитано: {report.read}, некорректных: {report.invalid}", file=sys.stderr)
+    print(f"{prefix}: новых {report.inserted}, конфликтов {report.conflicts} "
+          f"(перезаписано {report.overwritten}, переименовано {report.renamed}, пропущено {report.skipped})",
+          file=sys.stderr)
+    return EXIT_OK
+
+
+def policy_from_args(args: argparse.Namespace):
+    """Собирает политику генерации из параметров командной строки."""
+    from generator import Policy
+    classes = args.classes.split(",")
+    return Policy(args.length, classes, min_counts=dict.fromkeys(classes, args.min_each), exclude=args.exclude,
+                  exclude_look_alikes=args.no_look_alikes, passphrase=args.passphrase, words=args.words,
+                  syllables=args.syllables, separator=args.separator)
+
+
+def cmd_gen(manager, args: argparse.Namespace) -> int:
+    from generator import PasswordGenerator
+    policy = policy_from_args(args)
+    print(f"Энтропия: {policy.entropy_bits():.1f} бит", file=sys.stderr)
+    if args.service is None:
+        write_output(args, "\n".join(PasswordGenerator(policy).generate_many(args.count)))
+        return EXIT_OK
+
+    template = args.service if "{n}" in args.service else args.service + "-{n}"
+    services = [template.format(n=n) for n in range(args.start, args.start + args.count)]
+    key = unlock(manager, args)
+    if key is None:
+        return EXIT_AUTH_FAILED
+    created = manager.generate_entries(services, args.username, args.category, key, policy)
+    if created is None:
+        print("Некоторые сервисы уже существуют в категории; записи не созданы", file=sys.stderr)
+        return EXIT_ERROR
+    write_output(args, "\n".join(f"{service}\t{password}" for service, password in created))
+    return EXIT_OK
+
+
+def cmd_agent(manager, args: argparse.Namespace) -> int:
+    from agent import Agent, AgentClient
+    if args.action == "start":
+        key = unlock(manager, args)
+        if key is None:
+            return EXIT_AUTH_FAILED
+        agent = Agent(manager, args.socket, args.idle_timeout)
+        agent.set_key(key)
+        print(f"Агент запущен: {agent.socket_path}", file=sys.stderr)
+        agent.run()
+        return EXIT_OK
+    try:
+        client = AgentClient(args.socket)
+    except OSError:
+        print("Агент не запущен", file=sys.stderr)
+        return EXIT_ERROR
+    try:
+        response = client.request(args.action)
+    finally:
+        client.close()
+    if args.action == "status":
+        cache = response.get("cache", {})
+        write_output(args, "locked" if response["locked"] else "unlocked")
+        if cache:
+            print(f"Кэш: попаданий {cache['hits']}, промахов {cache['misses']}, "
+                  f"вытеснено {cache['evictions']}, записей {cache['size']}", file=sys.stderr)
+    return EXIT_OK
+
+
+def cmd_api(manager, args: argparse.Namespace) -> int:
+    from httpapi import SecretsServer, TokenStore
+    tokens = TokenStore()
+    vault_name = manager.vault.name if manager.vault is not None else DEFAULT_VAULT
+    if args.action == "serve":
+        key = unlock(manager, args)
+        if key is None:
+            return EXIT_AUTH_FAILED
+        from aio import AsyncVault
+        server = SecretsServer(AsyncVault(manager.db, manager.crypto, key), vault_name, tokens, args.host,
+                               args.port, args.unix, args.idle_timeout)
+        print(f"API запущен: {server.address}", file=sys.stderr)
+        server.run()
+        return EXIT_OK
+    if args.action == "tokens":
+        lines = [f"{entry['name']}\t{','.join(entry['categories']) if entry['categories'] is not None else '*'}\t"
+                 f"{entry['rate']:g}/с\t{entry['burst']}" for entry in tokens.list(vault_name)]
+        if lines:
+            write_output(args, "\n".join(lines))
+        return EXIT_OK
+    if args.name is None:
+        print("Укажите имя токена", file=sys.stderr)
+        return EXIT_ERROR
+    if args.action == "add-token":
+        try:
+            token = tokens.create(vault_name, args.name, args.category, args.rate, args.burst)
+        except ValueError:
+            print(f"Токен '{args.name}' уже существует", file=sys.stderr)
+            return EXIT_ERROR
+        print("Токен показывается один раз; сохраните его", file=sys.stderr)
+        write_output(args, token)
+        return EXIT_OK
+    if not tokens.revoke(vault_name, args.name):
+        print(f"Токен '{args.name}' не найден", file=sys.stderr)
+        return EXIT_ERROR
+    return EXIT_OK
+
+
+def cmd_compile(manager, args: argparse.Namespace) -> int:
+    from snapshot import compile_snapshot, encode_key
+    key = unlock(manager, args)
+    if key is None:
+        return EXIT_AUTH_FAILED
+    rows = []
+    for category in args.category or [None]:
+        rows.extend(manager.db.get_encrypted_entries(category))
+    passwords = manager.crypto.decrypt_many((row[3] for row in rows), key)
+    snapshot_key = compile_snapshot(args.output, ((service, category, username, password) for
+                                                  (service, username, category, _), password in zip(rows, passwords)))
+    print(f"Снимок {args.output}: записей {len(rows)}. Ключ снимка показывается один раз; "
+          f"передайте его в {SNAPSHOT_KEY_ENV}", file=sys.stderr)
+    write_output(args, encode_key(snapshot_key))
+    return EXIT_OK
+
+
+def cmd_snapshot_get(manager, args: argparse.Namespace) -> int:
+    """Читает запись из снимка без базы данных и Argon2; manager не используется."""
+    from snapshot import Snapshot, decode_key
+    text = read_secret_line(args, "Ключ снимка: ") if args.password_stdin else os.environ.get(SNAPSHOT_KEY_ENV)
+    if not text:
+        print(f"Ключ снимка не задан: укажите {SNAPSHOT_KEY_ENV} или --password-stdin", file=sys.stderr)
+        return EXIT_AUTH_FAILED
+    with Snapshot(args.file, decode_key(text)) as snapshot:
+        entry = snapshot.get(args.service, args.category)
+    if entry is None:
+        print(f"Запись '{args.service}' не найдена", file=sys.stderr)
+        return EXIT_ERROR
+    write_output(args, format_entry(args.field, *entry))
+    return EXIT_OK
+
+
+def cmd_vault(manager, args: argparse.Namespace) -> int:
+    from db import Database
+    from vaults import Keyring, list_vaults, requires_keyfile
+    keyring = Keyring(params=manager.argon2_params())
+    vault = manager.vault
+    if args.action == "list":
+        enrolled = set(keyring.names())
+        lines = []
+        for item in list_vaults():
+            if item.name == vault.name:
+                count = manager.db.count_entries()
+            else:
+                db = Database(item.db_path)
+                try:
+                    count = db.count_entries() if os.path.exists(item.db_path) else 0
+                finally:
+                    db.close()
+            state = ""
+            if item.name in enrolled:
+                state = "устарел" if keyring.is_stale(item) or requires_keyfile(item) else "в связке"
+            lines.append(f"{item.name}\t{count}\t{state}")
+        if lines:
+            write_output(args, "\n".join(lines))
+        return EXIT_OK
+    if args.action == "create":
+        if manager.crypto.read_master_hash() is not None:
+            print(f"Хранилище '{vault.name}' уже существует", file=sys.stderr)
+            return EXIT_ERROR
+        if unlock(manager, args) is None:
+            return EXIT_AUTH_FAILED
+        print(f"Хранилище '{vault.name}' создано", file=sys.stderr)
+        return EXIT_OK
+    if args.action == "enroll":
+        if manager.crypto.read_master_hash() is None:
+            print(f"Хранилище '{vault.name}' еще не создано", file=sys.stderr)
+            return EXIT_ERROR
+        if requires_keyfile(vault):
+            print(f"Хранилище '{vault.name}' требует файл-ключ и не может быть добавлено в связку",
+                  file=sys.stderr)
+            return EXIT_ERROR
+        if not keyring.exists():
+            print("Связка ключей будет создана с этим паролем", file=sys.stderr)
+        unlocked = unlock_keyring(manager, args)
+        if unlocked is None:
+            return EXIT_AUTH_FAILED
+        args.keyring = False
+        key = unlock(manager, args)
+        if key is None:
+            return EXIT_AUTH_FAILED
+        unlocked.add(vault, key)
+        print(f"Ключ хранилища '{vault.name}' добавлен в связку", file=sys.stderr)
+        return EXIT_OK
+    if not keyring.remove(vault.name):
+        print(f"Хранилища '{vault.name}' нет в связке", file=sys.stderr)
+        return EXIT_ERROR
+    return EXIT_OK
+
+
+def cmd_keyfile(manager, args: argparse.Namespace) -> int:
+    """Файл-ключ как второй фактор: status показывает требование и найденные ключи, create и remove меняют его."""
+    from usb_key_check import find_usb_mounts, find_keyfiles, create_keyfile, read_keyfile
+    crypto = manager.crypto
+    key_id = crypto.required_keyfile()
+    if args.action == "status":
+        lines = [f"требуется\t{key_id}" if key_id else "не требуется"]
+        lines.extend(f"usb\t{mount}" for mount in find_usb_mounts())
+        for path in find_keyfiles():
+            try:
+                matches = crypto.keyfile_id(crypto.keyfile_secret(read_keyfile(path))) == key_id
+            except RuntimeError:
+                lines.append(f"ключ\t{path}\tне читается")
+                continue
+            lines.append(f"ключ\t{path}" + ("\tподходит" if matches else ""))
+        write_output(args, "\n".join(lines))
+        return EXIT_OK
+    if crypto.read_master_hash() is None:
+        print("Хранилище еще не создано", file=sys.stderr)
+        return EXIT_ERROR
+    directory = args.directory
+    if args.action == "create" and directory is None:
+        mounts = find_usb_mounts()
+        if len(mounts) != 1:
+            print("Укажите каталог: " + ("USB-накопитель не найден" if not mounts else
+                                         "найдено несколько USB-накопителей"), file=sys.stderr)
+            return EXIT_ERROR
+        directory = mounts[0]
+    if args.action == "remove" and key_id is None:
+        print("Хранилище не требует файла-ключа", file=sys.stderr)
+        return EXIT_ERROR
+    master_password = read_secret_line(args, "Мастер-пароль: ")
+    if not master_password.strip():
+        print("Мастер-пароль не может быть пустым", file=sys.stderr)
+        return EXIT_AUTH_FAILED
+    salt = crypto.get_salt()
+    keys = manager.unlock(master_password, salt)
+    if keys is None:
+        print("Неверный мастер-пароль", file=sys.stderr)
+        return EXIT_AUTH_FAILED
+    if args.action == "remove":
+        manager.set_keyfile(master_password, salt, keys, None)
+        print("Файл-ключ больше не требуется", file=sys.stderr)
+        return EXIT_OK
+    path = create_keyfile(directory)
+    manager.set_keyfile(master_password, salt, keys, read_keyfile(path))
+    print(f"Файл-ключ записан в {path}; без него хранилище не открыть, сохраните его копию", file=sys.stderr)
+    return EXIT_OK
+
+
+def cmd_backup(manager, args: argparse.Namespace) -> int:
+    """Резервные копии: create создает копию, list показывает их, verify проверяет, restore восстанавливает."""
+    from backup import BackupManager
+    db = manager.db
+    backups = BackupManager(db.db_path, db.backup_dir, key_files=db.key_files)
+    if args.action == "create":
+        write_output(args, db.backup_db(args.kind))
+        return EXIT_OK
+    if args.action == "list":
+        lines = [f"{m['name']}\t{m['kind']}\t{m['base'] or ''}\t{m['created']}" for m in backups.list_backups()]
+        if lines:
+            write_output(args, "\n".join(lines))
+        return EXIT_OK
+    if args.name is None:
+        print("Укажите имя резервной копии (см. backup list)", file=sys.stderr)
+        return EXIT_ERROR
+    if not os.path.exists(os.path.join(backups.backup_dir, f"{args.name}.json")):
+        print(f"Резервная копия '{args.name}' не найдена", file=sys.stderr)
+        return EXIT_ERROR
+    if args.action == "verify":
+        if not backups.verify(args.name):
+            print(f"Резервная копия '{args.name}' повреждена или неполна", file=sys.stderr)
+            return EXIT_ERROR
+        print(f"Резервная копия '{args.name}' в порядке", file=sys.stderr)
+        return EXIT_OK
+    from agent import AgentClient
+    try:
+        AgentClient(args.socket).close()
+    except OSError:
+        pass
+    else:
+        print("Агент запущен: остановите его перед восстановлением (agent stop)", file=sys.stderr)
+        return EXIT_ERROR
+    # Connections must not outlive the file they were opened on
+    db.close()
+    previous = backups.restore(args.name, with_keys=args.with_keys)
+    print(f"База данных восстановлена из '{args.name}'; прежняя сохранена как '{previous}'", file=sys.stderr)
+    return EXIT_OK
+
+
+def cmd_sync(manager, args: argparse.Namespace) -> int:
+    from sync import DirectoryRemote, Replica, Synchronizer, newest
+    from vaults import get_vault
+    vault = manager.vault or get_vault()
+    if not os.path.exists(vault.master_hash_file):
+        print(f"Хранилище '{vault.name}' еще не создано", file=sys.stderr)
+        return EXIT_ERROR
+    remote = DirectoryRemote(args.directory)
+    created = not remote.exists()
+    if args.rekey:
+        if created or args.dry_run:
+            print("--rekey нужна существующая копия и запуск без --dry-run", file=sys.stderr)
+            return EXIT_ERROR
+        key = unlock(manager, args)
+        if key is None:
+            return EXIT_AUTH_FAILED
+        remote_password = read_secret_line(args, "Мастер-пароль, с которым копия синхронизировалась последний раз: ")
+        if not remote.rekey(manager.db, vault.salt_file, vault.master_hash_file, manager.crypto, key, remote_password):
+            print("Неверный мастер-пароль копии", file=sys.stderr)
+            return EXIT_AUTH_FAILED
+        print(f"Копия в {args.directory} перешифрована ключом хранилища", file=sys.stderr)
+    remote_db = remote.open(manager.db, vault.salt_file, vault.master_hash_file)
+    try:
+        resolve = ask_conflict if args.conflicts == "ask" and not args.dry_run else newest
+        report = Synchronizer(Replica(manager.db), Replica(remote_db), resolve).run(args.dry_run)
+    finally:
+        remote_db.close()
+    if created:
+        print(f"Создана копия хранилища в {args.directory}", file=sys.stderr)
+    prefix = "будет получено" if args.dry_run else "получено"
+    print(f"Корзин с отличиями: {report.buckets}, сравнено записей: {report.compared}; "
+          f"{prefix} {report.pulled}, отправлено {report.pushed}, конфликтов {report.conflicts} "
+          f"({report.seconds * 1000:.0f} мс)", file=sys.stderr)
+    return EXIT_OK
+
+
+def ask_conflict(local, remote) -> str:
+    """Спрашивает, какую версию записи, измененной в обеих копиях, оставить."""
+    import datetime
+    from sync import LOCAL, REMOTE
+
+    def describe(state) -> str:
+        when = datetime.datetime.fromtimestamp(state.updated_at).strftime("%Y-%m-%d %H:%M:%S")
+        return f"удалена {when}" if state.deleted else f"изменена {when}, пользователь {state.username}"
+
+    category = f" [{local.category}]" if local.category else ""
+    print(f"Конфликт: {local.service}{category}\n  здесь: {describe(local)}\n  в копии: {describe(remote)}",
+          file=sys.stderr)
+    while True:
+        print("Оставить локальную (l) или удаленную (r) версию? ", end="", file=sys.stderr, flush=True)
+        answer = sys.stdin.readline()
+        if not answer:
+            raise ValueError("Стандартный ввод закрыт")
+        if answer.strip().lower() in ("l", "r"):
+            return LOCAL if answer.strip().lower() == "l" else REMOTE
+
+
+def cmd_stats(manager, args: argparse.Namespace) -> int:
+    if args.reset:
+        registry.reset()
+        return EXIT_OK
+    histograms = registry.load()
+    if args.prometheus:
+        write_output(args, render_prometheus(histograms).rstrip("\n"))
+        return EXIT_OK
+    lines = [f"{'фаза':<8}{'операция':<28}{'вызовов':>8}{'среднее':>12}{'p50':>12}{'p95':>12}{'макс':>12}"]
+    for phase, operation, count, mean, p50, p95, maximum in summarize(histograms):
+        lines.append(f"{phase:<8}{operation:<28}{count:>8}" +
+                     "".join(f"{value * 1000:>10.2f}мс" for value in (mean, p50, p95, maximum)))
+    write_output(args, "\n".join(lines))
+    return EXIT_OK
+
+
+def cmd_audit(manager, args: argparse.Namespace) -> int:
+    from audit import Auditor
+    auditor = Auditor(manager.db, manager.crypto, None, workers=args.workers)
+    if auditor.needs_key(args.strength):
+        auditor.key = unlock(manager, args)
+        if auditor.key is None:
+            return EXIT_AUTH_FAILED
+    report = auditor.run(args.category, args.strength, args.threshold)
+    write_output(args, "\n".join(format_audit(report, args.threshold)))
+    return EXIT_OK
+
+
+def format_audit(report, threshold: float) -> List[str]:
+    """Строки отчета аудита: группы повторяющихся паролей и слабые пароли."""
+    lines = [f"Записей: {report.total}",
+             f"Повторно используемые пароли: групп {len(report.reused)}, записей {report.reused_entries}"]
+    for group in report.reused:
+        lines.append("  " + ", ".join(f"{service} ({username})" + (f" [{category}]" if category else "")
+                                      for service, username, category in group))
+    if report.weak is not None:
+        lines.append(f"Слабые пароли (менее {threshold:.0f} бит): {len(report.weak)}")
+        lines.extend(f"  {service}\t{username}\t{category or ''}\t{bits:.0f} бит"
+                     for service, username, category, bits in report.weak)
+    return lines
+
+
+def cmd_history(manager, args: argparse.Namespace) -> int:
+    if manager.db.get_password(args.service, args.category) is None:
+        print(f"Запись '{args.service}' не найдена", file=sys.stderr)
+        return EXIT_ERROR
+    if args.restore is not None:
+        if not manager.db.restore_version(args.service, args.restore, args.category):
+            print(f"Версия {args.restore} не найдена", file=sys.stderr)
+            return EXIT_ERROR
+        print(f"Версия {args.restore} восстановлена", file=sys.stderr)
+        return EXIT_OK
+    versions = manager.db.get_history(args.service, args.category)
+    if args.show is None:
+        if versions:
+            import datetime
+            write_output(args, "\n".join(f"{version_id}\t{datetime.datetime.fromtimestamp(changed_at):%Y-%m-%d %H:%M:%S}"
+                                          for version_id, changed_at in versions))
+        return EXIT_OK
+    if args.show not in (version_id for version_id, _ in versions):
+        print(f"Версия {args.show} не найдена", file=sys.stderr)
+        return EXIT_ERROR
+    key = unlock(manager, args)
+    if key is None:
+        return EXIT_AUTH_FAILED
+    # Read after unlocking: it may have re-encrypted the vault with new Argon2 parameters
+    version = manager.db.get_history_version(args.show)
+    write_output(args, manager.crypto.decrypt_password(version["encrypted_password"], key))
+    return EXIT_OK
+
+
+def cmd_calibrate(manager, args: argparse.Namespace) -> int:
+    params = manager.calibrate(args.target_ms / 1000, args.max_memory_mib * 1024, save=not args.dry_run)
+    from crypto import Crypto
+    elapsed = measure_derive(Crypto(params=params))
+    write_output(args, f"time_cost={params['time_cost']} memory_cost={params['memory_cost']} "
+                       f"parallelism={params['parallelism']} ({elapsed * 1000:.0f} мс)")
+    if args.dry_run:
+        return EXIT_OK
+    crypto = manager.crypto
+    if not crypto.needs_rehash(allow_weaker=True) or crypto.needs_rehash():
+        print("Параметры сохранены; хранилище будет перехешировано при следующей разблокировке", file=sys.stderr)
+        return EXIT_OK
+    # Weaker parameters are never applied by a later unlock, only here, where the user asked for them
+    print("Новые параметры слабее текущих; введите мастер-пароль, чтобы перехешировать хранилище сейчас",
+          file=sys.stderr)
+    master_password = read_secret_line(args, "Мастер-пароль: ")
+    if manager.unlock(master_password, crypto.get_salt(), allow_weaker=True) is None:
+        print("Неверный мастер-пароль; хранилище сохраняет прежние параметры", file=sys.stderr)
+        return EXIT_AUTH_FAILED
+    print("Хранилище перехешировано", file=sys.stderr)
+    return EXIT_OK
+
+
+def cmd_config(manager, args: argparse.Namespace) -> int:
+    """Выводит действующие настройки и их источник; manager не используется."""
+    from config import CONFIG_FILE, settings
+    rows = settings.diagnostics()
+    if args.json:
+        import json
+        write_output(args, json.dumps({"file": CONFIG_FILE, "errors": settings.errors,
+                                       "settings": {key: {"value": value, "source": source, "hot": hot}
+                                                    for key, value, source, hot in rows}},
+                                      ensure_ascii=False, indent=2))
+    else:
+        lines = [f"# {CONFIG_FILE}"]
+        lines.extend(f"{key}\t{value}\t{source}" + ("\t*" if hot else "") for key, value, source, hot in rows)
+        write_output(args, "\n".join(lines))
+        for error in settings.errors:
+            print(f"Ошибка настройки: {error}", file=sys.stderr)
+    return EXIT_ERROR if settings.errors else EXIT_OK
+
+
+def cmd_journal(manager, args: argparse.Namespace) -> int:
+    """Выводит последние записи журнала операций или проверяет его цепочку HMAC; manager не используется."""
+    from auditlog import journal_files, load_key, verify
+    if args.verify:
+        if not journal.key_file:
+            print("Цепочка HMAC не включена: задайте journal.hmac_key_file", file=sys.stderr)
+            return EXIT_ERROR
+        checked, genesis, error = verify(journal.path, load_key(journal.key_file))
+        if error is not None:
+            print(f"Журнал изменен: {error}; до этого проверено записей: {checked}", file=sys.stderr)
+            return EXIT_ERROR
+        print(f"Проверено записей: {checked}" + ("" if genesis else "; начало цепочки удалено ротацией"),
+              file=sys.stderr)
+        return EXIT_OK
+    from collections import deque
+    lines = deque(maxlen=args.lines)
+    for path in journal_files(journal.path):
+        with open(path, "r") as f:
+            lines.extend(line.rstrip("\n") for line in f)
+    if lines:
+        write_output(args, "\n".join(lines))
+    return EXIT_OK
+
+
+def measure_derive(crypto) -> float:
+    """Возвращает время одного вывода ключей с параметрами crypto."""
+    import time
+    start = time.perf_counter()
+    crypto.derive_keys("calibration", os.urandom(16))
+    return time.perf_counter() - start
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="passman", description="Менеджер паролей: неинтерактивные команды")
+    parser.add_argument("--password-stdin", action="store_true",
+                        help="читать мастер-пароль (и пароль для add) построчно со стандартного ввода")
+    parser.add_argument("--out-fd", type=int, default=None, help="файловый дескриптор для вывода секретов")
+    parser.add_argument("--socket", default=None, help="путь к сокету агента")
+    parser.add_argument("--vault", default=None, help=f"имя хранилища (по умолчанию {DEFAULT_VAULT})")
+    parser.add_argument("--keyring", action="store_true",
+                        help="разблокировать хранилище паролем связки ключей вместо его мастер-пароля")
+    parser.add_argument("--keyfile", default=None,
+                        help=f"файл-ключ хранилища (также {KEYFILE_ENV}); без него ключ ищется на USB-накопителях")
+    parser.add_argument("--profile", action="store_true",
+                        help="записать профиль cProfile выполнения команды в ~/.passman_profiles")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    get = subparsers.add_parser("get", help="вывести пароль сервиса")
+    get.add_argument("service")
+    get.add_argument("-c", "--category")
+    get.add_argument("--field", choices=["password", "username", "all"], default="password")
+    get.add_argument("--no-agent", action="store_true", help="не обращаться к запущенному агенту")
+    get.add_argument("--all-vaults", action="store_true",
+                     help="искать запись во всех хранилищах; пароли расшифровываются ключами из связки")
+    get.set_defaults(handler=cmd_get)
+
+    add = subparsers.add_parser("add", help="добавить запись")
+    add.add_argument("service")
+    add.add_argument("username")
+    add.add_argument("-c", "--category")
+    add.add_argument("--generate", action="store_true", help="сгенерировать пароль и вывести его")
+    add.add_argument("--length", type=int, default=GENERATED_PASSWORD_LENGTH)
+    add.set_defaults(handler=cmd_add)
+
+    list_parser = subparsers.add_parser("list", help="вывести сервисы, имена пользователей и категории")
+    list_parser.add_argument("-c", "--category")
+    list_parser.set_defaults(handler=cmd_list)
+
+    search = subparsers.add_parser("search", help="найти записи по сервису, имени пользователя или категории")
+    search.add_argument("text")
+    search.add_argument("-c", "--category")
+    search.add_argument("--limit", type=int, default=SEARCH_LIMIT)
+    search.add_argument("--all-vaults", action="store_true", help="искать во всех хранилищах параллельно")
+    search.set_defaults(handler=cmd_search)
+
+    export = subparsers.add_parser("export", help="экспортировать записи в NDJSON")
+    export.add_argument("file", nargs="?", default=EXPORT_FILE)
+    export.set_defaults(handler=cmd_export)
+
+    import_parser = subparsers.add_parser("import", help="импортировать записи из NDJSON или JSON")
+    import_parser.add_argument("file", nargs="?", default=EXPORT_FILE)
+    import_parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    import_parser.set_defaults(handler=cmd_import)
+
+    import_from = subparsers.add_parser("import-from",
+                                        help="импортировать открытые пароли из CSV браузера или XML KeePass")
+    import_from.add_argument("format", choices=["csv", "keepass"])
+    import_from.add_argument("file")
+    import_from.add_argument("--on-conflict", choices=["skip", "overwrite", "rename"], default="skip",
+                             help="что делать с уже существующим сервисом в категории")
+    import_from.add_argument("--dry-run", action="store_true",
+                             help="только посчитать новые, конфликтующие и некорректные записи")
+    import_from.add_argument("--workers", type=int, default=IMPORT_WORKERS, help="потоков шифрования")
+    import_from.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    import_from.set_defaults(handler=cmd_import_from)
+
+    gen = subparsers.add_parser("gen", help="сгенерировать пароли; с --service сохранить их как записи")
+    gen.add_argument("--length", type=int, default=GENERATED_PASSWORD_LENGTH)
+    gen.add_argument("--count", type=int, default=1)
+    gen.add_argument("--classes", default="lower,upper,digits,symbols",
+                     help="классы символов через запятую: lower, upper, digits, symbols")
+    gen.add_argument("--min-each", type=int, default=1, help="минимум символов каждого класса")
+    gen.add_argument("--exclude", default="", help="символы, которые не использовать")
+    gen.add_argument("--no-look-alikes", action="store_true", help="не использовать похожие символы (1, l, I, 0, O...)")
+    gen.add_argument("--passphrase", action="store_true", help="парольная фраза из слогов вместо символов")
+    gen.add_argument("--words", type=int, default=PASSPHRASE_WORDS)
+    gen.add_argument("--syllables", type=int, default=PASSPHRASE_SYLLABLES, help="слогов в слове")
+    gen.add_argument("--separator", default=PASSPHRASE_SEPARATOR)
+    gen.add_argument("--service", help="шаблон имени сервиса, например 'host-{n}'; записи сохраняются одной транзакцией")
+    gen.add_argument("--start", type=int, default=1, help="первый номер {n}")
+    gen.add_argument("--username", default="")
+    gen.add_argument("-c", "--category")
+    gen.set_defaults(handler=cmd_gen)
+
+    agent = subparsers.add_parser("agent", help="агент, хранящий ключ в памяти (как ssh-agent)")
+    agent.add_argument("action", choices=["start", "stop", "lock", "status"])
+    agent.add_argument("--idle-timeout", type=float, default=AGENT_IDLE_TIMEOUT)
+    agent.set_defaults(handler=cmd_agent)
+
+    api = subparsers.add_parser("api", help="локальный HTTP API секретов для CI с токенами доступа")
+    api.add_argument("action", choices=["serve", "add-token", "tokens", "revoke-token"],
+                     help="serve: запустить API; add-token/revoke-token: выдать или отозвать токен; tokens: список")
+    api.add_argument("name", nargs="?", help="имя токена")
+    api.add_argument("-c", "--category", action="append",
+                     help="категория, доступная токену (можно повторять; без категории: '')")
+    api.add_argument("--rate", type=float, default=API_RATE, help="запросов в секунду на токен")
+    api.add_argument("--burst", type=int, default=API_BURST, help="запросов подряд сверх среднего")
+    api.add_argument("--host", default=API_HOST, help="адрес loopback-интерфейса")
+    api.add_argument("--port", type=int, default=API_PORT)
+    api.add_argument("--unix", default=None, metavar="PATH", help="слушать Unix-сокет вместо TCP")
+    api.add_argument("--idle-timeout", type=float, default=API_IDLE_TIMEOUT,
+                     help="секунд бездействия до закрытия соединения")
+    api.set_defaults(handler=cmd_api)
+
+    compile_parser = subparsers.add_parser("compile",
+                                           help="записать зашифрованный снимок только для чтения и вывести его ключ")
+    compile_parser.add_argument("output")
+    compile_parser.add_argument("-c", "--category", action="append",
+                                help="включить в снимок только эту категорию (можно повторять)")
+    compile_parser.set_defaults(handler=cmd_compile)
+
+    snapshot_get = subparsers.add_parser("snapshot-get",
+                                         help=f"вывести запись из снимка; ключ берется из {SNAPSHOT_KEY_ENV}")
+    snapshot_get.add_argument("file")
+    snapshot_get.add_argument("service")
+    snapshot_get.add_argument("-c", "--category")
+    snapshot_get.add_argument("--field", choices=["password", "username", "all"], default="password")
+    snapshot_get.set_defaults(handler=cmd_snapshot_get, needs_vault=False)
+
+    calibrate = subparsers.add_parser("calibrate", help="подобрать параметры Argon2 для этого компьютера")
+    calibrate.add_argument("--target-ms", type=int, default=int(ARGON2_TARGET_SECONDS * 1000),
+                           help="желаемое время разблокировки")
+    calibrate.add_argument("--max-memory-mib", type=int, default=ARGON2_MAX_MEMORY_KIB // 1024,
+                           help="предел памяти для Argon2")
+    calibrate.add_argument("--dry-run", action="store_true", help="только показать параметры")
+    calibrate.set_defaults(handler=cmd_calibrate)
+
+    config_parser = subparsers.add_parser("config",
+                                          help="вывести действующие настройки: значение и источник "
+                                               "(default, file, env); * отмечает применяемые без перезапуска")
+    config_parser.add_argument("--json", action="store_true", help="вывести в JSON вместе с ошибками")
+    config_parser.set_defaults(handler=cmd_config, needs_vault=False)
+
+    journal_parser = subparsers.add_parser("journal", help="последние записи журнала операций с хранилищами")
+    journal_parser.add_argument("-n", "--lines", type=int, default=20)
+    journal_parser.add_argument("--verify", action="store_true", help="проверить цепочку HMAC журнала")
+    journal_parser.set_defaults(handler=cmd_journal, needs_vault=False)
+
+    audit = subparsers.add_parser("audit", help="найти повторно используемые и слабые пароли")
+    audit.add_argument("-c", "--category", help="только группы и записи с участием этой категории")
+    audit.add_argument("--strength", action="store_true", help="расшифровать и оценить энтропию паролей")
+    audit.add_argument("--threshold", type=float, default=WEAK_PASSWORD_BITS, help="порог слабого пароля в битах")
+    audit.add_argument("--workers", type=int, default=AUDIT_WORKERS, help="процессов для оценки силы")
+    audit.set_defaults(handler=cmd_audit)
+
+    history = subparsers.add_parser("history", help="предыдущие пароли записи: список, вывод и восстановление")
+    history.add_argument("service")
+    history.add_argument("-c", "--category")
+    version = history.add_mutually_exclusive_group()
+    version.add_argument("--show", type=int, metavar="ID", help="вывести пароль версии")
+    version.add_argument("--restore", type=int, metavar="ID",
+                         help="сделать версию текущей; текущий пароль сохранится в истории")
+    history.set_defaults(handler=cmd_history)
+
+    sync = subparsers.add_parser("sync", help="синхронизировать хранилище с его копией в каталоге")
+    sync.add_argument("directory", help="каталог копии; при первом запуске копия создается")
+    sync.add_argument("--conflicts", choices=["newest", "ask"], default="newest",
+                      help="запись, измененная в обеих копиях: оставить более новую или спросить")
+    sync.add_argument("--dry-run", action="store_true", help="только показать, что будет передано")
+    sync.add_argument("--rekey", action="store_true",
+                      help="после смены мастер-пароля или параметров Argon2 перешифровать копию новым ключом; "
+                           "запрашивает текущий мастер-пароль, затем прежний")
+    sync.set_defaults(handler=cmd_sync)
+
+    keyfile = subparsers.add_parser("keyfile", help="файл-ключ на USB-накопителе как второй фактор разблокировки")
+    keyfile.add_argument("action", choices=["status", "create", "remove"],
+                         help="status: требуется ли ключ и где он найден; create: записать новый ключ и требовать его; "
+                              "remove: больше не требовать ключ")
+    keyfile.add_argument("directory", nargs="?",
+                         help="куда записать ключ (по умолчанию единственный смонтированный USB-накопитель)")
+    keyfile.set_defaults(handler=cmd_keyfile)
+
+    backup = subparsers.add_parser("backup", help="резервные копии базы данных: создание, проверка и восстановление")
+    backup.add_argument("action", choices=["create", "list", "verify", "restore"],
+                        help="create: создать копию; list: все копии; verify: пересобрать копию и сверить ее "
+                             "SHA-256; restore: проверить копию и заменить ею базу данных")
+    backup.add_argument("name", nargs="?", help="имя копии для verify и restore")
+    backup.add_argument("--kind", choices=["full", "differential", "incremental"], default="differential",
+                        help="вид новой копии (по умолчанию differential, как в меню)")
+    backup.add_argument("--with-keys", action="store_true",
+                        help="для restore: если копия сделана с другим мастер-паролем или файлом-ключом, "
+                             "восстановить вместе с ней соль и токен проверки")
+    backup.set_defaults(handler=cmd_backup)
+
+    vault = subparsers.add_parser("vault", help="хранилища и связка ключей")
+    vault.add_argument("action", choices=["list", "create", "enroll", "forget"],
+                       help="list: все хранилища; create: создать хранилище --vault; "
+                            "enroll/forget: добавить ключ хранилища --vault в связку или убрать его")
+    vault.set_defaults(handler=cmd_vault)
+
+    stats = subparsers.add_parser("stats", help="гистограммы времени действий, запросов, шифрования и отрисовки")
+    stats.add_argument("--prometheus", action="store_true", help="вывести в текстовом формате Prometheus")
+    stats.add_argument("--reset", action="store_true", help="удалить накопленную статистику")
+    stats.set_defaults(handler=cmd_stats)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None, manager_factory: Optional[Callable] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if manager_factory is None:
+        from manager import PasswordManager as manager_factory
+    if args.profile:
+        registry.profile_dir = PROFILE_DIR
+    # Names only: commands such as search take free text, which is not journaled
+    fields = {"service": getattr(args, "service", None), "category": getattr(args, "category", None)}
+    if not getattr(args, "needs_vault", True):
+        try:
+            with registry.action(args.command), journal.action(args.command, vault=args.vault, **fields) as event:
+                code = args.handler(None, args)
+                event["outcome"] = OUTCOMES.get(code, FAILED)
+                return code
+        except Exception as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            return EXIT_ERROR
+        finally:
+            registry.flush()
+    from vaults import get_vault
+    try:
+        vault = get_vault(args.vault)
+    except ValueError as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    creating = args.command == "vault" and args.action == "create"
+    if vault.name != DEFAULT_VAULT and not vault.exists() and not creating:
+        print(f"Хранилище '{vault.name}' не найдено; создайте его командой vault create", file=sys.stderr)
+        return EXIT_ERROR
+    if args.socket is None:
+        args.socket = vault.agent_socket
+    manager = manager_factory(vault=vault)
+    if args.keyfile:
+        manager.keyfile_path = args.keyfile
+    # stats is not timed itself, so --reset really leaves nothing behind
+    action = registry.action(args.command) if args.handler is not cmd_stats else nullcontext()
+    try:
+        with action, journal.action(args.command, vault=vault.name, **fields) as event:
+            code = args.handler(manager, args)
+            event["outcome"] = OUTCOMES.get(code, FAILED)
+            return code
+    except Exception as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    finally:
+        manager.db.close()
+        registry.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,359 @@
 import os
+import json
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
-HOME_DIR = os.path.expanduser("~")
+# PASSMAN_HOME moves every file below to another directory, PASSMAN_CONFIG only the settings file
+HOME_DIR = os.environ.get("PASSMAN_HOME") or os.path.expanduser("~")
 DB_PATH = os.path.join(HOME_DIR, ".passman.db")
 SALT_FILE = os.path.join(HOME_DIR, ".passman_salt.bin")
 MASTER_HASH_FILE = os.path.join(HOME_DIR, ".passman_master.hash")
-CONFIG_FILE = os.path.join(HOME_DIR, ".passman_config.yaml")
+CONFIG_FILE = os.environ.get("PASSMAN_CONFIG") or os.path.join(HOME_DIR, ".passman_config.yaml")
+# Parsed copy of CONFIG_FILE, reused while the file's modification time and size are unchanged
+CONFIG_CACHE_FILE = os.path.join(HOME_DIR, ".passman_config.cache.json")
 LOG_FILE = os.path.join(HOME_DIR, ".passman.log")
+BACKUP_DIR = os.path.join(HOME_DIR, ".passman_backups")
+AGENT_SOCKET = os.path.join(HOME_DIR, ".passman_agent.sock")
+METRICS_FILE = os.path.join(HOME_DIR, ".passman_metrics.json")
+METRICS_TEXTFILE = os.path.join(HOME_DIR, ".passman_metrics.prom")
+PROFILE_DIR = os.path.join(HOME_DIR, ".passman_profiles")
+# Named vaults live in VAULTS_DIR/<name>/; the default vault keeps the files above
+VAULTS_DIR = os.path.join(HOME_DIR, ".passman_vaults")
+KEYRING_DIR = os.path.join(HOME_DIR, ".passman_keyring")
+DEFAULT_VAULT = "default"
 ARGON2_PARAMS = {
     "time_cost": 4,
     "memory_cost": 65536,
     "parallelism": 2,
     "hash_len": 32
 }
+# Calibration targets an unlock latency under a memory ceiling, never going below the OWASP minimum
+ARGON2_TARGET_SECONDS = 0.5
+ARGON2_MAX_MEMORY_KIB = 262144
+ARGON2_MIN_MEMORY_KIB = 19456
+ARGON2_MIN_TIME_COST = 2
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,
+    "cache_size": -16384,
+    "busy_timeout": 5000
+}
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.002
+BACKUP_RETENTION = 5
+AGENT_IDLE_TIMEOUT = 900
+# Local HTTP secrets API: loopback address, token file, default per-token rate (requests/s) and burst, keep-alive idle limit
+API_HOST = "127.0.0.1"
+API_PORT = 8765
+API_TOKENS_FILE = os.path.join(HOME_DIR, ".passman_api_tokens.json")
+API_RATE = 50.0
+API_BURST = 100
+API_IDLE_TIMEOUT = 30
+# Environment variable holding the key of a compiled snapshot for snapshot-get
+SNAPSHOT_KEY_ENV = "PASSMAN_SNAPSHOT_KEY"
+# Path of the vault keyfile, for when it is not on a USB drive or several drives are mounted
+KEYFILE_ENV = "PASSMAN_KEYFILE"
+# Previous passwords kept per entry and in total; limits are enforced every HISTORY_PRUNE_EVERY saved versions
+HISTORY_PER_ENTRY = 10
+HISTORY_MAX_ROWS = 10000
+HISTORY_PRUNE_EVERY = 100
+CACHE_MAX_ENTRIES = 128
+CACHE_TTL = 300
+METRICS_ENABLED = True
+# The application log is rotated at LOG_MAX_BYTES (0: never), keeping LOG_BACKUPS old files
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+# Audit journal of vault operations: JSON lines written in batches by a background thread, rotated by size
+# and age (0: never), HMAC-chained when a key file is set
+JOURNAL_FILE = os.path.join(HOME_DIR, ".passman_journal.jsonl")
+JOURNAL_ENABLED = True
+JOURNAL_MAX_BYTES = 10 * 1024 * 1024
+JOURNAL_ROTATE_SECONDS = 86400
+JOURNAL_BACKUPS = 10
+JOURNAL_BATCH = 256
+JOURNAL_HMAC_KEY_FILE = ""
+SEARCH_LIMIT = 20
+SEARCH_CANDIDATES = 100
+EXPORT_FILE = "export.ndjson"
+LEGACY_EXPORT_FILE = "export.json"
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_WORKERS = min(4, os.cpu_count() or 1)
+AUDIT_WORKERS = min(4, os.cpu_count() or 1)
+AUDIT_CHUNK_SIZE = 2000
+VAULT_SEARCH_WORKERS = 4
+# AsyncVault: operations admitted at once before callers wait, Argon2/bulk crypto processes, ciphertexts per bulk task
+AIO_MAX_PENDING = 64
+AIO_CRYPTO_WORKERS = min(4, os.cpu_count() or 1)
+AIO_BULK_CHUNK = 2000
+# Sync compares replicas through a Merkle tree with SYNC_BUCKETS leaves and SYNC_FANOUT children per node;
+# SYNC_BUCKETS must be a power of SYNC_FANOUT
+SYNC_BUCKETS = 65536
+SYNC_FANOUT = 16
 GENERATED_PASSWORD_LENGTH = 16
-DEFAULT_CONFIG = {
-    "ui": {
-        "language": "ru",
-        "theme": "default"
-    }
-}
\ No newline at end of file
+PASSWORD_SYMBOLS = "!@#$%^&*"
+LOOK_ALIKES = "Il1|O0oS5Z2B8"
+PASSPHRASE_WORDS = 5
+PASSPHRASE_SYLLABLES = 3
+PASSPHRASE_SEPARATOR = "-"
+# Entropy below which a password is shown as weak, and from which it is shown as strong
+WEAK_PASSWORD_BITS = 50
+STRONG_PASSWORD_BITS = 80
+SETTINGS_ENV_PREFIX = "PASSMAN_"
+
+
+class Setting(NamedTuple):
+    """A tunable value: its default, valid range or choices, and whether running services apply changes."""
+    default: Any
+    minimum: Optional[float] = None
+    maximum: Optional[float] = None
+    choices: Optional[Tuple[str, ...]] = None
+    hot: bool = False
+
+
+# Every setting can be given in CONFIG_FILE as section: {name: value} or as PASSMAN_SECTION_NAME
+SETTINGS: Dict[str, Setting] = {
+    # Floors match calibrate(), so an override cannot weaken key derivation below the OWASP minimum
+    "argon2.time_cost": Setting(ARGON2_PARAMS["time_cost"], ARGON2_MIN_TIME_COST),
+    "argon2.memory_cost": Setting(ARGON2_PARAMS["memory_cost"], ARGON2_MIN_MEMORY_KIB),
+    "argon2.parallelism": Setting(ARGON2_PARAMS["parallelism"], 1, 255),
+    "argon2.target_ms": Setting(int(ARGON2_TARGET_SECONDS * 1000), 1),
+    "argon2.max_memory_kib": Setting(ARGON2_MAX_MEMORY_KIB, ARGON2_MIN_MEMORY_KIB),
+    "sqlite.journal_mode": Setting(SQLITE_PRAGMAS["journal_mode"],
+                                   choices=("WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY")),
+    "sqlite.synchronous": Setting(SQLITE_PRAGMAS["synchronous"], choices=("OFF", "NORMAL", "FULL", "EXTRA")),
+    "sqlite.mmap_size": Setting(SQLITE_PRAGMAS["mmap_size"], 0),
+    # Negative values are KiB, positive values pages
+    "sqlite.cache_size": Setting(SQLITE_PRAGMAS["cache_size"]),
+    "sqlite.busy_timeout": Setting(SQLITE_PRAGMAS["busy_timeout"], 0),
+    "cache.max_entries": Setting(CACHE_MAX_ENTRIES, 0, hot=True),
+    "cache.ttl": Setting(float(CACHE_TTL), 0, hot=True),
+    "agent.idle_timeout": Setting(float(AGENT_IDLE_TIMEOUT), 1, hot=True),
+    "api.rate": Setting(API_RATE, 0.001),
+    "api.burst": Setting(API_BURST, 1),
+    "api.idle_timeout": Setting(float(API_IDLE_TIMEOUT), 0.1, hot=True),
+    "backup.pages_per_step": Setting(BACKUP_PAGES_PER_STEP, 1),
+    "backup.step_sleep": Setting(BACKUP_STEP_SLEEP, 0.0),
+    "backup.retention": Setting(BACKUP_RETENTION, 1),
+    "history.per_entry": Setting(HISTORY_PER_ENTRY, 1),
+    "history.max_rows": Setting(HISTORY_MAX_ROWS, 1),
+    "history.prune_every": Setting(HISTORY_PRUNE_EVERY, 1),
+    "import.chunk_size": Setting(IMPORT_CHUNK_SIZE, 1),
+    "import.workers": Setting(IMPORT_WORKERS, 1),
+    "audit.workers": Setting(AUDIT_WORKERS, 1),
+    "audit.chunk_size": Setting(AUDIT_CHUNK_SIZE, 1),
+    "search.limit": Setting(SEARCH_LIMIT, 1),
+    "search.candidates": Setting(SEARCH_CANDIDATES, 1),
+    "vaults.search_workers": Setting(VAULT_SEARCH_WORKERS, 1),
+    "aio.max_pending": Setting(AIO_MAX_PENDING, 1),
+    "aio.crypto_workers": Setting(AIO_CRYPTO_WORKERS, 1),
+    "aio.bulk_chunk": Setting(AIO_BULK_CHUNK, 1),
+    "metrics.enabled": Setting(METRICS_ENABLED),
+    "log.max_bytes": Setting(LOG_MAX_BYTES, 0),
+    "log.backups": Setting(LOG_BACKUPS, 1),
+    "journal.enabled": Setting(JOURNAL_ENABLED),
+    "journal.max_bytes": Setting(JOURNAL_MAX_BYTES, 4096),
+    "journal.rotate_seconds": Setting(JOURNAL_ROTATE_SECONDS, 0),
+    "journal.backups": Setting(JOURNAL_BACKUPS, 1),
+    "journal.batch": Setting(JOURNAL_BATCH, 1),
+    "journal.hmac_key_file": Setting(JOURNAL_HMAC_KEY_FILE),
+    "ui.language": Setting("ru", choices=("ru",)),
+    "ui.theme": Setting("default", choices=("default", "dark")),
+}
+
+
+class Config:
+    """Effective settings: defaults, overridden by the settings file, overridden by the environment.
+
+    The YAML file is parsed only when its modification time or size differs
+    from the cached parse in CONFIG_CACHE_FILE, so most runs read a small
+    JSON file and never import yaml. Invalid or unknown values are reported
+    in errors and fall back to the lower-priority value; they do not stop
+    the program. reload() re-reads a changed file and returns what changed, for
+    long-running services to apply their hot settings.
+    """
+
+    def __init__(self, path: str = CONFIG_FILE, cache_file: Optional[str] = CONFIG_CACHE_FILE,
+                 environ: Optional[Dict[str, str]] = None):
+        self.path = path
+        self.cache_file = cache_file
+        self.environ = os.environ if environ is None else environ
+        self.values: Dict[str, Any] = {key: setting.default for key, setting in SETTINGS.items()}
+        self.sources: Dict[str, str] = dict.fromkeys(SETTINGS, "default")
+        self.errors: List[str] = []
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._loaded = False
+        self.reload()
+
+    def __getitem__(self, key: str) -> Any:
+        return self.values[key]
+
+    def section(self, name: str) -> Dict[str, Any]:
+        """Returns the settings of one section by their short names."""
+        prefix = name + "."
+        return {key[len(prefix):]: value for key, value in self.values.items() if key.startswith(prefix)}
+
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self) -> Dict[str, Any]:
+        """Re-reads the settings file if it changed and returns {key: new value} of changed settings."""
+        stamp = self._file_stamp()
+        if self._loaded and stamp == self._stamp:
+            return {}
+        self._stamp, self._loaded = stamp, True
+        data, errors = self._read(stamp)
+        values, sources = {}, {}
+        for key, setting in SETTINGS.items():
+            section, name = key.split(".")
+            items = data.get(section)
+            values[key], sources[key] = setting.default, "default"
+            candidates = [("file", items.get(name) if isinstance(items, dict) else None),
+                          ("env", self.environ.get(SETTINGS_ENV_PREFIX + key.replace(".", "_").upper()))]
+            for source, raw in candidates:
+                if raw is None:
+                    continue
+                try:
+                    values[key], sources[key] = self.coerce(key, raw), source
+                except ValueError as e:
+                    errors.append(f"{key} ({source}): {e}")
+        for section, items in data.items():
+            if not isinstance(items, dict):
+                errors.append(f"{section}: expected a mapping of settings")
+                continue
+            errors.extend(f"{section}.{name}: unknown setting" for name in items if f"{section}.{name}" not in SETTINGS)
+        changed = {key: value for key, value in values.items() if value != self.values[key]}
+        self.values, self.sources, self.errors = values, sources, errors
+        return changed
+
+    @staticmethod
+    def coerce(key: str, raw: Any) -> Any:
+        """Converts a file or environment value to the type of the setting and checks its range."""
+        setting = SETTINGS[key]
+        kind = type(setting.default)
+        if kind is bool:
+            if isinstance(raw, str) and raw.strip().lower() in ("1", "true", "yes", "on", "0", "false", "no", "off"):
+                value = raw.strip().lower() in ("1", "true", "yes", "on")
+            elif isinstance(raw, bool):
+                value = raw
+            else:
+                raise ValueError(f"expected a boolean, got {raw!r}")
+        elif kind in (int, float):
+            if isinstance(raw, bool):
+                raise ValueError(f"expected a number, got {raw!r}")
+            try:
+                value = kind(raw)
+                if kind is int and isinstance(raw, float) and raw != value:
+                    raise ValueError(raw)
+            except ValueError:
+                raise ValueError(f"expected {'an integer' if kind is int else 'a number'}, got {raw!r}")
+            if setting.minimum is not None and value < setting.minimum:
+                raise ValueError(f"must be at least {setting.minimum}")
+            if setting.maximum is not None and value > setting.maximum:
+                raise ValueError(f"must be at most {setting.maximum}")
+        else:
+            value = str(raw)
+            if setting.choices is not None:
+                value = next((choice for choice in setting.choices if choice.lower() == value.lower()), None)
+                if value is None:
+                    raise ValueError(f"expected one of {', '.join(setting.choices)}, got {raw!r}")
+        return value
+
+    def _read(self, stamp: Optional[Tuple[int, int]]) -> Tuple[dict, List[str]]:
+        """Returns the parsed settings file, from the cache when it matches stamp."""
+        if stamp is None:
+            return {}, []
+        if self.cache_file is not None:
+            try:
+                with open(self.cache_file, "r") as f:
+                    cached = json.load(f)
+                if cached["path"] == self.path and tuple(cached["stamp"]) == stamp:
+                    return cached["data"], []
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        import yaml
+        try:
+            with open(self.path, "r") as f:
+                data = yaml.safe_load(f) or {}
+        except (OSError, yaml.YAMLError) as e:
+            return {}, [f"{self.path}: {e}"]
+        if not isinstance(data, dict):
+            return {}, [f"{self.path}: expected a mapping of sections"]
+        if self.cache_file is not None:
+            try:
+                tmp_file = self.cache_file + ".tmp"
+                fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"path": self.path, "stamp": list(stamp), "data": data}, f)
+                os.replace(tmp_file, self.cache_file)
+            except (OSError, TypeError, ValueError):
+                pass
+        return data, []
+
+    def update(self, section: str, values: Dict[str, Any]):
+        """Validates values, merges them into one section of the settings file and reloads."""
+        for name, value in values.items():
+            self.coerce(f"{section}.{name}", value)
+        import yaml
+        data = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                data = yaml.safe_load(f) or {}
+        data.setdefault(section, {}).update(values)
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, "w") as f:
+            yaml.dump(data, f)
+        os.replace(tmp_file, self.path)
+        self.reload()
+
+    def diagnostics(self) -> List[Tuple[str, Any, str, bool]]:
+        """Returns (key, effective value, source, hot) for every setting."""
+        return [(key, self.values[key], self.sources[key], SETTINGS[key].hot) for key in SETTINGS]
+
+
+settings = Config()
+
+# Effective values: the constants above are the defaults, replaced here by the file and environment settings
+ARGON2_PARAMS = {
+    "time_cost": settings["argon2.time_cost"],
+    "memory_cost": settings["argon2.memory_cost"],
+    "parallelism": settings["argon2.parallelism"],
+    "hash_len": ARGON2_PARAMS["hash_len"]
+}
+ARGON2_TARGET_SECONDS = settings["argon2.target_ms"] / 1000
+ARGON2_MAX_MEMORY_KIB = settings["argon2.max_memory_kib"]
+SQLITE_PRAGMAS = settings.section("sqlite")
+CACHE_MAX_ENTRIES = settings["cache.max_entries"]
+CACHE_TTL = settings["cache.ttl"]
+AGENT_IDLE_TIMEOUT = settings["agent.idle_timeout"]
+API_RATE = settings["api.rate"]
+API_BURST = settings["api.burst"]
+API_IDLE_TIMEOUT = settings["api.idle_timeout"]
+BACKUP_PAGES_PER_STEP = settings["backup.pages_per_step"]
+BACKUP_STEP_SLEEP = settings["backup.step_sleep"]
+BACKUP_RETENTION = settings["backup.retention"]
+HISTORY_PER_ENTRY = settings["history.per_entry"]
+HISTORY_MAX_ROWS = settings["history.max_rows"]
+HISTORY_PRUNE_EVERY = settings["history.prune_every"]
+IMPORT_CHUNK_SIZE = settings["import.chunk_size"]
+IMPORT_WORKERS = settings["import.workers"]
+AUDIT_WORKERS = settings["audit.workers"]
+AUDIT_CHUNK_SIZE = settings["audit.chunk_size"]
+SEARCH_LIMIT = settings["search.limit"]
+SEARCH_CANDIDATES = settings["search.candidates"]
+VAULT_SEARCH_WORKERS = settings["vaults.search_workers"]
+AIO_MAX_PENDING = settings["aio.max_pending"]
+AIO_CRYPTO_WORKERS = settings["aio.crypto_workers"]
+AIO_BULK_CHUNK = settings["aio.bulk_chunk"]
+METRICS_ENABLED = settings["metrics.enabled"]
+LOG_MAX_BYTES = settings["log.max_bytes"]
+LOG_BACKUPS = settings["log.backups"]
+JOURNAL_ENABLED = settings["journal.enabled"]
+JOURNAL_MAX_BYTES = settings["journal.max_bytes"]
+JOURNAL_ROTATE_SECONDS = settings["journal.rotate_seconds"]
+JOURNAL_BACKUPS = settings["journal.backups"]
+JOURNAL_BATCH = settings["journal.batch"]
+JOURNAL_HMAC_KEY_FILE = os.path.expanduser(settings["journal.hmac_key_file"])
@@ -1,67 +1,231 @@
 import os
+import time
 import base64
 import hashlib
+import hmac
 import logging
-from typing import Optional
-from argon2 import PasswordHasher
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from config import ARGON2_PARAMS, SALT_FILE, MASTER_HASH_FILE
+from typing import Iterable, List, NamedTuple, Optional, Tuple, Union
+from argon2 import PasswordHasher, Type, extract_parameters
+from argon2.low_level import hash_secret_raw
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from config import (ARGON2_PARAMS, SALT_FILE, MASTER_HASH_FILE, ARGON2_TARGET_SECONDS, ARGON2_MAX_MEMORY_KIB,
+                    ARGON2_MIN_MEMORY_KIB, ARGON2_MIN_TIME_COST)
+from metrics import timed, KDF, CRYPTO
+from usb_key_check import find_keyfiles, read_keyfile
 
 logger = logging.getLogger(__name__)
 
+VERIFIER_PREFIX = "$passman-hkdf"
+# Verifier of a vault that also needs a keyfile: the prefix is followed by $<keyfile id>
+KEYFILE_VERIFIER_PREFIX = "$passman-hkdf-keyfile"
+LEGACY_HASH_PREFIX = "$argon2"
+
+# Bytes of HMAC-SHA256 kept per fingerprint; collisions among 2**64 entries stay negligible
+FINGERPRINT_SIZE = 16
+
+
+class VaultKeys(NamedTuple):
+    """Sub-keys expanded from a single Argon2 output."""
+    verifier: bytes
+    enc_key: bytes
+    mac_key: bytes
+
+
+def calibrate(target_seconds: float = ARGON2_TARGET_SECONDS, max_memory_kib: int = ARGON2_MAX_MEMORY_KIB,
+              parallelism: int = None) -> dict:
+    """Finds the strongest Argon2id parameters that derive a key within target_seconds on this host.
+
+    Memory hardness matters most against GPU attacks, so memory_cost starts at
+    max_memory_kib and is halved until ARGON2_MIN_TIME_COST passes fit the
+    target; time_cost then grows as far as the target allows. The result never
+    drops below ARGON2_MIN_MEMORY_KIB and ARGON2_MIN_TIME_COST.
+    """
+    parallelism = parallelism or min(os.cpu_count() or 1, 4)
+    salt = os.urandom(16)
+
+    def run(time_cost: int, memory_cost: int) -> float:
+        start = time.perf_counter()
+        hash_secret_raw(b"calibration", salt, time_cost=time_cost, memory_cost=memory_cost,
+                        parallelism=parallelism, hash_len=ARGON2_PARAMS["hash_len"], type=Type.ID)
+        return time.perf_counter() - start
+
+    memory_cost = max(max_memory_kib, ARGON2_MIN_MEMORY_KIB)
+    while True:
+        elapsed = run(1, memory_cost)
+        if elapsed * ARGON2_MIN_TIME_COST <= target_seconds or memory_cost <= ARGON2_MIN_MEMORY_KIB:
+            break
+        memory_cost = max(memory_cost // 2, ARGON2_MIN_MEMORY_KIB)
+    time_cost = max(int(target_seconds / elapsed), ARGON2_MIN_TIME_COST)
+    # Time grows roughly linearly with passes; confirm the estimate on the real parameters
+    while time_cost > ARGON2_MIN_TIME_COST and run(time_cost, memory_cost) > target_seconds * 1.1:
+        time_cost -= 1
+    return {
+        "time_cost": time_cost,
+        "memory_cost": memory_cost,
+        "parallelism": parallelism,
+        "hash_len": ARGON2_PARAMS["hash_len"]
+    }
+
 
 class Crypto:
-    """Handles encryption, decryption, and master password verification."""
+    """Handles encryption, decryption, and master password verification.
+
+    A vault may require a keyfile as a second factor. Its SHA-256 digest is
+    the HKDF salt for every sub-key, so the Argon2 output alone opens
+    nothing, and the verifier record names the keyfile the vault needs.
+    keyfile_path points to the keyfile explicitly; otherwise unlock() looks
+    for it on mounted USB drives.
+    """
+
+    def __init__(self, salt_file: str = None, master_hash_file: str = None, params: Optional[dict] = None,
+                 keyfile_path: Optional[str] = None):
+        self.salt_file = salt_file or SALT_FILE
+        self.master_hash_file = master_hash_file or MASTER_HASH_FILE
+        self.keyfile_path = keyfile_path
+        # Digest of the keyfile the vault uses; set by unlock() and used for every later derivation
+        self.keyfile: Optional[bytes] = None
+        self.set_params(params or ARGON2_PARAMS)
 
-    def __init__(self):
+    def set_params(self, params: dict):
+        """Sets the Argon2 parameters used for new keys and verifiers."""
+        self.params = dict(params)
         self.ph = PasswordHasher(
-            time_cost=ARGON2_PARAMS["time_cost"],
-            memory_cost=ARGON2_PARAMS["memory_cost"],
-            parallelism=ARGON2_PARAMS["parallelism"],
-            hash_len=ARGON2_PARAMS["hash_len"]
+            time_cost=self.params["time_cost"],
+            memory_cost=self.params["memory_cost"],
+            parallelism=self.params["parallelism"],
+            hash_len=self.params["hash_len"]
+        )
+
+    @timed(KDF)
+    def derive_keys(self, master_password: str, salt: bytes, params: Optional[dict] = None) -> VaultKeys:
+        """Runs Argon2 once and expands the output into verifier, encryption and MAC keys."""
+        params = params or self.params
+        master = hash_secret_raw(
+            master_password.encode(), salt,
+            time_cost=params["time_cost"],
+            memory_cost=params["memory_cost"],
+            parallelism=params["parallelism"],
+            hash_len=params["hash_len"],
+            type=Type.ID
+        )
+        return VaultKeys(
+            verifier=self._expand(master, b"passman verifier", self.keyfile),
+            enc_key=self._expand(master, b"passman encryption", self.keyfile),
+            mac_key=self._expand(master, b"passman mac", self.keyfile)
         )
 
     def derive_key(self, master_password: str, salt: bytes) -> bytes:
         """Derives an encryption key from the master password and salt."""
-        return self.ph.hash(master_password.encode(), salt=salt).encode()[:32]
+        return self.derive_keys(master_password, salt).enc_key
 
-    def encrypt_password(self, password: str, key: bytes) -> str:
+    @staticmethod
+    def _expand(master: bytes, info: bytes, salt: Optional[bytes] = None) -> bytes:
+        """Derives an independent 32-byte sub-key with HKDF-SHA256."""
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(master)
+
+    @staticmethod
+    def keyfile_secret(data: bytes) -> bytes:
+        """Returns the digest of a keyfile's contents that is mixed into the vault keys."""
+        return hashlib.sha256(data).digest()
+
+    @staticmethod
+    def keyfile_id(secret: bytes) -> str:
+        """Returns the public identifier of a keyfile, stored in the verifier record."""
+        return hashlib.sha256(b"passman keyfile id" + secret).hexdigest()[:16]
+
+    def _find_keyfile(self, key_id: str) -> bytes:
+        """Returns the digest of the keyfile with key_id from keyfile_path or a mounted USB drive."""
+        paths = [self.keyfile_path] if self.keyfile_path else find_keyfiles()
+        for path in paths:
+            try:
+                secret = self.keyfile_secret(read_keyfile(path))
+            except RuntimeError as e:
+                if self.keyfile_path:
+                    raise
+                logger.warning(str(e))
+                continue
+            if self.keyfile_id(secret) == key_id:
+                return secret
+        if self.keyfile_path:
+            raise RuntimeError(f"Keyfile {self.keyfile_path} does not belong to this vault")
+        raise RuntimeError("The vault requires its keyfile: insert the USB drive with it or pass --keyfile")
+
+    @staticmethod
+    def fingerprint_key(key: bytes) -> bytes:
+        """Derives the fingerprint key from the vault encryption key.
+
+        Every code path that writes an entry already holds the encryption key,
+        and HKDF keeps the two keys independent.
+        """
+        return Crypto._expand(key, b"passman fingerprint")
+
+    def fingerprint(self, password: str, key: bytes) -> bytes:
+        """Returns the keyed fingerprint of a password; equal passwords have equal fingerprints."""
+        return self.fingerprint_many([password], key)[0]
+
+    @timed(CRYPTO)
+    def fingerprint_many(self, passwords: Iterable[str], key: bytes) -> List[bytes]:
+        """Returns truncated HMAC-SHA256 fingerprints of passwords under the fingerprint key."""
+        fingerprint_key = self.fingerprint_key(key)
+        return [hmac.new(fingerprint_key, password.encode(), hashlib.sha256).digest()[:FINGERPRINT_SIZE]
+                for password in passwords]
+
+    def encrypt_password(self, password: str, key: bytes) -> bytes:
         """Encrypts a password using AES-256-GCM."""
+        return self.encrypt_many([password], key)[0]
+
+    def decrypt_password(self, encrypted_password: Union[bytes, str], key: bytes) -> str:
+        """Decrypts an encrypted password using AES-256-GCM."""
+        return self.decrypt_many([encrypted_password], key)[0]
+
+    @timed(CRYPTO)
+    def encrypt_many(self, passwords: Iterable[str], key: bytes) -> List[bytes]:
+        """Encrypts passwords with one keyed AES-256-GCM context.
+
+        Each result is the raw ``iv + tag + ciphertext`` blob stored in the database.
+        """
         try:
-            iv = os.urandom(12)
-            cipher = Cipher(algorithms.AES(key), modes.GCM(iv), backend=default_backend())
-            encryptor = cipher.encryptor()
-            encrypted_password = encryptor.update(password.encode()) + encryptor.finalize()
-            return base64.b64encode(iv + encryptor.tag + encrypted_password).decode()
+            aead = AESGCM(key)
+            result = []
+            for password in passwords:
+                iv = os.urandom(12)
+                sealed = aead.encrypt(iv, password.encode(), None)
+                result.append(iv + sealed[-16:] + sealed[:-16])
+            return result
         except Exception as e:
             raise RuntimeError(f"Encryption failed: {e}")
 
-    def decrypt_password(self, encrypted_password: str, key: bytes) -> str:
-        """Decrypts an encrypted password using AES-256-GCM."""
+    @timed(CRYPTO)
+    def decrypt_many(self, encrypted_passwords: Iterable[Union[bytes, str]], key: bytes) -> List[str]:
+        """Decrypts raw or legacy base64 blobs with one keyed AES-256-GCM context."""
         try:
-            data = base64.b64decode(encrypted_password)
-            iv, tag, encrypted_password = data[:12], data[12:28], data[28:]
-            cipher = Cipher(algorithms.AES(key), modes.GCM(iv, tag), backend=default_backend())
-            decryptor = cipher.decryptor()
-            return (decryptor.update(encrypted_password) + decryptor.finalize()).decode('utf-8')
+            aead = AESGCM(key)
+            result = []
+            for data in encrypted_passwords:
+                if isinstance(data, str):
+                    data = base64.b64decode(data)
+                iv, tag, encrypted_password = data[:12], data[12:28], data[28:]
+                result.append(aead.decrypt(iv, encrypted_password + tag, None).decode('utf-8'))
+            return result
         except Exception as e:
             raise RuntimeError(f"Decryption failed: {e}")
 
     def save_salt(self, salt: bytes):
         """Saves the salt with a hash for integrity checking."""
         salt_hash = hashlib.sha256(salt).hexdigest()
-        with open(SALT_FILE, "wb") as f:
+        with open(self.salt_file, "wb") as f:
             f.write(salt + salt_hash.encode())
 
     def get_salt(self) -> bytes:
         """Retrieves or generates a salt with integrity verification."""
         try:
-            if not os.path.exists(SALT_FILE):
+            if not os.path.exists(self.salt_file):
                 salt = os.urandom(16)
                 self.save_salt(salt)
                 return salt
-            with open(SALT_FILE, "rb") as f:
+            with open(self.salt_file, "rb") as f:
                 data = f.read()
                 if len(data) < 80:
                     logger.error(f"Salt file too short: {len(data)} bytes")
@@ -85,22 +249,162 @@ class Crypto:
         """Hashes the master password using Argon2."""
         return self.ph.hash(master_password.encode(), salt=salt)
 
-    def save_master_hash(self, master_password: str, salt: bytes):
-        """Saves the hash of the master password."""
-        master_hash = self.hash_master_password(master_password, salt)
-        with open(MASTER_HASH_FILE, "w") as f:
-            f.write(master_hash)
+    @property
+    def pending_file(self) -> str:
+        """Verifier of a key switch whose re-encryption may not have committed yet."""
+        return self.master_hash_file + ".pending"
 
-    def verify_master_password(self, master_password: str, salt: bytes) -> bool:
-        """Verifies the master password against the stored hash."""
-        if not os.path.exists(MASTER_HASH_FILE):
-            self.save_master_hash(master_password, salt)
-            return True
+    def read_master_hash(self, pending: bool = False) -> Optional[str]:
+        """Returns the stored master hash record (or the pending one), or None for a new vault."""
+        path = self.pending_file if pending else self.master_hash_file
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return f.read().strip()
+
+    def has_pending_verifier(self) -> bool:
+        return os.path.exists(self.pending_file)
+
+    def promote_verifier(self):
+        """Makes the pending verifier the vault's verifier, once the vault is encrypted under its keys."""
+        os.replace(self.pending_file, self.master_hash_file)
+        self._sync_dir()
+
+    def discard_pending_verifier(self):
+        """Drops the pending verifier of a key switch that never committed."""
+        os.remove(self.pending_file)
+        self._sync_dir()
+
+    def _sync_dir(self):
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(os.path.dirname(os.path.abspath(self.master_hash_file)), os.O_RDONLY | os.O_DIRECTORY)
         try:
-            with open(MASTER_HASH_FILE, "r") as f:
-                stored_hash = f.read()
-            self.ph.verify(stored_hash, master_password.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def has_legacy_hash(self) -> bool:
+        """Checks whether the vault still uses the pre-HKDF Argon2 hash file."""
+        stored = self.read_master_hash()
+        return stored is not None and stored.startswith(LEGACY_HASH_PREFIX)
+
+    @staticmethod
+    def _parse_verifier(stored: str) -> Tuple[str, Optional[str]]:
+        """Splits a verifier record into its Argon2 part and the id of the required keyfile, if any."""
+        if stored.startswith(KEYFILE_VERIFIER_PREFIX + "$"):
+            key_id, encoded = stored[len(KEYFILE_VERIFIER_PREFIX) + 1:].split("$", 1)
+            return "$" + encoded, key_id
+        return stored[len(VERIFIER_PREFIX):], None
+
+    def required_keyfile(self) -> Optional[str]:
+        """Returns the id of the keyfile the vault requires, or None."""
+        stored = self.read_master_hash()
+        if stored is None or not stored.startswith(VERIFIER_PREFIX):
+            return None
+        return self._parse_verifier(stored)[1]
+
+    def save_verifier(self, keys: VaultKeys, salt: bytes, params: Optional[dict] = None, pending: bool = False):
+        """Saves the verification token together with the Argon2 parameters used and the keyfile id.
+
+        With pending, the token goes to pending_file: a key switch writes it
+        before re-encrypting the vault and promotes it afterwards, so a crash
+        in between leaves a verifier for whichever key the vault ended up under.
+        """
+        params = params or self.params
+        record = "{prefix}$argon2id$v=19$m={m},t={t},p={p}${salt}${token}".format(
+            prefix=f"{KEYFILE_VERIFIER_PREFIX}${self.keyfile_id(self.keyfile)}" if self.keyfile else VERIFIER_PREFIX,
+            m=params["memory_cost"],
+            t=params["time_cost"],
+            p=params["parallelism"],
+            salt=base64.b64encode(salt).decode().rstrip("="),
+            token=base64.b64encode(keys.verifier).decode().rstrip("=")
+        )
+        path = self.pending_file if pending else self.master_hash_file
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        self._sync_dir()
+
+    def unlock(self, master_password: str, salt: bytes, pending: bool = False) -> Optional[VaultKeys]:
+        """Verifies the master password and derives the vault keys with a single Argon2 pass.
+
+        With pending, checks against the pending verifier of an interrupted key switch instead.
+        """
+        stored = self.read_master_hash(pending)
+        if stored is None and pending:
+            return None
+        if stored is None:
+            self.keyfile = self.keyfile_secret(read_keyfile(self.keyfile_path)) if self.keyfile_path else None
+            keys = self.derive_keys(master_password, salt)
+            self.save_verifier(keys, salt)
+            return keys
+        if not stored.startswith(VERIFIER_PREFIX):
+            raise RuntimeError("Master hash file uses the legacy format and must be migrated")
+        try:
+            encoded, key_id = self._parse_verifier(stored)
+            parameters = extract_parameters(encoded)
+            token = base64.b64decode(encoded.rsplit("$", 1)[1] + "==")
+        except Exception as e:
+            logger.error(f"Master hash file corrupted: {e}")
+            return None
+        params = {
+            "time_cost": parameters.time_cost,
+            "memory_cost": parameters.memory_cost,
+            "parallelism": parameters.parallelism,
+            "hash_len": self.params["hash_len"]
+        }
+        # Looked up before Argon2 runs, so a missing keyfile costs no key derivation
+        self.keyfile = self._find_keyfile(key_id) if key_id is not None else None
+        keys = self.derive_keys(master_password, salt, params)
+        if not hmac.compare_digest(keys.verifier, token):
+            logger.error("Master password verification failed: token mismatch")
+            return None
+        return keys
+
+    def needs_rehash(self, allow_weaker: bool = False) -> bool:
+        """Checks whether the vault should be rehashed with the current Argon2 parameters.
+
+        Only a change that lowers neither the memory cost nor the number of
+        passes qualifies, so a config edit cannot weaken the stored key
+        derivation on the next unlock. allow_weaker is for an explicit
+        request such as calibrate and accepts any change.
+        """
+        stored = self.read_master_hash()
+        if stored is None or not stored.startswith(VERIFIER_PREFIX):
+            return False
+        try:
+            parameters = extract_parameters(self._parse_verifier(stored)[0])
+        except Exception as e:
+            logger.error(f"Master hash file corrupted: {e}")
+            return False
+        if (parameters.memory_cost, parameters.time_cost, parameters.parallelism) == (
+                self.params["memory_cost"], self.params["time_cost"], self.params["parallelism"]):
+            return False
+        if allow_weaker:
             return True
+        return (self.params["memory_cost"] >= parameters.memory_cost and
+                self.params["time_cost"] >= parameters.time_cost)
+
+    def unlock_legacy(self, master_password: str) -> Optional[bytes]:
+        """Verifies a legacy Argon2 hash file and returns the key the old scheme encrypted with.
+
+        The old ``derive_key`` truncated the encoded hash string, so the key is
+        recovered from the stored record without a second Argon2 pass.
+        """
+        stored = self.read_master_hash()
+        try:
+            self.ph.verify(stored, master_password.encode())
         except Exception as e:
             logger.error(f"Master password verification failed: {e}")
-            return False
\ No newline at end of file
+            return None
+        return stored.encode()[:32]
+
+    def verify_master_password(self, master_password: str, salt: bytes) -> bool:
+        """Verifies the master password against the stored hash."""
+        if self.has_legacy_hash():
+            return self.unlock_legacy(master_password) is not None
+        return self.unlock(master_password, salt) is not None
@@ -1,154 +1,907 @@
 import os
+import base64
 import sqlite3
 import json
-import shutil
-import datetime
-from typing import List, Optional
-from config import DB_PATH
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Callable, Dict, Iterator, Iterable, List, Optional, Tuple, Union
+from config import (DB_PATH, SQLITE_PRAGMAS, EXPORT_FILE, IMPORT_CHUNK_SIZE, HISTORY_PER_ENTRY, HISTORY_MAX_ROWS,
+                    HISTORY_PRUNE_EVERY)
+from backup import BackupManager, FULL
+from metrics import timed, DB
+
+logger = logging.getLogger(__name__)
+
+# Name of the sentinel category row (id 0) used for entries without a category
+NO_CATEGORY = ""
+
+CATEGORY_ID_SQL = "(SELECT id FROM categories WHERE name=?)"
+
+# What import_entries does with an entry whose (service, category) pair is already taken
+SKIP = "skip"
+OVERWRITE = "overwrite"
+RENAME = "rename"
+CONFLICT_POLICIES = (SKIP, OVERWRITE, RENAME)
+
+# Bound parameters per IN (...) lookup, below SQLite's historical limit of 999
+LOOKUP_BATCH = 500
+
+# (service, username, encrypted_password, category, fingerprint)
+ImportEntry = Tuple[str, str, bytes, Optional[str], Optional[bytes]]
+
+# Queries on the interactive hot path; each must resolve to an index seek
+HOT_QUERIES = {
+    "get_password": (
+        f"SELECT id, username, encrypted_password FROM passwords WHERE service=? AND category_id={CATEGORY_ID_SQL}",
+        ("service", NO_CATEGORY)
+    ),
+    "update_password": (
+        f"UPDATE passwords SET encrypted_password=?, fingerprint=? WHERE service=? AND category_id={CATEGORY_ID_SQL}",
+        (b"", None, "service", NO_CATEGORY)
+    ),
+    "save_history": (
+        f"INSERT INTO password_history (entry_id, encrypted_password, fingerprint, changed_at) "
+        f"SELECT id, encrypted_password, fingerprint, ? FROM passwords "
+        f"WHERE service=? AND category_id={CATEGORY_ID_SQL} AND (? IS NULL OR fingerprint IS NOT ?)",
+        (0.0, "service", NO_CATEGORY, None, None)
+    ),
+    "get_history": (
+        f"SELECT h.id, h.changed_at FROM password_history h JOIN passwords p ON p.id = h.entry_id "
+        f"WHERE p.service=? AND p.category_id={CATEGORY_ID_SQL} ORDER BY h.id DESC",
+        ("service", NO_CATEGORY)
+    ),
+    "delete_password": (
+        f"DELETE FROM passwords WHERE service=? AND category_id={CATEGORY_ID_SQL}",
+        ("service", NO_CATEGORY)
+    ),
+    "get_services_in_category": (
+        f"SELECT service FROM passwords WHERE category_id={CATEGORY_ID_SQL}",
+        ("category",)
+    ),
+    "get_entries_in_category": (
+        f"SELECT service, username FROM passwords WHERE category_id={CATEGORY_ID_SQL}",
+        ("category",)
+    ),
+    "get_all_categories": (
+        "SELECT name FROM categories WHERE id != 0 "
+        "AND EXISTS (SELECT 1 FROM passwords WHERE category_id=categories.id) ORDER BY name",
+        ()
+    ),
+}
+
+
+def as_blob(encrypted_password: Union[bytes, str]) -> bytes:
+    """Converts a legacy base64 ciphertext to the raw blob stored in the database."""
+    if isinstance(encrypted_password, str):
+        return base64.b64decode(encrypted_password)
+    return encrypted_password
+
+
+def category_name(category: Optional[str]) -> str:
+    """Maps an optional category to the name stored in the categories table."""
+    return category or NO_CATEGORY
+
+
+def iter_export(input_file: str, progress: Optional[Callable[[int], None]] = None) -> Iterator[dict]:
+    """Yields entries from an NDJSON export, or from a legacy JSON array export.
+
+    progress is called with the number of bytes consumed, so callers can use
+    the file size as the total.
+    """
+    with open(input_file, "rb") as f:
+        if f.peek(64).lstrip().startswith(b"["):
+            data = json.load(f)
+            if progress:
+                progress(f.tell())
+            yield from data
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+            if progress:
+                progress(len(line))
+
+
+def _create_passwords_table(cursor: sqlite3.Cursor):
+    """Version 1: the original passwords table."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS passwords (
+            id INTEGER PRIMARY KEY,
+            service TEXT NOT NULL,
+            username TEXT NOT NULL,
+            encrypted_password BLOB NOT NULL,
+            category TEXT,
+            UNIQUE(service, category)
+        )
+    """)
+
+
+def _migrate_blob_storage(cursor: sqlite3.Cursor):
+    """Version 2: rebuilds a legacy TEXT ciphertext column as BLOB and decodes its base64 rows."""
+    cursor.execute("PRAGMA table_info(passwords)")
+    column_types = {row[1]: row[2].upper() for row in cursor.fetchall()}
+    if column_types.get("encrypted_password") != "TEXT":
+        return
+    cursor.execute("ALTER TABLE passwords RENAME TO passwords_legacy")
+    _create_passwords_table(cursor)
+    cursor.execute("SELECT id, service, username, encrypted_password, category FROM passwords_legacy")
+    cursor.executemany(
+        "INSERT INTO passwords (id, service, username, encrypted_password, category) VALUES (?, ?, ?, ?, ?)",
+        [(row[0], row[1], row[2], as_blob(row[3]), row[4]) for row in cursor.fetchall()]
+    )
+    cursor.execute("DROP TABLE passwords_legacy")
+
+
+def _normalize_categories(cursor: sqlite3.Cursor):
+    """Version 3: moves categories into their own table behind a non-NULL sentinel id.
+
+    Rows that collide on (service, category) once NULL and empty categories are
+    merged keep their data under a service name suffixed with the entry id.
+    """
+    cursor.execute("CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute("INSERT INTO categories (id, name) VALUES (0, ?)", (NO_CATEGORY,))
+    cursor.execute(
+        "INSERT INTO categories (name) SELECT DISTINCT category FROM passwords "
+        "WHERE category IS NOT NULL AND category != ? ORDER BY category",
+        (NO_CATEGORY,)
+    )
+    cursor.execute("""
+        CREATE TABLE passwords_normalized (
+            id INTEGER PRIMARY KEY,
+            service TEXT NOT NULL,
+            username TEXT NOT NULL,
+            encrypted_password BLOB NOT NULL,
+            category_id INTEGER NOT NULL DEFAULT 0 REFERENCES categories(id),
+            UNIQUE(service, category_id)
+        )
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO passwords_normalized (id, service, username, encrypted_password, category_id)
+        SELECT p.id, p.service, p.username, p.encrypted_password, COALESCE(c.id, 0)
+        FROM passwords p LEFT JOIN categories c ON c.name = p.category
+        ORDER BY p.id
+    """)
+    cursor.execute("""
+        INSERT INTO passwords_normalized (id, service, username, encrypted_password, category_id)
+        SELECT p.id, p.service || ' #' || p.id, p.username, p.encrypted_password, COALESCE(c.id, 0)
+        FROM passwords p LEFT JOIN categories c ON c.name = p.category
+        WHERE p.id NOT IN (SELECT id FROM passwords_normalized)
+    """)
+    cursor.execute("DROP TABLE passwords")
+    cursor.execute("ALTER TABLE passwords_normalized RENAME TO passwords")
+    cursor.execute("CREATE INDEX idx_passwords_category ON passwords(category_id, service, username)")
+
+
+def _create_search_index(cursor: sqlite3.Cursor):
+    """Version 4: FTS5 trigram index over service, username and category, kept in sync by triggers.
+
+    SQLite builds without FTS5 or the trigram tokenizer skip the index; search
+    then falls back to prefix lookups on the service index.
+    """
+    try:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE passwords_fts USING fts5(service, username, category, tokenize='trigram')"
+        )
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Full-text search index unavailable: {e}")
+        return
+    cursor.execute("""
+        INSERT INTO passwords_fts (rowid, service, username, category)
+        SELECT p.id, p.service, p.username, c.name FROM passwords p JOIN categories c ON c.id = p.category_id
+    """)
+    cursor.execute("""
+        CREATE TRIGGER passwords_fts_insert AFTER INSERT ON passwords BEGIN
+            INSERT INTO passwords_fts (rowid, service, username, category)
+            VALUES (new.id, new.service, new.username, (SELECT name FROM categories WHERE id = new.category_id));
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER passwords_fts_delete AFTER DELETE ON passwords BEGIN
+            DELETE FROM passwords_fts WHERE rowid = old.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER passwords_fts_update AFTER UPDATE OF service, username, category_id ON passwords BEGIN
+            UPDATE passwords_fts
+            SET service = new.service, username = new.username,
+                category = (SELECT name FROM categories WHERE id = new.category_id)
+            WHERE rowid = old.id;
+        END
+    """)
+
+
+def _add_fingerprints(cursor: sqlite3.Cursor):
+    """Version 5: keyed password fingerprints for reuse detection without decryption.
+
+    Existing rows get NULL and are filled in by the next audit, which holds the key.
+    """
+    cursor.execute("ALTER TABLE passwords ADD COLUMN fingerprint BLOB")
+    cursor.execute("CREATE INDEX idx_passwords_fingerprint ON passwords(fingerprint)")
+
+
+def _create_history_table(cursor: sqlite3.Cursor):
+    """Version 6: previous ciphertexts of each entry, newest last, removed with the entry."""
+    cursor.execute("""
+        CREATE TABLE password_history (
+            id INTEGER PRIMARY KEY,
+            entry_id INTEGER NOT NULL REFERENCES passwords(id) ON DELETE CASCADE,
+            encrypted_password BLOB NOT NULL,
+            fingerprint BLOB,
+            changed_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_history_entry ON password_history(entry_id, id)")
+
+
+# Current time in Unix seconds with millisecond precision, for use inside triggers
+NOW_SQL = "((julianday('now') - 2440587.5) * 86400.0)"
+SYNC_VERSION_SQL = "(SELECT value FROM sync_meta WHERE key = 'version')"
+
+
+def _add_sync_columns(cursor: sqlite3.Cursor):
+    """Version 7: row versions, change times and tombstones for delta sync.
+
+    Every insert, edit and delete takes the next value of a per-vault
+    counter, and deletes leave a tombstone, so changes since any point are
+    found on an index. Writers that set version themselves, like sync
+    applying remote rows, bypass the triggers and keep the remote change
+    time. Existing rows get their id as version and an unknown (zero)
+    change time.
+    """
+    cursor.execute("ALTER TABLE passwords ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE passwords ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE passwords ADD COLUMN sync_bucket INTEGER")
+    cursor.execute("ALTER TABLE passwords ADD COLUMN sync_digest BLOB")
+    cursor.execute("UPDATE passwords SET version = id")
+    cursor.execute("CREATE INDEX idx_passwords_version ON passwords(version)")
+    cursor.execute("CREATE INDEX idx_passwords_bucket ON passwords(sync_bucket)")
+    cursor.execute("""
+        CREATE TABLE sync_tombstones (
+            service TEXT NOT NULL,
+            category TEXT NOT NULL,
+            deleted_at REAL NOT NULL,
+            version INTEGER NOT NULL,
+            sync_bucket INTEGER,
+            sync_digest BLOB,
+            PRIMARY KEY (service, category)
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_tombstones_version ON sync_tombstones(version)")
+    cursor.execute("CREATE INDEX idx_tombstones_bucket ON sync_tombstones(sync_bucket)")
+    cursor.execute("CREATE TABLE sync_tree (level INTEGER, position INTEGER, digest BLOB NOT NULL, "
+                   "PRIMARY KEY (level, position)) WITHOUT ROWID")
+    cursor.execute("CREATE TABLE sync_peers (peer TEXT PRIMARY KEY, version INTEGER NOT NULL, synced_at REAL NOT NULL)")
+    cursor.execute("CREATE TABLE sync_meta (key TEXT PRIMARY KEY, value NOT NULL)")
+    cursor.execute("INSERT INTO sync_meta (key, value) VALUES ('replica_id', lower(hex(randomblob(16))))")
+    cursor.execute("INSERT INTO sync_meta (key, value) SELECT 'version', coalesce(max(id), 0) FROM passwords")
+    cursor.execute("INSERT INTO sync_meta (key, value) VALUES ('tree_version', 0), ('tree_shape', '')")
+    cursor.execute(f"""
+        CREATE TRIGGER passwords_sync_insert AFTER INSERT ON passwords WHEN new.version = 0 BEGIN
+            UPDATE sync_meta SET value = value + 1 WHERE key = 'version';
+            UPDATE passwords SET version = {SYNC_VERSION_SQL},
+                updated_at = CASE WHEN new.updated_at = 0 THEN {NOW_SQL} ELSE new.updated_at END
+            WHERE id = new.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER passwords_sync_revive AFTER INSERT ON passwords BEGIN
+            DELETE FROM sync_tombstones
+            WHERE service = new.service AND category = (SELECT name FROM categories WHERE id = new.category_id);
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER passwords_sync_update
+        AFTER UPDATE OF service, username, encrypted_password, category_id ON passwords
+        WHEN new.version = old.version BEGIN
+            UPDATE sync_meta SET value = value + 1 WHERE key = 'version';
+            UPDATE passwords SET version = {SYNC_VERSION_SQL}, updated_at = {NOW_SQL} WHERE id = new.id;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER passwords_sync_delete AFTER DELETE ON passwords BEGIN
+            UPDATE sync_meta SET value = value + 1 WHERE key = 'version';
+            INSERT OR REPLACE INTO sync_tombstones (service, category, deleted_at, version)
+            VALUES (old.service, (SELECT name FROM categories WHERE id = old.category_id), {NOW_SQL},
+                    {SYNC_VERSION_SQL});
+        END
+    """)
+
+
+# Schema migrations, applied in order; PRAGMA user_version stores how many have run
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _create_passwords_table,
+    _migrate_blob_storage,
+    _normalize_categories,
+    _create_search_index,
+    _add_fingerprints,
+    _create_history_table,
+    _add_sync_columns,
+]
+
+
+class ConnectionPool:
+    """Hands out one shared writer connection and a read connection per thread.
+
+    Every connection is configured with the same pragmas; with WAL journaling
+    readers keep working on their snapshot while the writer commits.
+    """
+
+    def __init__(self, db_path: str, pragmas: Optional[dict] = None):
+        self.db_path = db_path
+        self.pragmas = dict(SQLITE_PRAGMAS if pragmas is None else pragmas)
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._write_lock = threading.RLock()
+
+    def _open(self, query_only: bool = False) -> sqlite3.Connection:
+        """Opens a connection and applies the configured pragmas."""
+        timeout = self.pragmas.get("busy_timeout", 5000) / 1000
+        conn = sqlite3.connect(self.db_path, timeout=timeout, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        conn.execute("PRAGMA foreign_keys = ON")
+        if query_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        """Returns the read-only connection owned by the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open(query_only=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Yields the writer connection while holding the write lock."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._open()
+            yield self._writer
+
+    def close(self):
+        """Closes the writer and every per-thread reader."""
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+        self._local = threading.local()
 
 
 class Database:
     """Manages SQLite database operations for the password manager."""
 
-    def __init__(self):
-        self.db_path = DB_PATH
-        self.conn = None
+    def __init__(self, db_path: str = None, pragmas: Optional[dict] = None, backup_dir: str = None,
+                 key_files: Optional[Tuple[str, str]] = None):
+        self.db_path = db_path or DB_PATH
+        self.backup_dir = backup_dir
+        # Salt and verifier files of the vault, copied into every backup
+        self.key_files = key_files
+        self.pool = ConnectionPool(self.db_path, pragmas)
+        self._write_listeners: List[Callable[[Optional[str], Optional[str]], None]] = []
+
+    def add_write_listener(self, listener: Callable[[Optional[str], Optional[str]], None]):
+        """Registers a callback run with (service, category) after an entry is changed or deleted.
+
+        Changes that touch every entry call it with (None, None).
+        """
+        self._write_listeners.append(listener)
+
+    def _notify_write(self, service: Optional[str] = None, category: str = None):
+        for listener in self._write_listeners:
+            listener(service, category)
 
     def connect(self) -> sqlite3.Connection:
-        """Establishes a connection to the SQLite database."""
-        if self.conn is None:
-            self.conn = sqlite3.connect(self.db_path)
-        return self.conn
+        """Returns the read connection of the calling thread."""
+        return self.pool.reader()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Runs a block on the writer connection, committing on success and rolling back on error."""
+        with self.pool.writer() as conn:
+            try:
+                yield conn.cursor()
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
 
     def close(self):
-        """Closes the database connection."""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        """Closes all database connections."""
+        self.pool.close()
 
     def init_db(self):
-        """Initializes the database with the passwords table."""
-        with self.connect() as conn:
+        """Initializes the database and applies pending schema migrations."""
+        with self.pool.writer() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS passwords (
-                    id INTEGER PRIMARY KEY,
-                    service TEXT NOT NULL,
-                    username TEXT NOT NULL,
-                    encrypted_password TEXT NOT NULL,
-                    category TEXT,
-                    UNIQUE(service, category)
-                )
-            """)
-            conn.commit()
+            cursor.execute("PRAGMA user_version")
+            version = cursor.fetchone()[0]
+            for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                try:
+                    cursor.execute("BEGIN")
+                    migration(cursor)
+                    cursor.execute(f"PRAGMA user_version = {target}")
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    raise RuntimeError(f"Migration to schema version {target} failed: {e}")
 
-    def add_password(self, service: str, username: str, encrypted_password: str, category: str = None) -> bool:
-        """Adds a new password entry to the database."""
+    def table_exists(self, name: str) -> bool:
+        """Checks whether a table (or virtual table) exists in the schema."""
+        cursor = self.connect().execute("SELECT 1 FROM sqlite_master WHERE name=?", (name,))
+        return cursor.fetchone() is not None
+
+    @timed(DB)
+    def count_entries(self, category: str = None) -> int:
+        """Returns the number of entries, optionally within one category."""
+        cursor = self.connect().cursor()
+        if category:
+            cursor.execute(f"SELECT COUNT(*) FROM passwords WHERE category_id={CATEGORY_ID_SQL}", (category,))
+        else:
+            cursor.execute("SELECT COUNT(*) FROM passwords")
+        return cursor.fetchone()[0]
+
+    def schema_version(self) -> int:
+        """Returns the schema version recorded in PRAGMA user_version."""
+        return self.connect().execute("PRAGMA user_version").fetchone()[0]
+
+    def query_plans(self) -> Dict[str, List[str]]:
+        """Returns the EXPLAIN QUERY PLAN details of every hot query."""
+        plans = {}
         with self.connect() as conn:
             cursor = conn.cursor()
-            try:
+            for name, (sql, params) in HOT_QUERIES.items():
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+                plans[name] = [row[3] for row in cursor.fetchall()]
+        return plans
+
+    def _ensure_category(self, cursor: sqlite3.Cursor, category: Optional[str]):
+        """Creates the category row if it does not exist yet."""
+        if category:
+            cursor.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (category,))
+
+    def _category_id(self, cursor: sqlite3.Cursor, name: str, category_ids: Dict[str, int]) -> int:
+        """Returns the id of a category, creating it on first use and caching it in category_ids."""
+        if name not in category_ids:
+            self._ensure_category(cursor, name)
+            cursor.execute("SELECT id FROM categories WHERE name=?", (name,))
+            category_ids[name] = cursor.fetchone()[0]
+        return category_ids[name]
+
+    @timed(DB)
+    def add_password(self, service: str, username: str, encrypted_password: bytes, category: str = None,
+                     fingerprint: bytes = None) -> bool:
+        """Adds a new password entry to the database."""
+        try:
+            with self.transaction() as cursor:
+                self._ensure_category(cursor, category)
                 cursor.execute(
-                    "INSERT INTO passwords (service, username, encrypted_password, category) VALUES (?, ?, ?, ?)",
-                    (service, username, encrypted_password, category)
+                    f"INSERT INTO passwords (service, username, encrypted_password, category_id, fingerprint) "
+                    f"VALUES (?, ?, ?, {CATEGORY_ID_SQL}, ?)",
+                    (service, username, encrypted_password, category_name(category), fingerprint)
                 )
-                conn.commit()
-                return True
-            except sqlite3.IntegrityError:
-                return False
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    @timed(DB)
+    def add_passwords(self, entries: List[ImportEntry]) -> bool:
+        """Adds (service, username, encrypted_password, category, fingerprint) entries in one transaction.
+
+        Nothing is added if any service already exists in its category.
+        """
+        if not entries:
+            return True
+        category_ids = {NO_CATEGORY: 0}
+        try:
+            with self.transaction() as cursor:
+                rows = [(service, username, encrypted_password,
+                         self._category_id(cursor, category_name(category), category_ids), fingerprint)
+                        for service, username, encrypted_password, category, fingerprint in entries]
+                self._insert_staged(cursor, rows)
+            return True
+        except sqlite3.IntegrityError:
+            return False
 
+    @timed(DB)
     def get_password(self, service: str, category: str = None) -> Optional[dict]:
         """Retrieves a password entry by service and optional category."""
         with self.connect() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT username, encrypted_password FROM passwords WHERE service=? AND (category=? OR category IS NULL)",
-                (service, category)
-            )
+            cursor.execute(HOT_QUERIES["get_password"][0], (service, category_name(category)))
             row = cursor.fetchone()
             if row:
-                return {"username": row[0], "encrypted_password": row[1]}
+                return {"id": row[0], "username": row[1], "encrypted_password": row[2]}
             return None
 
-    def update_password(self, service: str, encrypted_password: str, category: str = None) -> bool:
-        """Updates the encrypted password for a service and optional category."""
-        with self.connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE passwords SET encrypted_password=? WHERE service=? AND (category=? OR category IS NULL)",
-                (encrypted_password, service, category)
-            )
-            conn.commit()
-            return cursor.rowcount > 0
+    @timed(DB)
+    def update_password(self, service: str, encrypted_password: bytes, category: str = None,
+                        fingerprint: bytes = None) -> bool:
+        """Updates the encrypted password (and its fingerprint) for a service and optional category.
+
+        The previous ciphertext is kept in password_history unless the
+        fingerprints show the password did not change.
+        """
+        name = category_name(category)
+        with self.transaction() as cursor:
+            cursor.execute(HOT_QUERIES["save_history"][0], (time.time(), service, name, fingerprint, fingerprint))
+            saved = cursor.lastrowid if cursor.rowcount > 0 else None
+            cursor.execute(HOT_QUERIES["update_password"][0], (encrypted_password, fingerprint, service, name))
+            updated = cursor.rowcount > 0
+            if saved is not None and saved % HISTORY_PRUNE_EVERY == 0:
+                self._prune_history(cursor, HISTORY_PER_ENTRY, HISTORY_MAX_ROWS, since=saved - HISTORY_PRUNE_EVERY)
+        self._notify_write(service, category)
+        return updated
+
+    @timed(DB)
+    def get_history(self, service: str, category: str = None) -> List[Tuple[int, float]]:
+        """Returns (version id, time replaced) of the previous passwords of an entry, newest first."""
+        return self.connect().execute(HOT_QUERIES["get_history"][0], (service, category_name(category))).fetchall()
+
+    @timed(DB)
+    def get_history_version(self, version_id: int) -> Optional[dict]:
+        """Returns the stored ciphertext and fingerprint of a previous version."""
+        row = self.connect().execute(
+            "SELECT encrypted_password, fingerprint FROM password_history WHERE id=?", (version_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"encrypted_password": row[0], "fingerprint": row[1]}
+
+    def restore_version(self, service: str, version_id: int, category: str = None) -> bool:
+        """Makes a previous version of the entry current again; the replaced password goes to history in turn."""
+        if version_id not in (row[0] for row in self.get_history(service, category)):
+            return False
+        version = self.get_history_version(version_id)
+        return self.update_password(service, version["encrypted_password"], category, version["fingerprint"])
 
+    @timed(DB)
+    def prune_history(self, per_entry: int = HISTORY_PER_ENTRY, max_rows: int = HISTORY_MAX_ROWS) -> int:
+        """Applies the retention limits now and returns the number of versions removed."""
+        with self.transaction() as cursor:
+            return self._prune_history(cursor, per_entry, max_rows)
+
+    @staticmethod
+    def _prune_history(cursor: sqlite3.Cursor, per_entry: int, max_rows: int, since: int = 0) -> int:
+        """Keeps the newest per_entry versions of each entry and the newest max_rows overall.
+
+        Only entries with versions newer than id since are checked against the
+        per-entry limit, each by seeks on idx_history_entry. update_password
+        runs it when a saved version id is a multiple of HISTORY_PRUNE_EVERY,
+        passing the previous multiple, so the limits are exceeded by at most
+        that many rows in between.
+        """
+        cursor.execute(
+            "DELETE FROM password_history AS h "
+            "WHERE h.entry_id IN (SELECT entry_id FROM password_history WHERE id > ?) "
+            "AND h.id <= (SELECT id FROM password_history WHERE entry_id = h.entry_id "
+            "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (since, per_entry)
+        )
+        removed = cursor.rowcount
+        cursor.execute(
+            "DELETE FROM password_history WHERE id <= "
+            "(SELECT id FROM password_history ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (max_rows,)
+        )
+        removed += cursor.rowcount
+        if removed:
+            logger.info(f"Pruned {removed} password versions")
+        return removed
+
+    @timed(DB)
     def delete_password(self, service: str, category: str = None) -> bool:
         """Deletes a password entry by service and optional category."""
-        with self.connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM passwords WHERE service=? AND (category=? OR category IS NULL)",
-                (service, category)
-            )
-            conn.commit()
-            return cursor.rowcount > 0
+        with self.transaction() as cursor:
+            cursor.execute(HOT_QUERIES["delete_password"][0], (service, category_name(category)))
+            deleted = cursor.rowcount > 0
+        self._notify_write(service, category)
+        return deleted
 
     def delete_db(self) -> bool:
         """Deletes the entire database file."""
         try:
             self.close()
+            self._notify_write()
             if os.path.exists(self.db_path):
                 os.remove(self.db_path)
+                for suffix in ("-wal", "-shm"):
+                    if os.path.exists(self.db_path + suffix):
+                        os.remove(self.db_path + suffix)
                 return True
             return False
         except Exception as e:
             raise RuntimeError(f"Failed to delete database: {e}")
 
-    def backup_db(self) -> str:
-        """Creates a backup of the database."""
-        try:
-            backup_file = f"passwords_backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-            shutil.copy(self.db_path, backup_file)
-            return backup_file
-        except Exception as e:
-            raise RuntimeError(f"Backup failed: {e}")
-
-    def export_data(self, output_file: str = "export.json"):
-        """Exports all password entries to a JSON file."""
-        with self.connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT service, username, encrypted_password, category FROM passwords")
-            data = [{"service": row[0], "username": row[1], "encrypted_password": row[2], "category": row[3]} for row in
-                    cursor.fetchall()]
+    @timed(DB)
+    def backup_db(self, kind: str = FULL, backup_dir: str = None) -> str:
+        """Creates an online backup of the database, prunes old ones and returns the backup name."""
+        backups = BackupManager(self.db_path, backup_dir or self.backup_dir, key_files=self.key_files)
+        name = backups.create(kind)
+        backups.prune()
+        return name
 
+    @timed(DB)
+    def export_data(self, output_file: str = EXPORT_FILE) -> str:
+        """Streams all password entries to an NDJSON file, one entry per line."""
+        cursor = self.connect().cursor()
+        cursor.execute(
+            "SELECT p.service, p.username, p.encrypted_password, NULLIF(c.name, '') "
+            "FROM passwords p JOIN categories c ON c.id = p.category_id"
+        )
         with open(output_file, "w") as f:
-            json.dump(data, f, indent=4)
+            for service, username, encrypted_password, category in cursor:
+                f.write(json.dumps({"service": service, "username": username,
+                                    "encrypted_password": base64.b64encode(encrypted_password).decode(),
+                                    "category": category}) + "\n")
         return output_file
 
-    def import_data(self, input_file: str = "export.json"):
-        """Imports password entries from a JSON file."""
-        with open(input_file, "r") as f:
-            data = json.load(f)
+    @timed(DB)
+    def import_data(self, input_file: str = EXPORT_FILE, chunk_size: int = IMPORT_CHUNK_SIZE,
+                    progress: Optional[Callable[[int], None]] = None) -> int:
+        """Streams entries from an export file into the database in chunks inside one transaction.
+
+        Existing (service, category) pairs are left untouched. Returns the number of inserted entries.
+        """
+        category_ids = {NO_CATEGORY: 0}
+        entries = iter_export(input_file, progress)
+        imported = 0
+        with self.transaction() as cursor:
+            while True:
+                chunk = list(islice(entries, chunk_size))
+                if not chunk:
+                    break
+                rows = [(entry["service"], entry["username"], as_blob(entry["encrypted_password"]),
+                         self._category_id(cursor, category_name(entry.get("category")), category_ids), None)
+                        for entry in chunk]
+                imported += self._insert_staged(cursor, rows, ignore=True)
+        return imported
+
+    @timed(DB)
+    def import_entries(self, chunks: Iterable[List[ImportEntry]], on_conflict: str = SKIP,
+                       dry_run: bool = False) -> Dict[str, int]:
+        """Writes chunks of (service, username, encrypted_password, category, fingerprint) entries, one transaction each.
+
+        An entry whose (service, category) pair exists in the database or earlier
+        in the import is skipped, overwrites the stored username and password, or
+        is inserted as 'service #n' with the first free n, depending on
+        on_conflict; overwritten passwords are kept in history. A dry run writes
+        every chunk into a single transaction and rolls it back. Returns the
+        inserted, overwritten, renamed and skipped counts.
+        """
+        if on_conflict not in CONFLICT_POLICIES:
+            raise ValueError(f"Unknown conflict policy: {on_conflict}")
+        counts = dict.fromkeys(("inserted", "overwritten", "renamed", "skipped"), 0)
+        category_ids = {NO_CATEGORY: 0}
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            try:
+                for chunk in chunks:
+                    self._write_chunk(cursor, chunk, on_conflict, category_ids, counts)
+                    if not dry_run:
+                        conn.commit()
+            finally:
+                # Nothing left after a commit; discards a dry run or a failed chunk
+                conn.rollback()
+        if counts["overwritten"] and not dry_run:
+            self.prune_history()
+            self._notify_write()
+        return counts
+
+    def _write_chunk(self, cursor: sqlite3.Cursor, chunk: List[ImportEntry], on_conflict: str,
+                     category_ids: Dict[str, int], counts: Dict[str, int]):
+        rows = [(service, username, encrypted_password,
+                 self._category_id(cursor, category_name(category), category_ids), fingerprint)
+                for service, username, encrypted_password, category, fingerprint in chunk]
+        taken = self._existing_keys(cursor, rows)
+        fresh, conflicts = [], []
+        for row in rows:
+            key = (row[0], row[3])
+            (conflicts if key in taken else fresh).append(row)
+            taken.add(key)
+        counts["inserted"] += self._insert_staged(cursor, fresh)
+        if on_conflict == SKIP:
+            counts["skipped"] += len(conflicts)
+        elif on_conflict == OVERWRITE:
+            now = time.time()
+            cursor.executemany(
+                "INSERT INTO password_history (entry_id, encrypted_password, fingerprint, changed_at) "
+                "SELECT id, encrypted_password, fingerprint, ? FROM passwords "
+                "WHERE service=? AND category_id=? AND (? IS NULL OR fingerprint IS NOT ?)",
+                [(now, service, category_id, fingerprint, fingerprint)
+                 for service, _, _, category_id, fingerprint in conflicts]
+            )
+            cursor.executemany(
+                "UPDATE passwords SET username=?, encrypted_password=?, fingerprint=? "
+                "WHERE service=? AND category_id=?",
+                [(username, encrypted_password, fingerprint, service, category_id)
+                 for service, username, encrypted_password, category_id, fingerprint in conflicts]
+            )
+            counts["overwritten"] += len(conflicts)
+        else:
+            for service, username, encrypted_password, category_id, fingerprint in conflicts:
+                suffix = 2
+                while True:
+                    cursor.execute(
+                        "INSERT OR IGNORE INTO passwords "
+                        "(service, username, encrypted_password, category_id, fingerprint) VALUES (?, ?, ?, ?, ?)",
+                        (f"{service} #{suffix}", username, encrypted_password, category_id, fingerprint)
+                    )
+                    if cursor.rowcount:
+                        break
+                    suffix += 1
+            counts["renamed"] += len(conflicts)
+
+    @staticmethod
+    def _insert_staged(cursor: sqlite3.Cursor, rows: List[Tuple[str, str, bytes, int, Optional[bytes]]],
+                       ignore: bool = False) -> int:
+        """Inserts (service, username, encrypted_password, category_id, fingerprint) rows with a single statement.
+
+        FTS5 flushes its pending index data at every statement savepoint, so an
+        insert trigger fired once per executemany row writes one index segment
+        per entry. Staging the chunk in a temp table and copying it with one
+        INSERT ... SELECT is about four times faster. Sync versions are assigned
+        in the same statement rather than by the per-row insert trigger.
+        Returns the number inserted.
+        """
+        if not rows:
+            # max(rowid) of an empty staging table is NULL and would null the sync counter
+            return 0
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_rows "
+                       "(service TEXT, username TEXT, encrypted_password BLOB, category_id INTEGER, fingerprint BLOB)")
+        cursor.executemany("INSERT INTO temp.import_rows VALUES (?, ?, ?, ?, ?)", rows)
+        cursor.execute(
+            f"INSERT {'OR IGNORE ' if ignore else ''}INTO passwords "
+            f"(service, username, encrypted_password, category_id, fingerprint, updated_at, version) "
+            f"SELECT service, username, encrypted_password, category_id, fingerprint, ?, {SYNC_VERSION_SQL} + rowid "
+            f"FROM temp.import_rows ORDER BY rowid",
+            (time.time(),)
+        )
+        inserted = cursor.rowcount
+        cursor.execute("UPDATE sync_meta SET value = value + (SELECT max(rowid) FROM temp.import_rows) "
+                       "WHERE key = 'version'")
+        cursor.execute("DELETE FROM temp.import_rows")
+        return inserted
+
+    @staticmethod
+    def _existing_keys(cursor: sqlite3.Cursor, rows: List[tuple]) -> set:
+        """Returns the (service, category_id) pairs of rows that are already stored."""
+        services = list({row[0] for row in rows})
+        keys = set()
+        for start in range(0, len(services), LOOKUP_BATCH):
+            batch = services[start:start + LOOKUP_BATCH]
+            cursor.execute(
+                f"SELECT service, category_id FROM passwords WHERE service IN ({', '.join('?' * len(batch))})", batch
+            )
+            keys.update(cursor.fetchall())
+        return keys
+
+    @timed(DB)
+    def get_all_encrypted(self, table: str = "passwords") -> List[Tuple[int, bytes]]:
+        """Returns (id, encrypted_password) pairs of every entry, or every history version, for bulk re-keying."""
+        if table not in ("passwords", "password_history"):
+            raise ValueError(f"Not an encrypted table: {table}")
         with self.connect() as conn:
             cursor = conn.cursor()
-            for entry in data:
-                cursor.execute(
-                    "INSERT OR IGNORE INTO passwords (service, username, encrypted_password, category) VALUES (?, ?, ?, ?)",
-                    (entry["service"], entry["username"], entry["encrypted_password"], entry.get("category"))
-                )
-            conn.commit()
+            cursor.execute(f"SELECT id, encrypted_password FROM {table} ORDER BY id")
+            return cursor.fetchall()
+
+    def get_encrypted_sample(self) -> Optional[bytes]:
+        """Returns one stored ciphertext, of an entry or a history version, to tell which key the vault is under."""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT encrypted_password FROM passwords UNION ALL "
+                           "SELECT encrypted_password FROM password_history LIMIT 1")
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def has_sync_peers(self) -> bool:
+        """Checks whether the vault has ever been synced with another replica."""
+        return self.connect().execute("SELECT 1 FROM sync_peers LIMIT 1").fetchone() is not None
+
+    @timed(DB)
+    def update_encrypted_many(self, rows: Iterable[Tuple[bytes, Optional[bytes], int]],
+                              history_rows: Iterable[Tuple[bytes, Optional[bytes], int]] = ()):
+        """Replaces ciphertexts and fingerprints of entries and of history versions by id in a single transaction.
+
+        Re-encryption is not an edit: entries get a new sync version, so sync
+        trees pick up the new ciphertexts, but keep their change time.
+        """
+        with self.transaction() as cursor:
+            cursor.execute("UPDATE sync_meta SET value = value + 1 WHERE key = 'version'")
+            cursor.executemany(f"UPDATE passwords SET encrypted_password=?, fingerprint=?, version={SYNC_VERSION_SQL} "
+                               f"WHERE id=?", rows)
+            cursor.executemany("UPDATE password_history SET encrypted_password=?, fingerprint=? WHERE id=?",
+                               history_rows)
+        self._notify_write()
+
+    @timed(DB)
+    def get_encrypted_entries(self, category: str = None) -> List[Tuple[str, str, Optional[str], bytes]]:
+        """Returns (service, username, category, encrypted_password) for all entries or one category."""
+        sql = ("SELECT p.service, p.username, NULLIF(c.name, ''), p.encrypted_password "
+               "FROM passwords p JOIN categories c ON c.id = p.category_id")
+        params: list = []
+        if category:
+            sql += f" WHERE p.category_id = {CATEGORY_ID_SQL}"
+            params.append(category)
+        return self.connect().execute(sql, params).fetchall()
+
+    @timed(DB)
+    def get_unfingerprinted(self, limit: int) -> List[Tuple[int, bytes]]:
+        """Returns up to limit (id, encrypted_password) pairs of entries without a fingerprint."""
+        cursor = self.connect().execute(
+            "SELECT id, encrypted_password FROM passwords WHERE fingerprint IS NULL ORDER BY id LIMIT ?", (limit,)
+        )
+        return cursor.fetchall()
+
+    @timed(DB)
+    def set_fingerprints(self, rows: Iterable[Tuple[bytes, int]]):
+        """Stores fingerprints by entry id in a single transaction."""
+        with self.transaction() as cursor:
+            cursor.executemany("UPDATE passwords SET fingerprint=? WHERE id=?", rows)
+
+    @timed(DB)
+    def get_reused(self, category: str = None) -> List[Tuple[bytes, str, str, Optional[str]]]:
+        """Returns (fingerprint, service, username, category) of entries sharing a fingerprint, grouped.
 
+        Shared fingerprints are found by a GROUP BY over the fingerprint index;
+        with a category, only groups with at least one entry in it are returned.
+        """
+        sql = "SELECT fingerprint FROM passwords WHERE fingerprint IS NOT NULL"
+        params: list = []
+        if category:
+            sql += f" AND fingerprint IN (SELECT fingerprint FROM passwords WHERE category_id={CATEGORY_ID_SQL})"
+            params.append(category)
+        sql += " GROUP BY fingerprint HAVING COUNT(*) > 1"
+        cursor = self.connect().execute(
+            f"SELECT p.fingerprint, p.service, p.username, NULLIF(c.name, '') FROM passwords p "
+            f"JOIN categories c ON c.id = p.category_id WHERE p.fingerprint IN ({sql}) "
+            f"ORDER BY p.fingerprint, c.name, p.service",
+            params
+        )
+        return cursor.fetchall()
+
+    @timed(DB)
     def get_all_services(self, category: str = None) -> List[str]:
         """Returns a list of all unique services, optionally filtered by category."""
         with self.connect() as conn:
             cursor = conn.cursor()
             if category:
-                cursor.execute("SELECT DISTINCT service FROM passwords WHERE category=?", (category,))
+                cursor.execute(HOT_QUERIES["get_services_in_category"][0], (category,))
             else:
                 cursor.execute("SELECT DISTINCT service FROM passwords")
             return [row[0] for row in cursor.fetchall()]
 
+    @timed(DB)
+    def get_entries(self, category: str = None) -> List[Tuple[str, str, Optional[str]]]:
+        """Returns (service, username, category) for all entries, optionally filtered by category."""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            if category:
+                cursor.execute(HOT_QUERIES["get_entries_in_category"][0], (category,))
+                return [(row[0], row[1], category) for row in cursor.fetchall()]
+            cursor.execute(
+                "SELECT p.service, p.username, NULLIF(c.name, '') "
+                "FROM passwords p JOIN categories c ON c.id = p.category_id"
+            )
+            return cursor.fetchall()
+
+    @timed(DB)
     def get_all_categories(self) -> List[str]:
         """Returns a list of all unique categories."""
         with self.connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT DISTINCT category FROM passwords WHERE category IS NOT NULL")
-            return [row[0] for row in cursor.fetchall()]
\ No newline at end of file
+            cursor.execute(HOT_QUERIES["get_all_categories"][0])
+            return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,170 @@
+import math
+import secrets
+import string
+from typing import Callable, Dict, List, Optional, Sequence
+from config import (GENERATED_PASSWORD_LENGTH, PASSWORD_SYMBOLS, LOOK_ALIKES, PASSPHRASE_WORDS,
+                    PASSPHRASE_SYLLABLES, PASSPHRASE_SEPARATOR)
+
+CHARACTER_CLASSES: Dict[str, str] = {
+    "lower": string.ascii_lowercase,
+    "upper": string.ascii_uppercase,
+    "digits": string.digits,
+    "symbols": PASSWORD_SYMBOLS,
+}
+
+# Pronounceable consonant-vowel syllables; c, q, w, x and y are left out as easy to mishear
+CONSONANTS = "bdfghjklmnprstvz"
+VOWELS = "aeiou"
+SYLLABLES = [c + v for c in CONSONANTS for v in VOWELS]
+
+# Random bytes requested at a time; rejected bytes are cheap compared to one call per character
+RANDOM_BLOCK = 4096
+
+
+class Policy:
+    """Describes generated secrets.
+
+    In character mode a password has length characters drawn from the union
+    of the given classes, with at least min_counts[class] from each, minus the
+    excluded characters (and look-alikes such as 1, l and I when requested).
+    In passphrase mode it is words words of syllables consonant-vowel
+    syllables each, joined by separator.
+    """
+
+    def __init__(self, length: int = GENERATED_PASSWORD_LENGTH, classes: Sequence[str] = tuple(CHARACTER_CLASSES),
+                 min_counts: Optional[Dict[str, int]] = None, exclude: str = "", exclude_look_alikes: bool = False,
+                 passphrase: bool = False, words: int = PASSPHRASE_WORDS, syllables: int = PASSPHRASE_SYLLABLES,
+                 separator: str = PASSPHRASE_SEPARATOR):
+        unknown = set(classes) - set(CHARACTER_CLASSES)
+        if unknown:
+            raise ValueError(f"Unknown character classes: {', '.join(sorted(unknown))}")
+        excluded = set(exclude) | (set(LOOK_ALIKES) if exclude_look_alikes else set())
+        self.classes = {name: "".join(c for c in CHARACTER_CLASSES[name] if c not in excluded) for name in classes}
+        self.min_counts = {name: count for name, count in (min_counts or {}).items() if count > 0}
+        self.length = length
+        self.passphrase = passphrase
+        self.words = words
+        self.syllables = syllables
+        self.separator = separator
+        self.alphabet = "".join(self.classes.values())
+        if passphrase:
+            if words < 1 or syllables < 1:
+                raise ValueError("A passphrase needs at least one word of one syllable")
+            return
+        if not self.alphabet:
+            raise ValueError("The policy leaves no characters to choose from")
+        for name in self.min_counts:
+            if name not in self.classes:
+                raise ValueError(f"Minimum count for a class that is not used: {name}")
+            if not self.classes[name]:
+                raise ValueError(f"Every character of class {name} is excluded")
+        if length < max(1, sum(self.min_counts.values())):
+            raise ValueError("Length is shorter than the minimum counts combined")
+
+    @classmethod
+    def default(cls, length: int = GENERATED_PASSWORD_LENGTH) -> "Policy":
+        """Letters, digits and symbols with at least one of each."""
+        return cls(length, min_counts=dict.fromkeys(CHARACTER_CLASSES, 1))
+
+    def entropy_bits(self) -> float:
+        """Returns log2 of the number of distinct secrets the policy generates, all equally likely."""
+        if self.passphrase:
+            return self.words * self.syllables * math.log2(len(SYLLABLES))
+        return math.log2(self._count_valid())
+
+    def _count_valid(self) -> int:
+        """Counts passwords of the policy length meeting every minimum, class by class.
+
+        ways[n] is the number of strings of n characters from the classes seen
+        so far; adding a class with k of its characters interleaves them in
+        C(n + k, k) ways.
+        """
+        ways = [1] + [0] * self.length
+        for name, chars in self.classes.items():
+            minimum = self.min_counts.get(name, 0)
+            combined = [0] * (self.length + 1)
+            for n, count in enumerate(ways):
+                if count:
+                    for k in range(minimum, self.length - n + 1):
+                        combined[n + k] += count * math.comb(n + k, k) * len(chars) ** k
+            ways = combined
+        return ways[self.length]
+
+
+class PasswordGenerator:
+    """Generates secrets for a policy from bulk random bytes.
+
+    Bytes come from secrets.token_bytes in blocks. A byte maps to symbol
+    b % n of an n-symbol alphabet only when it is below 256 - 256 % n, and
+    the rest are dropped, so every symbol is equally likely. Dropping bytes,
+    mapping them to indices and then to characters are bytes.translate
+    calls. Passwords that miss a class minimum are rejected whole, which
+    keeps the result uniform over all passwords that satisfy the policy.
+    """
+
+    def __init__(self, policy: Policy = None, random_bytes: Callable[[int], bytes] = secrets.token_bytes):
+        self.policy = policy or Policy.default()
+        self.random_bytes = random_bytes
+        symbols = len(SYLLABLES) if self.policy.passphrase else len(self.policy.alphabet)
+        if symbols > 256:
+            raise ValueError("Alphabets of more than 256 symbols are not supported")
+        limit = 256 - 256 % symbols
+        self._indices = bytes(b % symbols for b in range(limit)) + bytes(256 - limit)
+        self._rejected = bytes(range(limit, 256))
+        self._characters = self.policy.alphabet.encode("ascii").ljust(256, b"\0")
+        self._buffer = b""
+        self._minimums = [(self.policy.classes[name].encode("ascii"), count)
+                          for name, count in self.policy.min_counts.items()]
+
+    def generate(self) -> str:
+        return self.generate_many(1)[0]
+
+    def generate_many(self, count: int) -> List[str]:
+        """Returns count independent secrets."""
+        if self.policy.passphrase:
+            return [self._passphrase() for _ in range(count)]
+        length = self.policy.length
+        result = []
+        while len(result) < count:
+            text = self._take(length * (count - len(result))).translate(self._characters)
+            for start in range(0, len(text), length):
+                password = text[start:start + length]
+                if self._meets_minimums(password):
+                    result.append(password.decode("ascii"))
+        return result
+
+    def _passphrase(self) -> str:
+        policy = self.policy
+        indices = self._take(policy.words * policy.syllables)
+        words = ["".join(SYLLABLES[i] for i in indices[w * policy.syllables:(w + 1) * policy.syllables])
+                 for w in range(policy.words)]
+        return policy.separator.join(words)
+
+    def _meets_minimums(self, password: bytes) -> bool:
+        for chars, minimum in self._minimums:
+            if len(password) - len(password.translate(None, chars)) < minimum:
+                return False
+        return True
+
+    def _take(self, count: int) -> bytes:
+        """Returns count uniform symbol indices."""
+        while len(self._buffer) < count:
+            block = self.random_bytes(max(RANDOM_BLOCK, 2 * (count - len(self._buffer))))
+            self._buffer += block.translate(self._indices, self._rejected)
+        taken, self._buffer = self._buffer[:count], self._buffer[count:]
+        return taken
+
+
+def estimate_entropy(password: str) -> float:
+    """Estimates the entropy of a password that was not generated here, in bits.
+
+    Assumes each character was drawn uniformly from the union of the classes
+    it uses (lower case, upper case, digits, ASCII punctuation, anything else),
+    which overestimates dictionary words and patterns.
+    """
+    pools = [(string.ascii_lowercase, 26), (string.ascii_uppercase, 26), (string.digits, 10),
+             (string.punctuation + " ", 33)]
+    pool = sum(size for chars, size in pools if any(c in chars for c in password))
+    if any(ord(c) > 127 for c in password):
+        pool += 100
+    return len(password) * math.log2(pool) if pool else 0.0
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import ipaddress
+import logging
+import secrets
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+from config import API_HOST, API_PORT, API_TOKENS_FILE, API_RATE, API_BURST, API_IDLE_TIMEOUT, settings
+from db import category_name
+from metrics import registry, ACTION
+from auditlog import journal, OK, DENIED, NOT_FOUND, RATE_LIMITED, FAILED
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for the request line and headers; requests carry no body
+MAX_REQUEST_SIZE = 16 * 1024
+
+# How often the token file is checked for changes, in seconds
+TOKEN_RELOAD_INTERVAL = 1.0
+
+TOKEN_PREFIX = "pm_"
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 429: "Too Many Requests",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error"}
+
+Response = Tuple[int, dict, Dict[str, str]]
+
+# Journal outcome of each status a request can end with
+OUTCOMES = {200: OK, 401: DENIED, 403: DENIED, 404: NOT_FOUND, 429: RATE_LIMITED}
+
+
+class Token(NamedTuple):
+    """An API token: who it was issued to, what it may read and how fast."""
+    name: str
+    categories: Optional[frozenset]
+    rate: float
+    burst: int
+
+    def allows(self, category: Optional[str]) -> bool:
+        """Checks read access to a category; None as categories means every category."""
+        return self.categories is None or category_name(category) in self.categories
+
+
+class TokenStore:
+    """API tokens of all vaults in one 0600 JSON file.
+
+    Only a SHA-256 hash of each token is stored, so the file does not grant
+    access by itself. Tokens are random 256-bit strings, which makes a plain
+    hash sufficient: there is nothing to brute-force.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or API_TOKENS_FILE
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._tokens: Dict[str, Dict[str, Token]] = {}
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def create(self, vault: str, name: str, categories: Optional[List[str]] = None,
+               rate: float = API_RATE, burst: int = API_BURST) -> str:
+        """Issues a token for the vault and returns it; the token is not stored and cannot be shown again."""
+        entries = self._load()
+        if any(entry["vault"] == vault and entry["name"] == name for entry in entries.values()):
+            raise ValueError(f"Token {name} already exists")
+        token = TOKEN_PREFIX + secrets.token_urlsafe(32)
+        entries[self.digest(token)] = {
+            "vault": vault, "name": name, "created_at": time.time(), "rate": rate, "burst": burst,
+            "categories": None if categories is None else sorted(category_name(c) for c in categories)
+        }
+        self._save(entries)
+        return token
+
+    def revoke(self, vault: str, name: str) -> bool:
+        entries = self._load()
+        kept = {digest: entry for digest, entry in entries.items()
+                if entry["vault"] != vault or entry["name"] != name}
+        if len(kept) == len(entries):
+            return False
+        self._save(kept)
+        return True
+
+    def list(self, vault: str) -> List[dict]:
+        """Returns the token records of a vault, without their hashes, in name order."""
+        return sorted((entry for entry in self._load().values() if entry["vault"] == vault),
+                      key=lambda entry: entry["name"])
+
+    def lookup(self, vault: str, token: str) -> Optional[Token]:
+        """Returns the token of the vault, re-reading the file at most once per TOKEN_RELOAD_INTERVAL."""
+        now = time.monotonic()
+        if now - self._checked >= TOKEN_RELOAD_INTERVAL:
+            self._checked = now
+            mtime = os.stat(self.path).st_mtime if os.path.exists(self.path) else None
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self._tokens = {}
+                for digest, entry in self._load().items():
+                    categories = None if entry["categories"] is None else frozenset(entry["categories"])
+                    self._tokens.setdefault(entry["vault"], {})[digest] = Token(
+                        entry["name"], categories, entry["rate"], entry["burst"])
+        return self._tokens.get(vault, {}).get(self.digest(token))
+
+    def _load(self) -> Dict[str, dict]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"API token file read failed: {e}")
+
+    def _save(self, entries: Dict[str, dict]):
+        tmp_file = self.path + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.path)
+
+
+class RateLimiter:
+    """Token bucket per API token: rate requests per second, bursts of up to burst."""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def acquire(self, token: Token) -> float:
+        """Takes one request from the token's bucket; returns 0, or the seconds to wait when it is empty."""
+        now = time.monotonic()
+        level, last = self._buckets.get(token.name, (float(token.burst), now))
+        level = min(float(token.burst), level + (now - last) * token.rate)
+        if level < 1:
+            self._buckets[token.name] = (level, now)
+            return (1 - level) / token.rate
+        self._buckets[token.name] = (level - 1, now)
+        return 0.0
+
+
+class SecretsServer:
+    """Read-only HTTP/1.1 JSON API over an unlocked AsyncVault, on loopback or a Unix socket.
+
+    The vault is unlocked once when the server starts; requests authenticate
+    with bearer tokens from the TokenStore, so no request runs Argon2.
+    Connections are kept alive between requests until the client closes
+    them, sends ``Connection: close`` or stays idle for idle_timeout
+    seconds. Database reads go through the AsyncVault, whose single
+    database thread and bounded admission keep a burst of requests from
+    piling up work; decryption of one entry takes microseconds and stays on
+    the event loop.
+
+    Routes:
+        GET /v1/health
+        GET /v1/secrets/<service>[?category=<name>]
+        GET /v1/entries[?category=<name>]
+    """
+
+    def __init__(self, vault, vault_name: str, tokens: TokenStore = None, host: str = API_HOST,
+                 port: int = API_PORT, socket_path: str = None, idle_timeout: float = API_IDLE_TIMEOUT):
+        if socket_path is None and host != "localhost" and not ipaddress.ip_address(host).is_loopback:
+            raise ValueError(f"API must listen on a loopback address, not {host}")
+        self.vault = vault
+        self.vault_name = vault_name
+        self.tokens = tokens or TokenStore()
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.limiter = RateLimiter()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def address(self) -> str:
+        if self.socket_path is not None:
+            return self.socket_path
+        host, port = self._server.sockets[0].getsockname()[:2] if self._server else (self.host, self.port)
+        return f"http://{host}:{port}"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except asyncio.LimitOverrunError:
+                    self._write(writer, 431, {"error": "request too large"}, {}, False)
+                    break
+                try:
+                    method, target, headers = self._parse(head)
+                except ValueError:
+                    self._write(writer, 400, {"error": "malformed request"}, {}, False)
+                    break
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if headers.get("content-length", "0") != "0" or "transfer-encoding" in headers:
+                    self._write(writer, 413, {"error": "requests take no body"}, {}, False)
+                    break
+                try:
+                    status, body, extra = await self.dispatch(method, target, headers)
+                except Exception as e:
+                    logger.error(f"API request failed: {e}")
+                    status, body, extra = 500, {"error": "internal error"}, {}
+                self._write(writer, status, body, extra, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse(head: bytes) -> Tuple[str, str, Dict[str, str]]:
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ")
+        if not version.startswith("HTTP/1."):
+            raise ValueError(version)
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    @staticmethod
+    def _write(writer: asyncio.StreamWriter, status: int, body: dict, extra: Dict[str, str], keep_alive: bool):
+        payload = json.dumps(body).encode()
+        head = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: application/json",
+                f"Content-Length: {len(payload)}", "Cache-Control: no-store"]
+        head.extend(f"{name}: {value}" for name, value in extra.items())
+        if not keep_alive:
+            head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + payload)
+
+    async def dispatch(self, method: str, target: str, headers: Dict[str, str]) -> Response:
+        """Authenticates, rate-limits and answers one request."""
+        url = urlsplit(target)
+        if method != "GET":
+            return 405, {"error": "only GET is supported"}, {"Allow": "GET"}
+        if url.path == "/v1/health":
+            return 200, {"ok": True}, {}
+        scheme, _, credentials = headers.get("authorization", "").partition(" ")
+        token = self.tokens.lookup(self.vault_name, credentials.strip()) if scheme.lower() == "bearer" else None
+        if token is None:
+            journal.record("api_auth", DENIED, vault=self.vault_name)
+            return 401, {"error": "invalid token"}, {"WWW-Authenticate": "Bearer"}
+        wait = self.limiter.acquire(token)
+        if wait:
+            journal.record("api_auth", RATE_LIMITED, vault=self.vault_name, token=token.name)
+            return 429, {"error": "rate limit exceeded"}, {"Retry-After": str(max(1, round(wait)))}
+        category = parse_qs(url.query).get("category", [None])[0]
+        if url.path.startswith("/v1/secrets/"):
+            service = unquote(url.path[len("/v1/secrets/"):])
+            with registry.timer(ACTION, "api_secret"), journal.action(
+                    "api_secret", vault=self.vault_name, token=token.name, service=service, category=category) as event:
+                response = await self._secret(token, service, category)
+                event["outcome"] = OUTCOMES.get(response[0], FAILED)
+                return response
+        if url.path == "/v1/entries":
+            with registry.timer(ACTION, "api_entries"), journal.action(
+                    "api_entries", vault=self.vault_name, token=token.name, category=category) as event:
+                response = await self._entries(token, category)
+                event["outcome"] = OUTCOMES.get(response[0], FAILED)
+                return response
+        return 404, {"error": "unknown route"}, {}
+
+    async def _secret(self, token: Token, service: str, category: Optional[str]) -> Response:
+        # Scope is checked before the lookup so a token cannot probe other categories
+        if not token.allows(category):
+            return 403, {"error": "category not allowed for this token"}, {}
+        entry = await self.vault.get(service, category)
+        if entry is None:
+            return 404, {"error": "not found"}, {}
+        return 200, {"service": service, "category": category, "username": entry[0], "password": entry[1]}, {}
+
+    async def _entries(self, token: Token, category: Optional[str]) -> Response:
+        if category is not None and not token.allows(category):
+            return 403, {"error": "category not allowed for this token"}, {}
+        entries = await self.vault.list(category)
+        return 200, {"entries": [{"service": service, "username": username, "category": entry_category}
+                                 for service, username, entry_category in entries
+                                 if token.allows(entry_category)]}, {}
+
+    async def start(self):
+        """Starts listening; the Unix socket is created readable by the owner only."""
+        if self.socket_path is None:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_REQUEST_SIZE)
+        else:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            old_umask = os.umask(0o077)
+            try:
+                self._server = await asyncio.start_unix_server(self._handle, path=self.socket_path,
+                                                               limit=MAX_REQUEST_SIZE)
+            finally:
+                os.umask(old_umask)
+            os.chmod(self.socket_path, 0o600)
+        logger.info(f"Secrets API listening on {self.address}")
+
+    async def _watch_settings(self):
+        while True:
+            await asyncio.sleep(TOKEN_RELOAD_INTERVAL)
+            changed = settings.reload()
+            if "api.idle_timeout" in changed:
+                self.idle_timeout = changed["api.idle_timeout"]
+                logger.info(f"API idle timeout set to {self.idle_timeout} s")
+
+    async def serve(self):
+        """Serves until cancelled, then closes the vault and removes the socket."""
+        await self.start()
+        watcher = asyncio.create_task(self._watch_settings())
+        try:
+            async with self._server:
+                try:
+                    await self._server.serve_forever()
+                except asyncio.CancelledError:
+                    pass
+        finally:
+            watcher.cancel()
+            self.vault.close()
+            registry.flush()
+            if self.socket_path is not None and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,228 @@
+import csv
+import logging
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+from config import IMPORT_CHUNK_SIZE, IMPORT_WORKERS
+from db import Database, ImportEntry, SKIP
+
+logger = logging.getLogger(__name__)
+
+CSV = "csv"
+KEEPASS = "keepass"
+
+# Lower-cased header names used by browser and password manager CSV exports (Chrome, Firefox,
+# Safari, Bitwarden), in order of preference
+SERVICE_COLUMNS = ("name", "title")
+URL_COLUMNS = ("url", "login_uri", "origin_url", "hostname")
+USERNAME_COLUMNS = ("username", "login_username", "login", "user")
+PASSWORD_COLUMNS = ("password", "login_password")
+CATEGORY_COLUMNS = ("folder", "group", "grouping", "category")
+
+# KeePass XML elements tracked while parsing; all others are only looked at when they end
+KEEPASS_STRUCTURE = frozenset(("Meta", "Group", "Entry", "History"))
+
+
+class PlainEntry(NamedTuple):
+    service: str
+    username: str
+    password: str
+    category: Optional[str]
+
+
+class ImportReport:
+    """Counts of what an import read, rejected and wrote."""
+
+    def __init__(self):
+        self.read = 0
+        self.invalid = 0
+        self.inserted = 0
+        self.overwritten = 0
+        self.renamed = 0
+        self.skipped = 0
+
+    @property
+    def conflicts(self) -> int:
+        return self.overwritten + self.renamed + self.skipped
+
+    def to_dict(self) -> Dict[str, int]:
+        return {"read": self.read, "invalid": self.invalid, "inserted": self.inserted,
+                "conflicts": self.conflicts, "overwritten": self.overwritten,
+                "renamed": self.renamed, "skipped": self.skipped}
+
+
+def service_from_url(url: str) -> str:
+    """Returns the host name of a URL without a leading 'www.', or the text itself if it has none."""
+    url = url.strip()
+    host = urlsplit(url if "//" in url else "//" + url).hostname or url
+    return host[4:] if host.startswith("www.") else host
+
+
+def _column(header: List[str], names: Iterable[str]) -> Optional[int]:
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def read_browser_csv(path: str) -> Iterator[Optional[PlainEntry]]:
+    """Yields entries from a browser CSV export row by row; None stands for a malformed row.
+
+    The service is the name or title column when there is one, otherwise the
+    host of the URL. An optional folder column becomes the category.
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in next(reader, [])]
+        service, url = _column(header, SERVICE_COLUMNS), _column(header, URL_COLUMNS)
+        username, password = _column(header, USERNAME_COLUMNS), _column(header, PASSWORD_COLUMNS)
+        category = _column(header, CATEGORY_COLUMNS)
+        if password is None or (service is None and url is None):
+            raise ValueError(f"{path}: CSV header has no password or service/url column")
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != len(header):
+                yield None
+                continue
+            name = row[service].strip() if service is not None else ""
+            if not name and url is not None and row[url].strip():
+                name = service_from_url(row[url])
+            folder = row[category].strip() if category is not None else ""
+            yield PlainEntry(name, row[username] if username is not None else "", row[password], folder or None)
+
+
+def read_keepass_xml(path: str) -> Iterator[Optional[PlainEntry]]:
+    """Yields entries from a KeePass 2.x XML export as they are parsed.
+
+    Groups below the root group become a 'parent/child' category. Entry
+    history and the recycle bin are skipped, and every parsed entry is
+    detached from the tree, so memory stays bounded by the nesting depth.
+    """
+    stack: List[ET.Element] = []  # open elements whose tag is in KEEPASS_STRUCTURE
+    groups: List[list] = []  # [name, in_recycle_bin] per open group
+    recycle_bin = None
+    history = 0
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        tag = element.tag
+        if event == "start":
+            if tag in KEEPASS_STRUCTURE:
+                stack.append(element)
+                if tag == "Group":
+                    groups.append(["", bool(groups) and groups[-1][1]])
+                elif tag == "History":
+                    history += 1
+            continue
+
+        if tag in KEEPASS_STRUCTURE:
+            stack.pop()
+        parent = stack[-1] if stack else None
+        if tag == "Entry":
+            if not history:
+                if groups and not groups[-1][1]:
+                    yield _keepass_entry(element, [name for name, _ in groups[1:]])
+                parent.remove(element)
+        elif parent is None or parent.tag != "Group":
+            if tag == "RecycleBinUUID" and parent is not None and parent.tag == "Meta":
+                recycle_bin = (element.text or "").strip() or None
+            elif tag == "History":
+                history -= 1
+                element.clear()
+            elif tag == "Meta":
+                element.clear()
+        elif tag == "Name":
+            groups[-1][0] = element.text or ""
+        elif tag == "UUID" and recycle_bin and element.text == recycle_bin:
+            groups[-1][1] = True
+        elif tag == "Group":
+            groups.pop()
+            parent.remove(element)
+
+
+def _keepass_entry(element: ET.Element, groups: List[str]) -> Optional[PlainEntry]:
+    fields = {string.findtext("Key"): string.findtext("Value") or "" for string in element.iter("String")}
+    service = fields.get("Title", "").strip() or service_from_url(fields.get("URL", ""))
+    return PlainEntry(service, fields.get("UserName", ""), fields.get("Password", ""), "/".join(groups) or None)
+
+
+READERS: Dict[str, Callable[[str], Iterator[Optional[PlainEntry]]]] = {
+    CSV: read_browser_csv,
+    KEEPASS: read_keepass_xml,
+}
+
+
+class Importer:
+    """Streams plaintext entries from another manager's export into the vault.
+
+    Entries are validated and grouped into chunks; chunks are encrypted on a
+    thread pool, at most workers + 1 ahead of the chunk being written, while
+    the database writes each one in its own transaction. A dry run skips
+    encryption and reports what the import would do.
+    """
+
+    def __init__(self, db: Database, crypto, key: Optional[bytes],
+                 workers: int = IMPORT_WORKERS, chunk_size: int = IMPORT_CHUNK_SIZE):
+        self.db = db
+        self.crypto = crypto
+        self.key = key
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+
+    def import_file(self, path: str, file_format: str, on_conflict: str = SKIP, dry_run: bool = False,
+                    progress: Optional[Callable[[int], None]] = None) -> ImportReport:
+        """Imports a CSV or KeePass XML export and returns the report."""
+        if file_format not in READERS:
+            raise ValueError(f"Unknown import format: {file_format}")
+        return self.run(READERS[file_format](path), on_conflict, dry_run, progress)
+
+    def run(self, entries: Iterable[Optional[PlainEntry]], on_conflict: str = SKIP, dry_run: bool = False,
+            progress: Optional[Callable[[int], None]] = None) -> ImportReport:
+        """Imports entries; progress, if given, is called with the number read after each chunk."""
+        if not dry_run and self.key is None:
+            raise ValueError("An encryption key is required unless it is a dry run")
+        report = ImportReport()
+        chunks = self._chunks(entries, report, progress)
+        if dry_run:
+            encrypted = ([(e.service, e.username, b"", e.category, None) for e in chunk] for chunk in chunks)
+        else:
+            encrypted = self._encrypt(chunks)
+        counts = self.db.import_entries(encrypted, on_conflict, dry_run)
+        for name, count in counts.items():
+            setattr(report, name, count)
+        logger.info(f"Import {'dry run ' if dry_run else ''}finished: {report.to_dict()}")
+        return report
+
+    def _chunks(self, entries: Iterable[Optional[PlainEntry]], report: ImportReport,
+                progress: Optional[Callable[[int], None]]) -> Iterator[List[PlainEntry]]:
+        entries = iter(entries)
+        while True:
+            chunk = list(islice(entries, self.chunk_size))
+            if not chunk:
+                return
+            report.read += len(chunk)
+            valid = [e for e in chunk if e is not None and e.service and e.password]
+            report.invalid += len(chunk) - len(valid)
+            if progress:
+                progress(report.read)
+            if valid:
+                yield valid
+
+    def _encrypt(self, chunks: Iterator[List[PlainEntry]]) -> Iterator[List[ImportEntry]]:
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="import") as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(self._encrypt_chunk, chunk))
+                if len(pending) > self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _encrypt_chunk(self, chunk: List[PlainEntry]) -> List[ImportEntry]:
+        passwords = [e.password for e in chunk]
+        blobs = self.crypto.encrypt_many(passwords, self.key)
+        fingerprints = self.crypto.fingerprint_many(passwords, self.key)
+        return [(e.service, e.username, blob, e.category, fingerprint)
+                for e, blob, fingerprint in zip(chunk, blobs, fingerprints)]
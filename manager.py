@@ -1,109 +1,348 @@
 import getpass
-import json
 import os
-import secrets
-import string
+import sys
 import logging
-import yaml
-from typing import Optional, Tuple, List
-
-from rich.panel import Panel
+from typing import Optional, Tuple, List, TYPE_CHECKING
 
 from db import Database
-from crypto import Crypto
-from ui import UI
-from config import GENERATED_PASSWORD_LENGTH, CONFIG_FILE, DEFAULT_CONFIG, LOG_FILE
-from rich.progress import Progress
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+from backup import DIFFERENTIAL
+from search import SearchIndex
+from cache import EntryCache
+from metrics import registry
+from auditlog import configure_logging, journal, CONFLICT, ERROR, NOT_FOUND
+from config import (GENERATED_PASSWORD_LENGTH, CONFIG_FILE, EXPORT_FILE, LEGACY_EXPORT_FILE, ARGON2_PARAMS,
+                    ARGON2_TARGET_SECONDS, ARGON2_MAX_MEMORY_KIB, WEAK_PASSWORD_BITS, DEFAULT_VAULT, KEYFILE_ENV,
+                    SALT_FILE, MASTER_HASH_FILE, Config, settings)
+
+if TYPE_CHECKING:
+    from crypto import Crypto, VaultKeys
+    from generator import Policy
+    from ui import UI
+    from vaults import Vault
+
+configure_logging()
 logger = logging.getLogger(__name__)
 
 
 class PasswordManager:
     """Управляет операциями с паролями и координирует работу базы данных, шифрования и интерфейса."""
 
-    def __init__(self):
-        self.db = Database()
-        self.crypto = Crypto()
-        self.ui = UI()
+    def __init__(self, db_path: str = None, crypto: Optional["Crypto"] = None, config_file: str = CONFIG_FILE,
+                 vault: Optional["Vault"] = None):
+        self.vault = vault
+        if vault is not None:
+            vault.create_dir()
+            db_path = db_path or vault.db_path
+        if crypto is not None:
+            key_files = (crypto.salt_file, crypto.master_hash_file)
+        elif vault is not None:
+            key_files = (vault.salt_file, vault.master_hash_file)
+        else:
+            key_files = (SALT_FILE, MASTER_HASH_FILE)
+        self.db = Database(db_path, backup_dir=vault.backup_dir if vault is not None else None, key_files=key_files)
+        self.search = SearchIndex(self.db)
+        self.cache = EntryCache()
+        self.db.add_write_listener(self.cache.invalidate)
+        self._crypto = crypto
+        self._ui = None
+        # Without a path the keyfile of a vault that requires one is looked for on USB drives
+        self.keyfile_path = os.environ.get(KEYFILE_ENV) or None
+        self.settings = settings if config_file == CONFIG_FILE else Config(config_file, cache_file=None)
+        for error in self.settings.errors:
+            logger.warning(f"Ошибка в настройках: {error}")
         self.db.init_db()
-        # Ensure config file exists
-        if not os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, "w") as f:
-                yaml.dump(DEFAULT_CONFIG, f)
-
-    def generate_password(self, length: int = GENERATED_PASSWORD_LENGTH) -> str:
-        """Генерирует случайный безопасный пароль."""
-        chars = string.ascii_letters + string.digits + "!@#$%^&*"
-        password = ''.join(secrets.choice(chars) for _ in range(length))
-        strength = self.ui.check_password_strength(password)
-        self.ui.console.print(f"Сила сгенерированного пароля: {strength}")
+
+    @property
+    def vault_name(self) -> str:
+        return self.vault.name if self.vault is not None else DEFAULT_VAULT
+
+    @property
+    def crypto(self) -> "Crypto":
+        """Argon2 и cryptography загружаются только для команд, которым нужен ключ."""
+        if self._crypto is None:
+            from crypto import Crypto
+            if self.vault is not None:
+                self._crypto = Crypto(self.vault.salt_file, self.vault.master_hash_file, self.argon2_params(),
+                                      keyfile_path=self.keyfile_path)
+            else:
+                self._crypto = Crypto(params=self.argon2_params(), keyfile_path=self.keyfile_path)
+        return self._crypto
+
+    def argon2_params(self) -> dict:
+        """Возвращает параметры Argon2 из настроек: подобранные калибровкой или значения по умолчанию."""
+        params = dict(ARGON2_PARAMS)
+        for name in ("time_cost", "memory_cost", "parallelism"):
+            params[name] = self.settings[f"argon2.{name}"]
+        return params
+
+    def calibrate(self, target_seconds: float = ARGON2_TARGET_SECONDS,
+                  max_memory_kib: int = ARGON2_MAX_MEMORY_KIB, save: bool = True) -> dict:
+        """Подбирает параметры Argon2 для этого компьютера и сохраняет их в конфигурации.
+
+        Хранилище перехешируется новыми параметрами при следующей успешной
+        разблокировке, если они не слабее прежних; более слабые применяет
+        только unlock с allow_weaker.
+        """
+        from crypto import calibrate
+        params = calibrate(target_seconds, max_memory_kib)
+        if save:
+            self.settings.update("argon2", {
+                "time_cost": params["time_cost"],
+                "memory_cost": params["memory_cost"],
+                "parallelism": params["parallelism"],
+                "target_ms": int(target_seconds * 1000)
+            })
+            self.crypto.set_params(params)
+        return params
+
+    @property
+    def ui(self) -> "UI":
+        """Интерфейс создается при первом обращении, чтобы CLI не загружал rich и questionary."""
+        if self._ui is None:
+            from ui import UI
+            self._ui = UI()
+        return self._ui
+
+    def generate_password(self, length: int = GENERATED_PASSWORD_LENGTH, show_strength: bool = True,
+                          policy: Optional["Policy"] = None) -> str:
+        """Генерирует случайный пароль по политике (по умолчанию буквы, цифры и символы)."""
+        from generator import PasswordGenerator, Policy
+        policy = policy or Policy.default(length)
+        password = PasswordGenerator(policy).generate()
+        if show_strength:
+            strength = self.ui.check_password_strength(password, policy.entropy_bits())
+            self.ui.console.print(f"Сила сгенерированного пароля: {strength}")
         return password
 
-    def change_master_password(self, old_key: bytes, salt: bytes) -> Tuple[bool, Optional[str]]:
-        """Меняет мастер-пароль и перешифровывает все пароли."""
-        new_password = self.ui.get_new_master_password()
+    def generate_entries(self, services: List[str], username: str, category: Optional[str], key: bytes,
+                         policy: Optional["Policy"] = None) -> Optional[List[Tuple[str, str]]]:
+        """Генерирует пароли для сервисов и сохраняет все записи в одной транзакции.
+
+        Возвращает пары (сервис, пароль) или None, если какой-либо сервис уже
+        есть в категории; тогда не сохраняется ничего.
+        """
+        from generator import PasswordGenerator
+        passwords = PasswordGenerator(policy).generate_many(len(services))
+        encrypted = self.crypto.encrypt_many(passwords, key)
+        fingerprints = self.crypto.fingerprint_many(passwords, key)
+        if not self.db.add_passwords([(service, username, blob, category, fingerprint)
+                                      for service, blob, fingerprint in zip(services, encrypted, fingerprints)]):
+            return None
+        return list(zip(services, passwords))
+
+    def change_master_password(self, old_key: bytes, salt: bytes,
+                               new_password: str = None) -> Tuple[bool, Optional["VaultKeys"]]:
+        """Меняет мастер-пароль и перешифровывает все пароли.
+
+        Без new_password пароль запрашивается через интерфейс, и результат
+        показывается пользователю; с new_password метод работает без интерфейса.
+        """
+        interactive = new_password is None
+        if interactive:
+            new_password = self.ui.get_new_master_password()
         if not new_password:
             return False, None
 
-        # Generate new key
-        new_key = self.crypto.derive_key(new_password, salt)
-
-        # Re-encrypt all passwords
-        with self.db.connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT service, username, encrypted_password, category FROM passwords")
-            entries = cursor.fetchall()
-
-            for service, username, encrypted_password, category in entries:
-                try:
-                    # Decrypt with old key
-                    password = self.crypto.decrypt_password(encrypted_password, old_key)
-                    # Encrypt with new key
-                    new_encrypted_password = self.crypto.encrypt_password(password, new_key)
-                    # Update database
-                    cursor.execute(
-                        "UPDATE passwords SET encrypted_password=? WHERE service=? AND (category=? OR category IS NULL)",
-                        (new_encrypted_password, service, category)
-                    )
-                except Exception as e:
-                    self.ui.display_error(f"Не удалось перешифровать {service}: {e}")
-                    return False, None
-
-            conn.commit()
-
-        # Save new master password hash
-        self.crypto.save_master_hash(new_password, salt)
-        self.ui.display_success("🔄 [green]Мастер-пароль изменен![/green]")
-        return True, new_password
+        # Generate new keys with a single Argon2 pass
+        new_keys = self.crypto.derive_keys(new_password, salt)
+        new_password = " " * len(new_password)  # Очистка памяти
+
+        try:
+            self.switch_keys(old_key, new_keys, salt)
+        except Exception as e:
+            if not interactive:
+                raise
+            self.ui.display_error(str(e))
+            return False, None
+
+        if interactive:
+            self.ui.display_success("🔄 [green]Мастер-пароль изменен![/green]")
+        return True, new_keys
+
+    def reencrypt_all(self, old_key: bytes, new_key: bytes):
+        """Перешифровывает все пароли и их предыдущие версии новым ключом в одной транзакции."""
+        try:
+            rows, history_rows = (self._reencrypt(self.db.get_all_encrypted(table), old_key, new_key)
+                                  for table in ("passwords", "password_history"))
+        except Exception as e:
+            raise RuntimeError(f"Не удалось перешифровать пароли: {e}")
+        self.db.update_encrypted_many(rows, history_rows)
+
+    def _reencrypt(self, entries: List[Tuple[int, bytes]], old_key: bytes,
+                   new_key: bytes) -> List[Tuple[bytes, bytes, int]]:
+        """Возвращает (шифротекст, отпечаток, id) записей, зашифрованных новым ключом."""
+        passwords = self.crypto.decrypt_many((encrypted for _, encrypted in entries), old_key)
+        encrypted_passwords = self.crypto.encrypt_many(passwords, new_key)
+        fingerprints = self.crypto.fingerprint_many(passwords, new_key)
+        return list(zip(encrypted_passwords, fingerprints, (entry_id for entry_id, _ in entries)))
+
+    def unlock(self, master_password: str, salt: bytes, allow_weaker: bool = False) -> Optional["VaultKeys"]:
+        """Проверяет мастер-пароль и выводит ключи хранилища за один проход Argon2.
+
+        Хранилища со старым файлом .passman_master.hash прозрачно переводятся
+        на новую схему: пароли перешифровываются, а хеш заменяется токеном проверки.
+        Хранилище перехешируется текущими параметрами Argon2, только если они не
+        слабее сохраненных, или при allow_weaker (явный запрос, как calibrate).
+        """
+        if self.crypto.has_pending_verifier() and not self._settle_key_switch(master_password, salt):
+            return None
+        if not self.crypto.has_legacy_hash():
+            keys = self.crypto.unlock(master_password, salt)
+            if keys is not None and self.crypto.needs_rehash(allow_weaker):
+                keys = self.rehash(master_password, salt, keys)
+            elif keys is not None and self.crypto.needs_rehash(allow_weaker=True):
+                logger.warning("Параметры Argon2 в настройках слабее параметров хранилища; "
+                               "оно не перехешировано (для смены параметров используйте calibrate)")
+            return keys
+
+        legacy_key = self.crypto.unlock_legacy(master_password)
+        if legacy_key is None:
+            return None
+        keys = self.crypto.derive_keys(master_password, salt)
+        self.switch_keys(legacy_key, keys, salt)
+        logger.info("Хранилище переведено на схему ключей HKDF")
+        return keys
+
+    def switch_keys(self, old_key: bytes, new_keys: "VaultKeys", salt: bytes):
+        """Перешифровывает хранилище новым ключом и заменяет токен проверки так, чтобы сбой не запер хранилище.
+
+        Новый токен записывается в отдельный файл до перешифровки и становится
+        основным только после ее фиксации. Если процесс прервется между этими
+        шагами, следующая разблокировка сама определит, каким ключом
+        зашифровано хранилище (см. _settle_key_switch).
+        """
+        self.crypto.save_verifier(new_keys, salt, pending=True)
+        try:
+            self.reencrypt_all(old_key, new_keys.enc_key)
+        except Exception:
+            self.crypto.discard_pending_verifier()
+            raise
+        self.crypto.promote_verifier()
+        if self.db.has_sync_peers():
+            logger.warning("Ключ хранилища изменился: копии, с которыми оно синхронизируется, нужно перешифровать "
+                           "командой sync КАТАЛОГ --rekey")
+
+    def _settle_key_switch(self, master_password: str, salt: bytes) -> bool:
+        """Завершает или отменяет смену ключей, прерванную между перешифровкой и заменой токена проверки.
+
+        Какой из двух токенов верен, решает один хранимый шифротекст: его
+        расшифровывает только ключ, которым зашифровано хранилище. Возвращает
+        False, если пароль не подходит ни к одному из токенов.
+        """
+        sample = self.db.get_encrypted_sample()
+
+        def opens(key: bytes) -> bool:
+            try:
+                self.crypto.decrypt_password(sample, key)
+                return True
+            except RuntimeError:
+                return False
+
+        pending_error = None
+        try:
+            pending = self.crypto.unlock(master_password, salt, pending=True)
+        except RuntimeError as e:
+            # The pending verifier may name a keyfile that is not at hand; the current one may still open the vault
+            pending, pending_error = None, e
+        if pending is not None and (sample is None or opens(pending.enc_key)):
+            self.crypto.promote_verifier()
+            logger.warning("Завершена прерванная смена ключей хранилища")
+            return True
+        if self.crypto.has_legacy_hash():
+            current = self.crypto.unlock_legacy(master_password)
+        else:
+            keys = self.crypto.unlock(master_password, salt)
+            current = keys.enc_key if keys is not None else None
+        if current is not None and (sample is None or opens(current)):
+            self.crypto.discard_pending_verifier()
+            logger.warning("Отменена прерванная смена ключей хранилища")
+            return True
+        if pending_error is not None:
+            raise pending_error
+        return False
+
+    def rehash(self, master_password: str, salt: bytes, keys: "VaultKeys") -> "VaultKeys":
+        """Выводит ключи с текущими параметрами Argon2 и перешифровывает ими хранилище."""
+        new_keys = self.crypto.derive_keys(master_password, salt)
+        self.switch_keys(keys.enc_key, new_keys, salt)
+        logger.info("Хранилище перехешировано с новыми параметрами Argon2")
+        return new_keys
+
+    def set_keyfile(self, master_password: str, salt: bytes, keys: "VaultKeys",
+                    keyfile: Optional[bytes]) -> "VaultKeys":
+        """Начинает или перестает требовать файл-ключ и перешифровывает хранилище новыми ключами.
+
+        keyfile: содержимое нового файла-ключа или None, чтобы отключить его.
+        """
+        previous = self.crypto.keyfile
+        self.crypto.keyfile = self.crypto.keyfile_secret(keyfile) if keyfile is not None else None
+        new_keys = self.crypto.derive_keys(master_password, salt)
+        try:
+            self.switch_keys(keys.enc_key, new_keys, salt)
+        except Exception:
+            self.crypto.keyfile = previous
+            raise
+        logger.info("Файл-ключ хранилища " + ("задан" if keyfile is not None else "отключен"))
+        return new_keys
+
+    def get_entry(self, service: str, category: Optional[str], key: bytes) -> Optional[Tuple[str, str]]:
+        """Возвращает (имя пользователя, пароль) из кэша или расшифровывает запись из базы."""
+        cached = self.cache.get(service, category)
+        if cached is not None:
+            return cached
+        result = self.db.get_password(service, category)
+        if result is None:
+            return None
+        password = self.crypto.decrypt_password(result["encrypted_password"], key)
+        self.cache.put(service, category, result["username"], password)
+        return result["username"], password
+
+    def version_history(self, service: str, category: Optional[str], key: bytes):
+        """Показывает предыдущие версии пароля и восстанавливает выбранную."""
+        versions = self.db.get_history(service, category)
+        if not versions:
+            self.ui.display_error("У записи нет предыдущих версий")
+            return
+        version_id = self.ui.select_version(versions)
+        if version_id is None:
+            return
+        action = self.ui.version_menu()
+        if action == "show":
+            version = self.db.get_history_version(version_id)
+            entry = self.db.get_password(service, category)
+            if version is None or entry is None:
+                self.ui.display_error(self.ui.messages["not_found"])
+                return
+            password = self.crypto.decrypt_password(version["encrypted_password"], key)
+            self.ui.display_password(service, entry["username"], password, category)
+        elif action == "restore":
+            if self.ui.confirm_action(f"♻️ Восстановить эту версию {service}? Текущий пароль сохранится в истории"):
+                if self.db.restore_version(service, version_id, category):
+                    self.ui.display_success(self.ui.messages["saved_success"])
+                else:
+                    self.ui.display_error(self.ui.messages["not_found"])
 
     def get_services_and_metadata(self, category: str = None) -> Tuple[List[str], List[str], List[str]]:
         """Получает список сервисов, имен пользователей и категорий."""
-        with self.db.connect() as conn:
-            cursor = conn.cursor()
-            if category:
-                cursor.execute(
-                    "SELECT service, username, category FROM passwords WHERE category=?",
-                    (category,)
-                )
-            else:
-                cursor.execute("SELECT service, username, category FROM passwords")
-            rows = cursor.fetchall()
-            services = [row[0] for row in rows]
-            usernames = [row[1] for row in rows]
-            categories = [row[2] for row in rows]
-            return services, usernames, categories
+        rows = self.db.get_entries(category)
+        services = [row[0] for row in rows]
+        usernames = [row[1] for row in rows]
+        categories = [row[2] for row in rows]
+        return services, usernames, categories
+
+    def select_service(self, category: str = None) -> Optional[str]:
+        """Предлагает выбрать сервис с поиском по индексу в пределах категории."""
+        return self.ui.select_service(lambda text: self.search.search(text, category),
+                                      self.db.count_entries(category))
 
     def run(self):
         """Запускает основной цикл приложения."""
+        from rich.panel import Panel
+        from rich.progress import Progress
+
         self.ui.print_banner()
+        if self.vault is not None and self.vault.name != DEFAULT_VAULT:
+            self.ui.console.print(f"🗄️ Хранилище: [bold]{self.vault.name}[/bold]")
         self.ui.animated_loading("Инициализация системы безопасности...")
 
         salt = self.crypto.get_salt()
@@ -116,8 +355,10 @@ class PasswordManager:
                 if not master_password.strip():
                     raise ValueError("Мастер-пароль не может быть пустым")
 
-                # Verify master password
-                if not self.crypto.verify_master_password(master_password, salt):
+                # Verify master password and derive keys
+                with registry.action("unlock"):
+                    keys = self.unlock(master_password, salt)
+                if keys is None:
                     attempts += 1
                     remaining = max_attempts - attempts
                     self.ui.display_error(
@@ -127,7 +368,7 @@ class PasswordManager:
                         return
                     continue
 
-                key = self.crypto.derive_key(master_password, salt)
+                key = keys.enc_key
                 break
             except Exception as e:
                 self.ui.display_error(str(e))
@@ -136,170 +377,207 @@ class PasswordManager:
         while True:
             action = self.ui.get_action()
             try:
-                # Select category for relevant actions
-                category = None
-                if action in ["get_password", "edit_password", "delete_password"]:
-                    categories = self.db.get_all_categories()
-                    category = self.ui.select_category(categories)
-                    if category == "Без категории":
-                        category = None
-
-                if action == "add_password":
-                    data = self.ui.get_password_data()
-                    if not data:
-                        continue
-                    encrypted_password = self.crypto.encrypt_password(data["password"], key)
-                    category = data["category"] if data["category"] else None
-                    if self.db.add_password(data["service"], data["username"], encrypted_password, category):
-                        self.ui.display_success(self.ui.messages["saved_success"])
-                    else:
-                        self.ui.display_error(f"Сервис '{data['service']}' уже существует в категории")
-
-                elif action == "get_password":
-                    services, usernames, categories = self.get_services_and_metadata(category)
-                    service = self.ui.select_service(services, usernames, categories)
-                    if not service:
-                        continue
-                    while True:
-                        sub_action = self.ui.service_menu(service)
-                        if sub_action == "back":
-                            break
-                        elif sub_action == "view":
-                            result = self.db.get_password(service, category)
-                            if result:
-                                try:
-                                    password = self.crypto.decrypt_password(result["encrypted_password"], key)
-                                    self.ui.display_password(service, result["username"], password, category)
-                                except Exception as e:
-                                    self.ui.display_error(f"Не удалось расшифровать: вероятно, неверный мастер-пароль")
-                            else:
-                                self.ui.display_error(self.ui.messages["not_found"])
-                        elif sub_action == "edit":
-                            data = self.ui.get_password_data()
-                            if not data:
-                                continue
-                            encrypted_password = self.crypto.encrypt_password(data["password"], key)
-                            if self.db.update_password(service, encrypted_password, category):
-                                self.ui.display_success(self.ui.messages["saved_success"])
-                            else:
-                                self.ui.display_error(f"Сервис '{service}' не найден")
-                        elif sub_action == "delete":
-                            if self.ui.confirm_action(f"🗑️ Удалить {service}?"):
-                                if self.db.delete_password(service, category):
-                                    self.ui.display_success(f"🗑️ [green]{service} удален![/green]")
-                                    break
-                                else:
-                                    self.ui.display_error(f"Сервис '{service}' не найден")
-
-                elif action == "generate_password":
-                    data = self.ui.get_password_data(generate=True)
-                    if not data:
-                        continue
-                    password = self.generate_password()
-                    encrypted_password = self.crypto.encrypt_password(password, key)
-                    category = data["category"] if data["category"] else None
-                    if self.db.add_password(data["service"], data["username"], encrypted_password, category):
-                        self.ui.display_password(data["service"], data["username"], password, category)
-                    else:
-                        self.ui.display_error(f"Сервис '{data['service']}' уже существует в категории")
-
-                elif action == "edit_password":
-                    services, usernames, categories = self.get_services_and_metadata(category)
-                    service = self.ui.select_service(services, usernames, categories)
-                    if not service:
-                        continue
-                    data = self.ui.get_password_data()
-                    if not data:
-                        continue
-                    encrypted_password = self.crypto.encrypt_password(data["password"], key)
-                    if self.db.update_password(service, encrypted_password, category):
-                        self.ui.display_success(self.ui.messages["saved_success"])
-                    else:
-                        self.ui.display_error(f"Сервис '{service}' не найден")
-
-                elif action == "delete_password":
-                    services, usernames, categories = self.get_services_and_metadata(category)
-                    service = self.ui.select_service(services, usernames, categories)
-                    if not service:
-                        continue
-                    if self.ui.confirm_action(f"🗑️ Удалить {service}?"):
-                        if self.db.delete_password(service, category):
-                            self.ui.display_success(f"🗑️ [green]{service} удален![/green]")
+                with registry.action(action), journal.action(action, vault=self.vault_name) as event:
+                    # Select category for relevant actions
+                    category = None
+                    if action in ["get_password", "edit_password", "delete_password"]:
+                        categories = self.db.get_all_categories()
+                        category = self.ui.select_category(categories)
+                        if category == "Без категории":
+                            category = None
+
+                    if action == "add_password":
+                        data = self.ui.get_password_data()
+                        if not data:
+                            continue
+                        encrypted_password = self.crypto.encrypt_password(data["password"], key)
+                        fingerprint = self.crypto.fingerprint(data["password"], key)
+                        category = data["category"] if data["category"] else None
+                        event.update(service=data["service"], category=category)
+                        if self.db.add_password(data["service"], data["username"], encrypted_password, category,
+                                                fingerprint):
+                            self.ui.display_success(self.ui.messages["saved_success"])
+                        else:
+                            event["outcome"] = CONFLICT
+                            self.ui.display_error(f"Сервис '{data['service']}' уже существует в категории")
+
+                    elif action == "get_password":
+                        service = self.select_service(category)
+                        if not service:
+                            continue
+                        event.update(service=service, category=category)
+                        while True:
+                            sub_action = self.ui.service_menu(service)
+                            if sub_action == "back":
+                                break
+                            # Each step on the entry is journaled on its own: the enclosing action spans the whole menu
+                            with journal.action(f"{action}_{sub_action}", vault=self.vault_name, service=service,
+                                                category=category) as step:
+                                if sub_action == "view":
+                                    try:
+                                        entry = self.get_entry(service, category, key)
+                                    except Exception as e:
+                                        step.update(outcome=ERROR, error=type(e).__name__)
+                                        self.ui.display_error(f"Не удалось расшифровать: вероятно, неверный мастер-пароль")
+                                        continue
+                                    if entry:
+                                        self.ui.display_password(service, entry[0], entry[1], category)
+                                    else:
+                                        step["outcome"] = NOT_FOUND
+                                        self.ui.display_error(self.ui.messages["not_found"])
+                                elif sub_action == "edit":
+                                    data = self.ui.get_password_data()
+                                    if not data:
+                                        continue
+                                    encrypted_password = self.crypto.encrypt_password(data["password"], key)
+                                    fingerprint = self.crypto.fingerprint(data["password"], key)
+                                    if self.db.update_password(service, encrypted_password, category, fingerprint):
+                                        self.ui.display_success(self.ui.messages["saved_success"])
+                                    else:
+                                        step["outcome"] = NOT_FOUND
+                                        self.ui.display_error(f"Сервис '{service}' не найден")
+                                elif sub_action == "history":
+                                    self.version_history(service, category, key)
+                                elif sub_action == "delete":
+                                    if self.ui.confirm_action(f"🗑️ Удалить {service}?"):
+                                        if self.db.delete_password(service, category):
+                                            self.ui.display_success(f"🗑️ [green]{service} удален![/green]")
+                                            break
+                                        else:
+                                            step["outcome"] = NOT_FOUND
+                                            self.ui.display_error(f"Сервис '{service}' не найден")
+
+                    elif action == "generate_password":
+                        data = self.ui.get_password_data(generate=True)
+                        if not data:
+                            continue
+                        password = self.generate_password()
+                        encrypted_password = self.crypto.encrypt_password(password, key)
+                        fingerprint = self.crypto.fingerprint(password, key)
+                        category = data["category"] if data["category"] else None
+                        event.update(service=data["service"], category=category)
+                        if self.db.add_password(data["service"], data["username"], encrypted_password, category,
+                                                fingerprint):
+                            self.ui.display_password(data["service"], data["username"], password, category)
+                        else:
+                            event["outcome"] = CONFLICT
+                            self.ui.display_error(f"Сервис '{data['service']}' уже существует в категории")
+
+                    elif action == "edit_password":
+                        service = self.select_service(category)
+                        if not service:
+                            continue
+                        event.update(service=service, category=category)
+                        data = self.ui.get_password_data()
+                        if not data:
+                            continue
+                        encrypted_password = self.crypto.encrypt_password(data["password"], key)
+                        fingerprint = self.crypto.fingerprint(data["password"], key)
+                        if self.db.update_password(service, encrypted_password, category, fingerprint):
+                            self.ui.display_success(self.ui.messages["saved_success"])
                         else:
+                            event["outcome"] = NOT_FOUND
                             self.ui.display_error(f"Сервис '{service}' не найден")
 
-                elif action == "backup_data":
-                    backup_file = self.db.backup_db()
-                    self.ui.display_success(self.ui.messages["backup_success"].format(file=backup_file))
-
-                elif action == "export_data":
-                    export_file = self.db.export_data()
-                    self.ui.display_success(self.ui.messages["export_success"].format(file=export_file))
-
-                elif action == "import_data":
-                    with open("export.json", "r") as f:
-                        data = json.load(f)
-                    with Progress() as progress:
-                        task = progress.add_task("[cyan]Импорт данных...", total=len(data))
-                        with self.db.connect() as conn:
-                            cursor = conn.cursor()
-                            for entry in data:
-                                cursor.execute(
-                                    "INSERT OR IGNORE INTO passwords (service, username, encrypted_password, category) VALUES (?, ?, ?, ?)",
-                                    (entry["service"], entry["username"], entry["encrypted_password"],
-                                     entry.get("category"))
-                                )
-                                progress.update(task, advance=1)
-                            conn.commit()
-                    self.ui.display_success(self.ui.messages["import_success"].format(file="export.json"))
-
-                elif action == "info":
-                    self.ui.console.print(Panel.fit(
-                        "[bold cyan]Менеджер паролей v3.0[/bold cyan]\n\n"
-                        "🔒 [bold green]Возможности:[/bold green]\n"
-                        "- Шифрование AES-256-GCM\n"
-                        "- Генератор безопасных паролей\n"
-                        "- Полное управление базой данных\n"
-                        "- Резервное копирование и экспорт/импорт\n"
-                        "- Поддержка категорий\n\n"
-                        "⚠️ [bold red]Опасные операции:[/bold red]\n"
-                        "- Удаление всех данных\n"
-                        "- Пересоздание базы данных",
-                        title="ℹ️ Информация",
-                        border_style="cyan"
-                    ))
-
-                elif action == "delete_all":
-                    if self.ui.confirm_action(self.ui.messages["confirm_delete_all"]):
-                        if self.db.delete_db():
-                            self.ui.display_success("🔥 [red]Все данные удалены![/red]")
-                        else:
-                            self.ui.display_error("Не удалось удалить базу данных")
+                    elif action == "delete_password":
+                        service = self.select_service(category)
+                        if not service:
+                            continue
+                        event.update(service=service, category=category)
+                        if self.ui.confirm_action(f"🗑️ Удалить {service}?"):
+                            if self.db.delete_password(service, category):
+                                self.ui.display_success(f"🗑️ [green]{service} удален![/green]")
+                            else:
+                                event["outcome"] = NOT_FOUND
+                                self.ui.display_error(f"Сервис '{service}' не найден")
+
+                    elif action == "backup_data":
+                        backup_file = self.db.backup_db(DIFFERENTIAL)
+                        self.ui.display_success(self.ui.messages["backup_success"].format(file=backup_file))
+
+                    elif action == "export_data":
+                        export_file = self.db.export_data()
+                        self.ui.display_success(self.ui.messages["export_success"].format(file=export_file))
+
+                    elif action == "import_data":
+                        import_file = EXPORT_FILE if os.path.exists(EXPORT_FILE) else LEGACY_EXPORT_FILE
+                        with Progress() as progress:
+                            task = progress.add_task("[cyan]Импорт данных...", total=os.path.getsize(import_file))
+                            self.db.import_data(import_file, progress=lambda size: progress.update(task, advance=size))
+                        self.ui.display_success(self.ui.messages["import_success"].format(file=import_file))
+
+                    elif action == "audit":
+                        from audit import Auditor
+                        strength = self.ui.confirm_action("Оценить силу паролей (потребуется расшифровать все записи)?")
+                        report = Auditor(self.db, self.crypto, key).run(strength=strength)
+                        self.ui.display_audit(report, WEAK_PASSWORD_BITS)
+
+                    elif action == "info":
+                        self.ui.console.print(Panel.fit(
+                            "[bold cyan]Менеджер паролей v3.0[/bold cyan]\n\n"
+                            "🔒 [bold green]Возможности:[/bold green]\n"
+                            "- Шифрование AES-256-GCM\n"
+                            "- Генератор безопасных паролей\n"
+                            "- Полное управление базой данных\n"
+                            "- Резервное копирование и экспорт/импорт\n"
+                            "- Поддержка категорий\n\n"
+                            "⚠️ [bold red]Опасные операции:[/bold red]\n"
+                            "- Удаление всех данных\n"
+                            "- Пересоздание базы данных",
+                            title="ℹ️ Информация",
+                            border_style="cyan"
+                        ))
+
+                    elif action == "delete_all":
+                        if self.ui.confirm_action(self.ui.messages["confirm_delete_all"]):
+                            if self.db.delete_db():
+                                self.ui.display_success("🔥 [red]Все данные удалены![/red]")
+                            else:
+                                self.ui.display_error("Не удалось удалить базу данных")
 
-                elif action == "new_db":
-                    if self.ui.confirm_action(self.ui.messages["confirm_new_db"]):
-                        self.db.delete_db()
-                        self.db.init_db()
-                        self.ui.display_success("🆕 [green]Новая база данных создана![/green]")
+                    elif action == "new_db":
+                        if self.ui.confirm_action(self.ui.messages["confirm_new_db"]):
+                            self.db.delete_db()
+                            self.db.init_db()
+                            self.ui.display_success("🆕 [green]Новая база данных создана![/green]")
 
-                elif action == "change_master_password":
-                    success, new_password = self.change_master_password(key, salt)
-                    if success and new_password:
-                        key = self.crypto.derive_key(new_password, salt)
-                        logger.info("Мастер-пароль успешно изменен")
-                        new_password = " " * len(new_password)  # Очистка памяти
+                    elif action == "change_master_password":
+                        success, new_keys = self.change_master_password(key, salt)
+                        if success and new_keys:
+                            keys = new_keys
+                            key = keys.enc_key
+                            logger.info("Мастер-пароль успешно изменен")
 
-                elif action == "exit":
-                    self.ui.display_success(self.ui.messages["goodbye"])
-                    break
+                    elif action == "exit":
+                        self.ui.display_success(self.ui.messages["goodbye"])
+                        break
 
             except Exception as e:
                 self.ui.display_error(str(e))
                 logger.error(f"Ошибка в действии {action}: {e}")
+            finally:
+                registry.flush()
 
+        self.cache.clear()
         self.db.close()
 
 
 if __name__ == "__main__":
-    manager = PasswordManager()
-    manager.run()
\ No newline at end of file
+    import argparse
+    # Global flags the interactive menu understands; any other argument is a CLI command, which parses them too
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--vault", default=None)
+    parser.add_argument("--keyfile", default=None)
+    parser.add_argument("--profile", action="store_true")
+    args, command = parser.parse_known_args()
+    if command:
+        from cli import main
+        sys.exit(main(manager_factory=PasswordManager))
+    if args.profile:
+        from config import PROFILE_DIR
+        registry.profile_dir = PROFILE_DIR
+    from vaults import get_vault
+    manager = PasswordManager(vault=get_vault(args.vault))
+    if args.keyfile:
+        manager.keyfile_path = args.keyfile
+    manager.run()
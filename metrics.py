@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import datetime
+import logging
+import functools
+import threading
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from config import METRICS_FILE, METRICS_TEXTFILE, METRICS_ENABLED
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; flushes are then not serialized between processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; from sub-millisecond queries to multi-second Argon2 runs
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Phases timed across the code base
+ACTION = "action"
+KDF = "kdf"
+DB = "db"
+CRYPTO = "crypto"
+RENDER = "render"
+
+Key = Tuple[str, str]
+
+# Raw samples kept before they are folded into histograms
+MAX_PENDING = 4096
+
+
+class Histogram:
+    """Counts durations in fixed buckets, plus their count, sum and maximum."""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: "Histogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile as the upper bound of the bucket it falls into."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {"counts": self.counts, "count": self.count, "sum": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        histogram = cls()
+        if len(data["counts"]) == len(BUCKETS):
+            histogram.counts = list(data["counts"])
+        histogram.count = data["count"]
+        histogram.total = data["sum"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class Metrics:
+    """In-process registry of duration histograms keyed by (phase, operation).
+
+    Processes are short-lived, so flush() merges what was observed since the
+    last flush into a JSON state file shared by all runs and rewrites a
+    Prometheus text file from it, ready for node_exporter's textfile collector.
+    With a profile directory set, action() also writes a cProfile dump per action.
+    """
+
+    def __init__(self, enabled: bool = METRICS_ENABLED, state_file: str = None, textfile: str = None):
+        self.enabled = enabled
+        self.state_file = state_file or METRICS_FILE
+        self.textfile = textfile or METRICS_TEXTFILE
+        self.profile_dir: Optional[str] = None
+        self._histograms: Dict[Key, Histogram] = {}
+        # Samples are appended without locking (deque.append is atomic) and folded into histograms later
+        self._pending: Deque[Tuple[str, str, float]] = deque()
+        self._lock = threading.Lock()
+
+    def observe(self, phase: str, operation: str, seconds: float):
+        self._pending.append((phase, operation, seconds))
+        if len(self._pending) >= MAX_PENDING:
+            self._aggregate()
+
+    def _aggregate(self):
+        with self._lock:
+            while True:
+                try:
+                    phase, operation, seconds = self._pending.popleft()
+                except IndexError:
+                    break
+                histogram = self._histograms.get((phase, operation))
+                if histogram is None:
+                    histogram = self._histograms[(phase, operation)] = Histogram()
+                histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, phase: str, operation: str) -> Iterator[None]:
+        """Times the enclosed block."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, operation, time.perf_counter() - start)
+
+    @contextmanager
+    def action(self, name: str) -> Iterator[None]:
+        """Times a dispatched action and profiles it when a profile directory is set."""
+        if self.profile_dir is None:
+            with self.timer(ACTION, name):
+                yield
+            return
+        import cProfile
+        profiler = cProfile.Profile()
+        with self.timer(ACTION, name):
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+        os.makedirs(self.profile_dir, mode=0o700, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        path = os.path.join(self.profile_dir, f"{stamp}_{name}.prof")
+        profiler.dump_stats(path)
+        logger.info(f"Profile of {name} written to {path}")
+
+    def snapshot(self) -> Dict[Key, Histogram]:
+        """Returns a copy of the histograms observed since the last flush."""
+        self._aggregate()
+        with self._lock:
+            copy = {}
+            for key, histogram in self._histograms.items():
+                copy[key] = Histogram()
+                copy[key].merge(histogram)
+            return copy
+
+    def load(self) -> Dict[Key, Histogram]:
+        """Reads the histograms accumulated by earlier flushes."""
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, "r") as f:
+                data = json.load(f)
+            return {(item["phase"], item["operation"]): Histogram.from_dict(item) for item in data}
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Metrics file unreadable, starting over: {e}")
+            return {}
+
+    def flush(self):
+        """Merges new observations into the state file and rewrites the Prometheus text file."""
+        self._aggregate()
+        with self._lock:
+            pending, self._histograms = self._histograms, {}
+        if not pending:
+            return
+        try:
+            with self._file_lock():
+                merged = self.load()
+                for key, histogram in pending.items():
+                    merged.setdefault(key, Histogram()).merge(histogram)
+                self._write(self.state_file, json.dumps(
+                    [dict(phase=phase, operation=operation, **h.to_dict())
+                     for (phase, operation), h in sorted(merged.items())]
+                ))
+                self._write(self.textfile, render_prometheus(merged))
+        except OSError as e:
+            logger.error(f"Failed to write metrics: {e}")
+
+    def discard(self):
+        """Drops observations that have not been flushed yet."""
+        with self._lock:
+            self._pending.clear()
+            self._histograms = {}
+
+    def reset(self):
+        """Forgets all observations, in memory and on disk."""
+        self.discard()
+        for path in (self.state_file, self.textfile):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        with open(self.state_file + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write(path: str, text: str):
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(text)
+        os.replace(tmp_file, path)
+
+
+def render_prometheus(histograms: Dict[Key, Histogram]) -> str:
+    """Formats histograms in the Prometheus text exposition format."""
+    lines = [
+        "# HELP passman_duration_seconds Time spent per phase and operation.",
+        "# TYPE passman_duration_seconds histogram"
+    ]
+    for (phase, operation), histogram in sorted(histograms.items()):
+        labels = f'phase="{phase}",operation="{operation}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'passman_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"passman_duration_seconds_sum{{{labels}}} {histogram.total}")
+        lines.append(f"passman_duration_seconds_count{{{labels}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def summarize(histograms: Dict[Key, Histogram]) -> List[Tuple[str, str, int, float, float, float, float]]:
+    """Returns (phase, operation, count, mean, p50, p95, max) rows sorted by total time, largest first."""
+    rows = []
+    for (phase, operation), h in sorted(histograms.items(), key=lambda item: -item[1].total):
+        mean = h.total / h.count if h.count else 0.0
+        rows.append((phase, operation, h.count, mean, h.quantile(0.5), h.quantile(0.95), h.max))
+    return rows
+
+
+registry = Metrics()
+
+
+def timed(phase: str, operation: str = None) -> Callable:
+    """Decorator recording the duration of every call in the shared registry."""
+    def decorator(func: Callable) -> Callable:
+        name = operation or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(phase, name, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,161 @@
+from typing import Dict, List, Optional, Tuple
+from config import SEARCH_LIMIT, SEARCH_CANDIDATES
+from db import Database, CATEGORY_ID_SQL
+from metrics import timed, DB
+
+SearchResult = Tuple[str, str, Optional[str]]
+Row = Tuple[int, str, str, Optional[str]]
+
+# Matches read per trigram to estimate its frequency
+SAMPLE = 64
+# Trigrams ANDed for a substring lookup and for each half of a fuzzy lookup
+RAREST_TRIGRAMS = 3
+FUZZY_TRIGRAMS = 2
+# Share of entries above which a trigram only slows an AND down instead of narrowing it
+COMMON_TRIGRAM = 0.1
+
+
+class SearchIndex:
+    """Ranked, limited lookups of entries by service, username and category.
+
+    Service prefixes are looked up on the service index first. Queries of three
+    or more characters then take substring matches from the FTS5 trigram index,
+    and when those do not fill the limit, typo-tolerant matches that contain
+    the rarer trigrams of either half of the query. A trigram that occurs in
+    most entries makes FTS5 walk its whole doclist whenever the other terms are
+    selective, so queries are built from the rarest trigrams only, estimated by
+    how far into the rowid range the first few matches reach, and substrings
+    are checked here. Each FTS step reads at most SEARCH_CANDIDATES rows
+    without ORDER BY; the candidates are ranked here.
+    """
+
+    def __init__(self, db: Database, limit: int = SEARCH_LIMIT, candidates: int = SEARCH_CANDIDATES):
+        self.db = db
+        self.limit = limit
+        self.candidates = candidates
+        self._fts = None
+
+    @property
+    def fts_available(self) -> bool:
+        if self._fts is None:
+            self._fts = self.db.table_exists("passwords_fts")
+        return self._fts
+
+    @timed(DB)
+    def search(self, text: str, category: str = None, limit: int = None) -> List[SearchResult]:
+        """Returns up to limit (service, username, category) matches for the text, best first."""
+        limit = limit or self.limit
+        text = text.strip()
+        results = self._prefix(text, category, limit)
+        if len(results) >= limit or len(text) < 3 or not self.fts_available:
+            return [row[1:] for row in results]
+
+        seen = {row[0] for row in results}
+        frequencies = self._frequencies(self._trigrams(text))
+        for rows in (self._substring(text, category, frequencies), self._fuzzy(category, frequencies)):
+            if len(results) >= limit:
+                break
+            candidates = [row for row in rows if row[0] not in seen]
+            candidates.sort(key=lambda row: self._rank(text, row))
+            for row in candidates[:limit - len(results)]:
+                results.append(row)
+                seen.add(row[0])
+        return [row[1:] for row in results]
+
+    @staticmethod
+    def _trigrams(text: str) -> List[str]:
+        text = text.lower()
+        return list(dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2)))
+
+    def _frequencies(self, trigrams: List[str]) -> Dict[str, float]:
+        """Estimates the share of entries containing each trigram from the rowids of its first SAMPLE matches."""
+        connection = self.db.connect()
+        max_rowid = connection.execute("SELECT max(rowid) FROM passwords_fts").fetchone()[0] or 1
+        frequencies = {}
+        for trigram in trigrams:
+            rowids = connection.execute(
+                "SELECT rowid FROM passwords_fts WHERE passwords_fts MATCH ? LIMIT ?",
+                (self._phrase(trigram), SAMPLE)
+            ).fetchall()
+            if len(rowids) < SAMPLE:
+                frequencies[trigram] = len(rowids) / max_rowid
+            else:
+                frequencies[trigram] = SAMPLE / rowids[-1][0]
+        return frequencies
+
+    @staticmethod
+    def _rarest(trigrams: List[str], frequencies: Dict[str, float], count: int) -> Optional[str]:
+        """ANDs up to count of the rarest trigrams that occur at all, skipping common ones after the first."""
+        present = sorted((t for t in trigrams if frequencies[t] > 0), key=frequencies.get)[:count]
+        if not present:
+            return None
+        chosen = present[:1] + [t for t in present[1:] if frequencies[t] <= COMMON_TRIGRAM]
+        return " AND ".join(SearchIndex._phrase(t) for t in chosen)
+
+    def _substring(self, text: str, category: Optional[str], frequencies: Dict[str, float]) -> List[Row]:
+        """Returns entries containing the text, verified here after matching its rarest trigrams."""
+        if not frequencies or min(frequencies.values()) == 0:
+            return []
+        rows = self._match(self._rarest(list(frequencies), frequencies, RAREST_TRIGRAMS), category)
+        text = text.lower()
+        return [row for row in rows if any(text in (field or "").lower() for field in row[1:])]
+
+    def _fuzzy(self, category: Optional[str], frequencies: Dict[str, float]) -> List[Row]:
+        """Returns entries containing the rarer trigrams of either half of the text, tolerating a typo."""
+        trigrams = list(frequencies)
+        if len(trigrams) < 2:
+            return []
+        middle = len(trigrams) // 2
+        halves = [trigrams[:middle], trigrams[middle:]]
+        queries = [self._rarest(half, frequencies, FUZZY_TRIGRAMS) for half in halves]
+        query = " OR ".join(f"({q})" for q in queries if q)
+        return self._match(query, category) if query else []
+
+    @staticmethod
+    def _rank(text: str, row: Row) -> tuple:
+        """Orders candidates: match in service, then username, then category; shorter and more similar first."""
+        text = text.lower()
+        service, username = row[1].lower(), row[2].lower()
+        if text in service:
+            place = 0
+        elif text in username:
+            place = 1
+        elif row[3] and text in row[3].lower():
+            place = 2
+        else:
+            trigrams = {text[i:i + 3] for i in range(len(text) - 2)}
+            shared = sum(1 for trigram in trigrams if trigram in service or trigram in username)
+            place = 3 + len(trigrams) - shared
+        return place, len(service), service
+
+    @staticmethod
+    def _phrase(text: str) -> str:
+        return '"' + text.replace('"', '""') + '"'
+
+    def _match(self, query: str, category: Optional[str]) -> List[Row]:
+        """Returns up to SEARCH_CANDIDATES entries matching an FTS5 query.
+
+        Only rowids come from the index; the columns are read from passwords,
+        which is several times cheaper per row than the FTS content table.
+        """
+        params: list = [query]
+        category_filter = ""
+        if category:
+            category_filter = f" AND (SELECT category_id FROM passwords WHERE id = passwords_fts.rowid) = {CATEGORY_ID_SQL}"
+            params.append(category)
+        params.append(self.candidates)
+        sql = (f"SELECT p.id, p.service, p.username, NULLIF(c.name, '') FROM "
+               f"(SELECT rowid AS id FROM passwords_fts WHERE passwords_fts MATCH ?{category_filter} LIMIT ?) m "
+               f"JOIN passwords p ON p.id = m.id JOIN categories c ON c.id = p.category_id")
+        return self.db.connect().execute(sql, params).fetchall()
+
+    def _prefix(self, text: str, category: Optional[str], limit: int) -> List[Row]:
+        sql = ("SELECT p.id, p.service, p.username, NULLIF(c.name, '') FROM passwords p "
+               "JOIN categories c ON c.id = p.category_id WHERE p.service >= ? AND p.service < ?")
+        params: list = [text, text + "\U0010ffff"]
+        if category:
+            sql += f" AND p.category_id = {CATEGORY_ID_SQL}"
+            params.append(category)
+        sql += " ORDER BY p.service LIMIT ?"
+        params.append(limit)
+        return self.db.connect().execute(sql, params).fetchall()
@@ -0,0 +1,177 @@
+import os
+import mmap
+import time
+import base64
+import bisect
+import hashlib
+import hmac
+import struct
+import logging
+from typing import Iterable, Optional, Tuple
+from db import category_name
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PMSNAP01"
+FORMAT_VERSION = 1
+# magic, format version, reserved, entry count, creation time, key check value
+HEADER = struct.Struct(">8sHHId16s")
+HASH_SIZE = 16
+OFFSET = struct.Struct(">Q")
+USERNAME_LENGTH = struct.Struct(">H")
+IV_SIZE = 12
+
+SnapshotEntry = Tuple[str, Optional[str], str, str]
+
+
+def encode_key(key: bytes) -> str:
+    return base64.urlsafe_b64encode(key).decode().rstrip("=")
+
+
+def decode_key(text: str) -> bytes:
+    try:
+        key = base64.urlsafe_b64decode(text.strip() + "=" * (-len(text.strip()) % 4))
+    except ValueError as e:
+        raise ValueError(f"Invalid snapshot key: {e}")
+    if len(key) != 32:
+        raise ValueError("Invalid snapshot key: expected 32 bytes")
+    return key
+
+
+def _index_key(key: bytes) -> bytes:
+    # The snapshot key is uniformly random, so HMAC alone is a sound KDF and much cheaper to set up than HKDF
+    return hmac.new(key, b"passman snapshot index", hashlib.sha256).digest()
+
+
+def _entry_hash(index_key: bytes, service: str, category: Optional[str]) -> bytes:
+    message = service.encode() + b"\0" + category_name(category).encode()
+    return hmac.new(index_key, message, hashlib.sha256).digest()[:HASH_SIZE]
+
+
+def _check_value(index_key: bytes) -> bytes:
+    return hmac.new(index_key, b"passman snapshot check", hashlib.sha256).digest()[:HASH_SIZE]
+
+
+def compile_snapshot(path: str, entries: Iterable[SnapshotEntry], key: Optional[bytes] = None) -> bytes:
+    """Writes (service, category, username, password) entries to an immutable snapshot file and returns its key.
+
+    Each snapshot gets a fresh random key unless one is given, so a leaked
+    snapshot key opens only that file. The file is written next to path and
+    renamed into place, readable by the owner only.
+    """
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    key = key or os.urandom(32)
+    index_key = _index_key(key)
+    aead = AESGCM(key)
+    records = []
+    for service, category, username, password in entries:
+        entry_hash = _entry_hash(index_key, service, category)
+        username_bytes = username.encode()
+        plaintext = USERNAME_LENGTH.pack(len(username_bytes)) + username_bytes + password.encode()
+        iv = os.urandom(IV_SIZE)
+        # The hash is associated data, so a record moved under another index slot fails to decrypt
+        records.append((entry_hash, iv + aead.encrypt(iv, plaintext, entry_hash)))
+    records.sort(key=lambda record: record[0])
+    for previous, current in zip(records, records[1:]):
+        if previous[0] == current[0]:
+            raise ValueError("Duplicate entry in snapshot")
+
+    tmp_file = path + ".tmp"
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(records), time.time(), _check_value(index_key)))
+            f.write(b"".join(entry_hash for entry_hash, _ in records))
+            offset = 0
+            offsets = [OFFSET.pack(0)]
+            for _, record in records:
+                offset += len(record)
+                offsets.append(OFFSET.pack(offset))
+            f.write(b"".join(offsets))
+            f.write(b"".join(record for _, record in records))
+        os.replace(tmp_file, path)
+    except Exception as e:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise RuntimeError(f"Snapshot write failed: {e}")
+    logger.info(f"Snapshot written: {path}, {len(records)} entries")
+    return key
+
+
+class _HashIndex:
+    """Sequence view of the sorted hash array inside the mapping, for bisect."""
+
+    def __init__(self, data: mmap.mmap, start: int, count: int):
+        self.data = data
+        self.start = start
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        position = self.start + i * HASH_SIZE
+        return self.data[position:position + HASH_SIZE]
+
+
+class Snapshot:
+    """Read-only lookups in a compiled snapshot file.
+
+    The file is memory-mapped and never parsed as a whole. Layout: a fixed
+    header, the sorted array of keyed entry hashes, count + 1 offsets into
+    the record region, then the packed AES-GCM records. A lookup computes
+    the keyed hash of service and category, binary-searches the hash array
+    in place and decrypts the one record it points to, so opening a
+    snapshot and reading a secret costs microseconds and does not depend on
+    the vault size. Service names are stored only as keyed hashes.
+    """
+
+    def __init__(self, path: str, key: bytes):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise RuntimeError(f"Snapshot is empty or unreadable: {e}")
+        try:
+            magic, version, _, self.count, self.created_at, check = HEADER.unpack_from(self._data, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise RuntimeError(f"{path} is not a snapshot of a supported version")
+            self._index_key = _index_key(key)
+            if not hmac.compare_digest(check, _check_value(self._index_key)):
+                raise RuntimeError("Snapshot key does not match")
+            self._offsets = HEADER.size + self.count * HASH_SIZE
+            self._records = self._offsets + (self.count + 1) * OFFSET.size
+            if len(self._data) < self._records:
+                raise RuntimeError("Snapshot is truncated")
+        except Exception:
+            self._data.close()
+            raise
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self._aead = AESGCM(key)
+        self._hashes = _HashIndex(self._data, HEADER.size, self.count)
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, service: str, category: str = None) -> Optional[Tuple[str, str]]:
+        """Returns (username, password) of an entry, or None."""
+        entry_hash = _entry_hash(self._index_key, service, category)
+        i = bisect.bisect_left(self._hashes, entry_hash)
+        if i == self.count or self._hashes[i] != entry_hash:
+            return None
+        start, end = (OFFSET.unpack_from(self._data, self._offsets + j * OFFSET.size)[0] for j in (i, i + 1))
+        record = self._data[self._records + start:self._records + end]
+        try:
+            plaintext = self._aead.decrypt(record[:IV_SIZE], record[IV_SIZE:], entry_hash)
+        except Exception as e:
+            raise RuntimeError(f"Snapshot record decryption failed: {e}")
+        (length,) = USERNAME_LENGTH.unpack_from(plaintext, 0)
+        username_end = USERNAME_LENGTH.size + length
+        return plaintext[USERNAME_LENGTH.size:username_end].decode(), plaintext[username_end:].decode()
+
+    def close(self):
+        self._data.close()
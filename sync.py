@@ -0,0 +1,515 @@
+import os
+import time
+import shutil
+import struct
+import sqlite3
+import hashlib
+import logging
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from config import SYNC_BUCKETS, SYNC_FANOUT
+from db import Database, HOT_QUERIES, CATEGORY_ID_SQL
+from metrics import timed, DB
+
+logger = logging.getLogger(__name__)
+
+# Sides of a sync, as returned by conflict resolvers
+LOCAL = "local"
+REMOTE = "remote"
+
+DIGEST_SIZE = 16
+EMPTY = bytes(DIGEST_SIZE)
+
+# Rows per statement when hashing changes, and buckets or nodes per IN (...) lookup
+SYNC_BATCH = 500
+
+Key = Tuple[str, str]
+
+
+class RowState(NamedTuple):
+    """What a replica holds for a (service, category) key: a live row or a tombstone."""
+    service: str
+    category: str
+    username: str
+    digest: bytes
+    version: int
+    updated_at: float
+    deleted: bool
+
+
+class SyncRow(NamedTuple):
+    """A row or tombstone as it travels between replicas."""
+    service: str
+    category: str
+    username: str
+    encrypted_password: bytes
+    fingerprint: Optional[bytes]
+    updated_at: float
+    deleted: bool
+
+
+class SyncReport:
+    """What a sync compared and moved."""
+
+    def __init__(self):
+        self.buckets = 0
+        self.compared = 0
+        self.pulled = 0
+        self.pushed = 0
+        self.conflicts = 0
+        self.seconds = 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"buckets": self.buckets, "compared": self.compared, "pulled": self.pulled,
+                "pushed": self.pushed, "conflicts": self.conflicts, "seconds": self.seconds}
+
+
+def bucket_of(service: str, buckets: int = SYNC_BUCKETS) -> int:
+    """Returns the Merkle leaf of a service; every replica computes the same one."""
+    return int.from_bytes(hashlib.blake2b(service.encode(), digest_size=8).digest(), "big") % buckets
+
+
+def row_digest(service: str, category: str, username: str, encrypted_password: bytes, deleted: bool) -> bytes:
+    """Digest of what a replica holds for a key; change times and versions are left out."""
+    text = b"\0".join((service.encode(), category.encode(), username.encode()))
+    header = struct.pack(">?II", deleted, len(text), len(encrypted_password))
+    return hashlib.blake2b(header + text + encrypted_password, digest_size=DIGEST_SIZE).digest()
+
+
+def newest(local: RowState, remote: RowState) -> str:
+    """Last writer wins; equal change times are broken by digest so both replicas pick the same side."""
+    return LOCAL if (local.updated_at, local.digest) >= (remote.updated_at, remote.digest) else REMOTE
+
+
+class Replica:
+    """The sync view of one vault database.
+
+    Triggers give every row change the next value of a per-vault counter and
+    turn deletes into tombstones. Rows and tombstones are spread over buckets
+    by a hash of the service, and each keeps the digest of what it holds. The
+    Merkle tree over the buckets is stored node by node in sync_tree, with
+    empty subtrees left out. refresh() finds the rows changed since the
+    previous refresh on the version index and rehashes only their buckets
+    and the paths from those buckets to the root, so a large vault with a
+    few changes has an up-to-date tree in milliseconds.
+    """
+
+    def __init__(self, db: Database, buckets: int = SYNC_BUCKETS, fanout: int = SYNC_FANOUT):
+        depth, size = 0, 1
+        while fanout >= 2 and size < buckets:
+            depth, size = depth + 1, size * fanout
+        if fanout < 2 or depth == 0 or size != buckets:
+            raise ValueError("Sync buckets must be a power of the fanout, with at least two children per node")
+        self.db = db
+        self.buckets = buckets
+        self.fanout = fanout
+        self.depth = depth
+        self.shape = f"{buckets}/{fanout}"
+        # Digests of empty subtrees by level, root level first
+        self._empty = [EMPTY]
+        for _ in range(depth):
+            self._empty.insert(0, hashlib.blake2b(self._empty[0] * fanout, digest_size=DIGEST_SIZE).digest())
+
+    def _meta(self, key: str):
+        return self.db.connect().execute("SELECT value FROM sync_meta WHERE key=?", (key,)).fetchone()[0]
+
+    @property
+    def replica_id(self) -> str:
+        return self._meta("replica_id")
+
+    @property
+    def version(self) -> int:
+        """The latest change version of this replica."""
+        return self._meta("version")
+
+    def peer_version(self, peer: str) -> int:
+        """Returns this replica's version when it last finished a sync with peer, or 0."""
+        row = self.db.connect().execute("SELECT version FROM sync_peers WHERE peer=?", (peer,)).fetchone()
+        return row[0] if row else 0
+
+    def set_peer_version(self, peer: str, version: int):
+        with self.db.transaction() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO sync_peers (peer, version, synced_at) VALUES (?, ?, ?)",
+                           (peer, version, time.time()))
+
+    @timed(DB, "sync_refresh")
+    def refresh(self) -> bytes:
+        """Brings the stored tree up to date and returns the root digest."""
+        connection = self.db.connect()
+        meta = dict(connection.execute(
+            "SELECT key, value FROM sync_meta WHERE key IN ('version', 'tree_version', 'tree_shape')"
+        ).fetchall())
+        if meta["tree_version"] != meta["version"] or meta["tree_shape"] != self.shape:
+            with self.db.transaction() as cursor:
+                since = meta["tree_version"]
+                if meta["tree_shape"] != self.shape:
+                    cursor.execute("DELETE FROM sync_tree")
+                    since = -1
+                dirty = self._assign_digests(cursor, since)
+                self._store_leaves(cursor, dirty)
+                for level in range(self.depth - 1, -1, -1):
+                    dirty = sorted({position // self.fanout for position in dirty})
+                    self._store_nodes(cursor, level, dirty)
+                cursor.execute("UPDATE sync_meta SET value = ? WHERE key = 'tree_version'", (meta["version"],))
+                cursor.execute("UPDATE sync_meta SET value = ? WHERE key = 'tree_shape'", (self.shape,))
+            logger.info(f"Sync tree refreshed from version {since}")
+        return self.nodes(0, [0])[0]
+
+    def _assign_digests(self, cursor: sqlite3.Cursor, since: int) -> List[int]:
+        """Stores bucket and digest of rows and tombstones changed after version since; returns those buckets."""
+        buckets = set()
+        selects = (
+            ("passwords", "id=?",
+             "SELECT p.version, p.id, p.service, c.name, p.username, p.encrypted_password "
+             "FROM passwords p JOIN categories c ON c.id = p.category_id "
+             "WHERE p.version > ? ORDER BY p.version LIMIT ?"),
+            ("sync_tombstones", "service=? AND category=?",
+             "SELECT version, service, category, service, category, '', NULL "
+             "FROM sync_tombstones WHERE version > ? ORDER BY version LIMIT ?"),
+        )
+        for table, where, select in selects:
+            start = since
+            while True:
+                rows = cursor.execute(select, (start, SYNC_BATCH)).fetchall()
+                if not rows:
+                    break
+                start = rows[-1][0]
+                changed = []
+                for row in rows:
+                    service, category, username, blob = row[-4:]
+                    deleted = blob is None
+                    bucket = bucket_of(service, self.buckets)
+                    digest = row_digest(service, category, "" if deleted else username, blob or b"", deleted)
+                    changed.append((bucket, digest) + tuple(row[1:-4]))
+                    buckets.add(bucket)
+                cursor.executemany(f"UPDATE {table} SET sync_bucket=?, sync_digest=? WHERE {where}", changed)
+        return sorted(buckets)
+
+    def _store_leaves(self, cursor: sqlite3.Cursor, buckets: List[int]):
+        for start in range(0, len(buckets), SYNC_BATCH):
+            chunk = buckets[start:start + SYNC_BATCH]
+            held: Dict[int, list] = {bucket: [] for bucket in chunk}
+            for _, state in self._bucket_states(cursor, chunk):
+                held[bucket_of(state.service, self.buckets)].append(state)
+            for bucket, states in held.items():
+                if states:
+                    states.sort(key=lambda state: (state.service, state.category))
+                    digest = hashlib.blake2b(b"".join(state.digest for state in states), digest_size=DIGEST_SIZE).digest()
+                    cursor.execute("INSERT OR REPLACE INTO sync_tree (level, position, digest) VALUES (?, ?, ?)",
+                                   (self.depth, bucket, digest))
+                else:
+                    cursor.execute("DELETE FROM sync_tree WHERE level=? AND position=?", (self.depth, bucket))
+
+    def _store_nodes(self, cursor: sqlite3.Cursor, level: int, positions: List[int]):
+        empty = self._empty[level + 1]
+        for position in positions:
+            first = position * self.fanout
+            cursor.execute("SELECT position, digest FROM sync_tree WHERE level=? AND position BETWEEN ? AND ?",
+                           (level + 1, first, first + self.fanout - 1))
+            children = [empty] * self.fanout
+            stored = cursor.fetchall()
+            for child, digest in stored:
+                children[child - first] = digest
+            if stored:
+                digest = hashlib.blake2b(b"".join(children), digest_size=DIGEST_SIZE).digest()
+                cursor.execute("INSERT OR REPLACE INTO sync_tree (level, position, digest) VALUES (?, ?, ?)",
+                               (level, position, digest))
+            else:
+                cursor.execute("DELETE FROM sync_tree WHERE level=? AND position=?", (level, position))
+
+    def nodes(self, level: int, positions: List[int]) -> List[bytes]:
+        """Returns the digests of tree nodes at level (0 is the root), in the order of positions."""
+        cursor = self.db.connect().cursor()
+        digests = {}
+        for start in range(0, len(positions), SYNC_BATCH):
+            chunk = positions[start:start + SYNC_BATCH]
+            cursor.execute(f"SELECT position, digest FROM sync_tree WHERE level=? "
+                           f"AND position IN ({','.join('?' * len(chunk))})", [level] + chunk)
+            digests.update(cursor.fetchall())
+        return [digests.get(position, self._empty[level]) for position in positions]
+
+    def states(self, buckets: Iterable[int]) -> Dict[Key, RowState]:
+        """Returns what this replica holds in the given buckets, as of the last refresh."""
+        buckets = list(buckets)
+        cursor = self.db.connect().cursor()
+        states = {}
+        for start in range(0, len(buckets), SYNC_BATCH):
+            states.update(self._bucket_states(cursor, buckets[start:start + SYNC_BATCH]))
+        return states
+
+    @staticmethod
+    def _bucket_states(cursor: sqlite3.Cursor, buckets: List[int]) -> List[Tuple[Key, RowState]]:
+        marks = ",".join("?" * len(buckets))
+        cursor.execute(
+            f"SELECT p.service, c.name, p.username, p.sync_digest, p.version, p.updated_at, 0 "
+            f"FROM passwords p JOIN categories c ON c.id = p.category_id WHERE p.sync_bucket IN ({marks}) "
+            f"UNION ALL SELECT service, category, '', sync_digest, version, deleted_at, 1 "
+            f"FROM sync_tombstones WHERE sync_bucket IN ({marks})", buckets + buckets
+        )
+        return [((row[0], row[1]), RowState(*row[:6], bool(row[6]))) for row in cursor.fetchall()]
+
+    def rows(self, keys: Iterable[Key]) -> List[SyncRow]:
+        """Returns the rows or tombstones stored under keys."""
+        connection = self.db.connect()
+        rows = []
+        for service, category in keys:
+            row = connection.execute(
+                f"SELECT username, encrypted_password, fingerprint, updated_at FROM passwords "
+                f"WHERE service=? AND category_id={CATEGORY_ID_SQL}", (service, category)
+            ).fetchone()
+            if row is not None:
+                rows.append(SyncRow(service, category, *row, False))
+                continue
+            row = connection.execute("SELECT deleted_at FROM sync_tombstones WHERE service=? AND category=?",
+                                     (service, category)).fetchone()
+            if row is not None:
+                rows.append(SyncRow(service, category, "", b"", None, row[0], True))
+        return rows
+
+    @timed(DB, "sync_apply")
+    def apply(self, rows: List[SyncRow]) -> int:
+        """Writes rows from another replica in one transaction, keeping their change times.
+
+        Replaced passwords are kept in history. New rows are staged and
+        inserted with a single statement, like imports.
+        """
+        if not rows:
+            return 0
+        category_ids: Dict[str, int] = {}
+        with self.db.transaction() as cursor:
+            inserts = []
+            for row in rows:
+                if row.deleted:
+                    cursor.execute(f"DELETE FROM passwords WHERE service=? AND category_id={CATEGORY_ID_SQL}",
+                                   (row.service, row.category))
+                    cursor.execute("UPDATE sync_meta SET value = value + 1 WHERE key = 'version'")
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO sync_tombstones (service, category, deleted_at, version) "
+                        "VALUES (?, ?, ?, (SELECT value FROM sync_meta WHERE key = 'version'))",
+                        (row.service, row.category, row.updated_at)
+                    )
+                    continue
+                category_id = self.db._category_id(cursor, row.category, category_ids)
+                cursor.execute(HOT_QUERIES["save_history"][0],
+                               (time.time(), row.service, row.category, row.fingerprint, row.fingerprint))
+                cursor.execute("UPDATE sync_meta SET value = value + 1 WHERE key = 'version'")
+                cursor.execute(
+                    "UPDATE passwords SET username=?, encrypted_password=?, fingerprint=?, updated_at=?, "
+                    "version=(SELECT value FROM sync_meta WHERE key = 'version') WHERE service=? AND category_id=?",
+                    (row.username, row.encrypted_password, row.fingerprint, row.updated_at, row.service, category_id)
+                )
+                if cursor.rowcount == 0:
+                    inserts.append((row.service, row.username, row.encrypted_password, category_id,
+                                    row.fingerprint, row.updated_at))
+            if inserts:
+                cursor.execute("CREATE TEMP TABLE IF NOT EXISTS sync_rows (service TEXT, username TEXT, "
+                               "encrypted_password BLOB, category_id INTEGER, fingerprint BLOB, updated_at REAL)")
+                cursor.executemany("INSERT INTO temp.sync_rows VALUES (?, ?, ?, ?, ?, ?)", inserts)
+                cursor.execute(
+                    "INSERT INTO passwords "
+                    "(service, username, encrypted_password, category_id, fingerprint, updated_at, version) "
+                    "SELECT service, username, encrypted_password, category_id, fingerprint, updated_at, "
+                    "(SELECT value FROM sync_meta WHERE key = 'version') + rowid FROM temp.sync_rows ORDER BY rowid"
+                )
+                cursor.execute("UPDATE sync_meta SET value = value + ? WHERE key = 'version'", (len(inserts),))
+                cursor.execute("DELETE FROM temp.sync_rows")
+        self.db._notify_write()
+        return len(rows)
+
+
+class Synchronizer:
+    """Two-way delta sync between a local and a remote replica of the same vault.
+
+    The trees are compared from the root down, reading only the children of
+    nodes whose digests differ, and the keys in differing buckets are compared
+    by their stored digests, so only changed rows are read and copied. A key changed on one
+    side since the replicas last synced is taken from that side; a key
+    changed on both is a conflict and goes to resolve, which returns LOCAL
+    or REMOTE. Ciphertexts are copied as they are, so both replicas must be
+    encrypted with the same key.
+    """
+
+    def __init__(self, local: Replica, remote: Replica,
+                 resolve: Callable[[RowState, RowState], str] = newest):
+        if local.buckets != remote.buckets or local.fanout != remote.fanout:
+            raise ValueError("Replicas must use the same tree shape")
+        self.local = local
+        self.remote = remote
+        self.resolve = resolve
+
+    def differing_buckets(self) -> List[int]:
+        """Refreshes both trees, walks them from the root and returns the leaves whose digests differ."""
+        if self.local.refresh() == self.remote.refresh():
+            return []
+        fanout = self.local.fanout
+        nodes = [0]
+        for level in range(1, self.local.depth + 1):
+            children = [child for node in nodes for child in range(node * fanout, (node + 1) * fanout)]
+            nodes = [child for child, local, remote in
+                     zip(children, self.local.nodes(level, children), self.remote.nodes(level, children))
+                     if local != remote]
+        return nodes
+
+    def run(self, dry_run: bool = False) -> SyncReport:
+        """Syncs both replicas and returns the report; a dry run only counts what would move."""
+        start = time.perf_counter()
+        report = SyncReport()
+        local_id, remote_id = self.local.replica_id, self.remote.replica_id
+        if local_id == remote_id:
+            raise ValueError("Cannot sync a replica with itself")
+        buckets = self.differing_buckets()
+        report.buckets = len(buckets)
+        pull, push = [], []
+        if buckets:
+            local_states, remote_states = self.local.states(buckets), self.remote.states(buckets)
+            local_mark, remote_mark = self.local.peer_version(remote_id), self.remote.peer_version(local_id)
+            for key in local_states.keys() | remote_states.keys():
+                local, remote = local_states.get(key), remote_states.get(key)
+                report.compared += 1
+                if local is None or remote is None:
+                    (push if remote is None else pull).append(key)
+                    continue
+                if local.digest == remote.digest:
+                    continue
+                local_changed, remote_changed = local.version > local_mark, remote.version > remote_mark
+                if local_changed and remote_changed:
+                    report.conflicts += 1
+                    side = self.resolve(local, remote)
+                elif local_changed or remote_changed:
+                    side = LOCAL if local_changed else REMOTE
+                else:
+                    side = newest(local, remote)
+                (push if side == LOCAL else pull).append(key)
+        report.pulled, report.pushed = len(pull), len(push)
+        if not dry_run:
+            self.local.apply(self.remote.rows(sorted(pull)))
+            self.remote.apply(self.local.rows(sorted(push)))
+            self.local.set_peer_version(remote_id, self.local.version)
+            self.remote.set_peer_version(local_id, self.remote.version)
+        report.seconds = time.perf_counter() - start
+        logger.info(f"Sync {'dry run ' if dry_run else ''}finished: {report.to_dict()}")
+        return report
+
+
+class DirectoryRemote:
+    """A replica kept as vault files in a directory, standing in for a remote store.
+
+    The first sync copies the local salt and verifier there and takes an
+    online backup of the local database, which then gets a replica id of its
+    own. Later syncs refuse a directory whose verifier differs from the local
+    one, as its ciphertexts were made with another key; after the local vault
+    changes its master password or Argon2 parameters, rekey() brings the
+    directory over to the new key.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.db_path = os.path.join(directory, "passman.db")
+        self.salt_file = os.path.join(directory, "salt.bin")
+        self.master_hash_file = os.path.join(directory, "master.hash")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.master_hash_file) and os.path.exists(self.db_path)
+
+    def open(self, local_db: Database, salt_file: str, master_hash_file: str) -> Database:
+        """Opens the remote database, creating the remote from the local vault on first use."""
+        if not self.exists():
+            self._create(local_db, salt_file, master_hash_file)
+        with open(master_hash_file, "r") as local, open(self.master_hash_file, "r") as remote:
+            if local.read().strip() != remote.read().strip():
+                raise RuntimeError(f"Vault in {self.directory} is encrypted with another key; sync is only "
+                                   f"possible between copies of the same vault (after a master password or Argon2 "
+                                   f"parameter change, re-key the copy with sync --rekey)")
+        db = Database(self.db_path, backup_dir=os.path.join(self.directory, "backups"))
+        db.init_db()
+        return db
+
+    def _create(self, local_db: Database, salt_file: str, master_hash_file: str):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        try:
+            with local_db.pool.writer() as source:
+                target = sqlite3.connect(self.db_path)
+                try:
+                    source.backup(target)
+                    target.execute("UPDATE sync_meta SET value = lower(hex(randomblob(16))) WHERE key = 'replica_id'")
+                    target.execute("DELETE FROM sync_peers")
+                    target.commit()
+                finally:
+                    target.close()
+            shutil.copyfile(salt_file, self.salt_file)
+            shutil.copyfile(master_hash_file, self.master_hash_file)
+        except Exception as e:
+            for path in (self.db_path, self.salt_file, self.master_hash_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise RuntimeError(f"Remote vault creation failed: {e}")
+        logger.info(f"Remote vault created in {self.directory}")
+
+    def rekey(self, local_db: Database, salt_file: str, master_hash_file: str, crypto, key: bytes,
+              remote_password: str) -> bool:
+        """Re-encrypts the remote with the local vault's key; returns False if remote_password is wrong.
+
+        crypto and key are the local vault's Crypto and encryption key, and
+        remote_password is the master password the remote was last synced
+        under. Rows that hold the same entry as the local vault take its
+        ciphertext, so the next sync finds them equal; the other rows and the
+        history are re-encrypted and keep their change times. The local salt
+        and verifier replace the remote ones only after the new ciphertexts
+        are committed, and a remote that already opens with key just gets
+        them, so an interrupted re-key is finished by running it again.
+        """
+        from crypto import Crypto
+        if not self.exists():
+            raise RuntimeError(f"No vault in {self.directory}")
+        db = Database(self.db_path, backup_dir=os.path.join(self.directory, "backups"))
+        try:
+            db.init_db()
+            sample = db.get_encrypted_sample()
+            if sample is not None and not self._opens(crypto, sample, key):
+                remote_crypto = Crypto(self.salt_file, self.master_hash_file, crypto.params,
+                                       keyfile_path=crypto.keyfile_path)
+                old_keys = remote_crypto.unlock(remote_password, remote_crypto.get_salt())
+                if old_keys is None:
+                    return False
+                self._reencrypt(local_db, db, crypto, old_keys.enc_key, key)
+            for source, target in ((salt_file, self.salt_file), (master_hash_file, self.master_hash_file)):
+                shutil.copyfile(source, target + ".tmp")
+                os.replace(target + ".tmp", target)
+        except Exception as e:
+            raise RuntimeError(f"Remote vault re-key failed: {e}")
+        finally:
+            db.close()
+        logger.info(f"Remote vault in {self.directory} re-keyed")
+        return True
+
+    @staticmethod
+    def _opens(crypto, encrypted: bytes, key: bytes) -> bool:
+        try:
+            crypto.decrypt_password(encrypted, key)
+            return True
+        except RuntimeError:
+            return False
+
+    @staticmethod
+    def _reencrypt(local_db: Database, db: Database, crypto, old_key: bytes, key: bytes):
+        select = ("SELECT p.id, p.service, c.name, p.username, p.encrypted_password, p.fingerprint "
+                  "FROM passwords p JOIN categories c ON c.id = p.category_id")
+        local = {(row[1], row[2]): row[3:] for row in local_db.connect().execute(select)}
+        entries = db.connect().execute(select).fetchall()
+        passwords = crypto.decrypt_many((row[4] for row in entries), old_key)
+        matches = [local.get((row[1], row[2])) for row in entries]
+        matched = [i for i, match in enumerate(matches) if match is not None and match[0] == entries[i][3]]
+        local_passwords = dict(zip(matched, crypto.decrypt_many((matches[i][1] for i in matched), key)))
+        rows, changed = [], []
+        for i, row in enumerate(entries):
+            if local_passwords.get(i) == passwords[i]:
+                rows.append((matches[i][1], matches[i][2], row[0]))
+            else:
+                changed.append(i)
+        changed_passwords = [passwords[i] for i in changed]
+        rows.extend(zip(crypto.encrypt_many(changed_passwords, key), crypto.fingerprint_many(changed_passwords, key),
+                        (entries[i][0] for i in changed)))
+        history = db.get_all_encrypted("password_history")
+        history_passwords = crypto.decrypt_many((encrypted for _, encrypted in history), old_key)
+        history_rows = zip(crypto.encrypt_many(history_passwords, key), crypto.fingerprint_many(history_passwords, key),
+                           (entry_id for entry_id, _ in history))
+        db.update_encrypted_many(rows, list(history_rows))
@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+import pytest
+
+# config resolves every file path when it is first imported: point them at a scratch home before any test imports it
+os.environ["PASSMAN_HOME"] = tempfile.mkdtemp(prefix="passman-tests-")
+for name in [name for name in os.environ if name.startswith("PASSMAN_") and name != "PASSMAN_HOME"]:
+    del os.environ[name]
+
+
+@pytest.fixture
+def db(tmp_path):
+    """An empty vault database in a temporary directory."""
+    from db import Database
+    database = Database(str(tmp_path / "vault.db"))
+    database.init_db()
+    yield database
+    database.close()
@@ -0,0 +1,180 @@
+import hashlib
+import os
+import sqlite3
+
+import pytest
+
+from backup import BackupManager, FULL, DIFFERENTIAL, INCREMENTAL
+from db import Database
+
+ENTRIES = 2000
+CATEGORIES = ("work", "home", "bank")
+# SQLite header fields the backup API bumps in its copy: file change counter, schema cookie, version-valid-for
+SQLITE_COUNTERS = ((24, 28), (40, 44), (92, 96))
+
+
+def database_digest(path: str) -> str:
+    """SHA-256 of a database image with the header counters zeroed, so a backup compares equal to its source."""
+    with open(path, "rb") as f:
+        image = bytearray(f.read())
+    for start, end in SQLITE_COUNTERS:
+        image[start:end] = bytes(end - start)
+    return hashlib.sha256(image).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def change_vault(db_path: str, round_number: int):
+    db = Database(db_path)
+    db.add_passwords([(f"new{round_number}-{i}", "user", os.urandom(48), None, None) for i in range(ENTRIES // 20)])
+    for i in range(round_number, ENTRIES, 50):
+        db.update_password(f"site{i}", os.urandom(48), CATEGORIES[i % len(CATEGORIES)])
+    for i in range(round_number, ENTRIES, 97):
+        db.delete_password(f"site{i}", CATEGORIES[i % len(CATEGORIES)])
+    db.close()
+
+
+@pytest.fixture
+def chain(tmp_path):
+    """A vault backed up as full -> differential -> incremental -> incremental, with each live digest."""
+    db_path = str(tmp_path / "vault.db")
+    backups = BackupManager(db_path, str(tmp_path / "backups"), step_sleep=0)
+    db = Database(db_path)
+    db.init_db()
+    db.add_passwords([(f"site{i}", f"user{i}", os.urandom(48), CATEGORIES[i % len(CATEGORIES)], None)
+                      for i in range(ENTRIES)])
+    db.close()
+    taken = []
+    for round_number, kind in enumerate((FULL, DIFFERENTIAL, INCREMENTAL, INCREMENTAL)):
+        if round_number:
+            change_vault(db_path, round_number)
+        # Closing the last connection checkpoints the WAL, so the file holds the whole database
+        taken.append((backups.create(kind), kind, database_digest(db_path)))
+    return backups, taken
+
+
+def test_chain_has_the_requested_kinds(chain):
+    backups, taken = chain
+    assert [backups.load_manifest(name)["kind"] for name, _, _ in taken] == [kind for _, kind, _ in taken]
+
+
+def test_every_backup_restores_byte_identical(chain, tmp_path):
+    backups, taken = chain
+    restored = str(tmp_path / "restored.db")
+    for name, _, live_digest in taken:
+        assert backups.verify(name)
+        backups.restore(name, restored)
+        assert file_digest(restored) == backups.load_manifest(name)["sha256"]
+        assert database_digest(restored) == live_digest
+
+
+def test_corrupted_delta_fails_to_verify(chain):
+    backups, taken = chain
+    name = taken[-1][0]
+    with open(os.path.join(backups.backup_dir, f"{name}.pages"), "r+b") as f:
+        f.seek(100)
+        byte = f.read(1)
+        f.seek(100)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    assert not backups.verify(name)
+    with pytest.raises(RuntimeError):
+        backups.restore(name, os.path.join(backups.backup_dir, "restored.db"))
+
+
+@pytest.fixture
+def vault(tmp_path):
+    """A vault with a full backup taken."""
+    db_path = str(tmp_path / "vault.db")
+    db = Database(db_path)
+    db.init_db()
+    db.add_passwords([(f"site{i}", f"user{i}", os.urandom(48), CATEGORIES[i % len(CATEGORIES)], None)
+                      for i in range(ENTRIES)])
+    db.close()
+    backups = BackupManager(db_path, str(tmp_path / "backups"), step_sleep=0)
+    backups.create(FULL)
+    return db_path, backups
+
+
+def test_small_change_writes_a_small_delta(vault):
+    db_path, backups = vault
+    db = Database(db_path)
+    db.update_password("site7", os.urandom(48), CATEGORIES[7 % len(CATEGORIES)])
+    name = backups.create(INCREMENTAL)
+    manifest = backups.load_manifest(name)
+    assert manifest["kind"] == INCREMENTAL
+    assert manifest["changed_pages"] < manifest["page_count"] // 10
+    delta_size = os.path.getsize(os.path.join(backups.backup_dir, f"{name}.pages"))
+    assert delta_size == manifest["changed_pages"] * (manifest["page_size"] + 4)
+    assert not os.path.exists(os.path.join(backups.backup_dir, f"{name}.db"))
+    db.close()
+    assert backups.verify(name)
+
+
+def test_delta_behind_an_old_reader_is_consistent(vault, tmp_path):
+    db_path, backups = vault
+    # An open read transaction keeps the checkpoint from copying the later writes into the file
+    reader = sqlite3.connect(db_path, isolation_level=None)
+    reader.execute("BEGIN")
+    reader.execute("SELECT count(*) FROM passwords").fetchone()
+    change_vault(db_path, 1)
+    name = backups.create(DIFFERENTIAL)
+    reader.close()
+    restored = str(tmp_path / "restored.db")
+    backups.restore(name, restored)
+    check, live = Database(restored), Database(db_path)
+    assert check.count_entries() == live.count_entries()
+    check.close()
+    live.close()
+
+
+@pytest.fixture
+def keyed_vault(tmp_path):
+    """A vault whose backups keep its salt and verifier, with one full backup taken."""
+    db_path = str(tmp_path / "vault.db")
+    key_files = (str(tmp_path / "salt.bin"), str(tmp_path / "master.hash"))
+    for path, content in zip(key_files, (b"salt-1", b"verifier-1")):
+        with open(path, "wb") as f:
+            f.write(content)
+    db = Database(db_path)
+    db.init_db()
+    db.add_passwords([(f"site{i}", f"user{i}", os.urandom(48), None, None) for i in range(100)])
+    db.close()
+    backups = BackupManager(db_path, str(tmp_path / "backups"), step_sleep=0, key_files=key_files)
+    return db_path, key_files, backups, backups.create(FULL)
+
+
+def test_restore_keeps_the_replaced_database(keyed_vault):
+    db_path, _, backups, name = keyed_vault
+    change_vault(db_path, 1)
+    changed = database_digest(db_path)
+    previous = backups.restore(name)
+    assert file_digest(db_path) == backups.load_manifest(name)["sha256"]
+    assert backups.load_manifest(previous)["kind"] == FULL
+    assert database_digest(os.path.join(backups.backup_dir, f"{previous}.db")) == changed
+
+
+def test_restore_under_another_verifier_needs_its_keys(keyed_vault):
+    db_path, key_files, backups, name = keyed_vault
+    for path, content in zip(key_files, (b"salt-2", b"verifier-2")):
+        with open(path, "wb") as f:
+            f.write(content)
+    before = file_digest(db_path)
+    with pytest.raises(RuntimeError, match="another master password"):
+        backups.restore(name)
+    assert file_digest(db_path) == before
+    backups.restore(name, with_keys=True)
+    for path, content in zip(key_files, (b"salt-1", b"verifier-1")):
+        with open(path, "rb") as f:
+            assert f.read() == content
+
+
+def test_restore_refuses_an_open_database(keyed_vault):
+    db_path, _, backups, name = keyed_vault
+    db = Database(db_path)
+    db.count_entries()
+    with pytest.raises(RuntimeError, match="in use"):
+        backups.restore(name)
+    db.close()
@@ -0,0 +1,10 @@
+import pytest
+
+from db import HOT_QUERIES
+
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_seeks_through_an_index(db, name):
+    details = db.query_plans()[name]
+    assert any(detail.startswith("SEARCH") for detail in details), details
+    assert not [detail for detail in details if detail.startswith("SCAN passwords")], details
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from crypto import Crypto
+from db import CONFLICT_POLICIES
+from importers import Importer, CSV
+
+ENTRIES = 200
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / "import.csv"
+    with open(path, "w", newline="") as f:
+        f.write("name,url,username,password,folder\n")
+        for i in range(ENTRIES):
+            f.write(f"site{i}.example.com,https://site{i}.example.com/,user{i},pw-{i},{('work', 'home')[i % 2]}\n")
+    return str(path)
+
+
+def sync_version(db):
+    with db.connect() as conn:
+        return conn.execute("SELECT value FROM sync_meta WHERE key = 'version'").fetchone()[0]
+
+
+@pytest.mark.parametrize("dry_run", [True, False])
+@pytest.mark.parametrize("policy", CONFLICT_POLICIES)
+def test_reimport_where_every_entry_conflicts(db, csv_file, policy, dry_run):
+    key = os.urandom(32)
+    first = Importer(db, Crypto(), key).import_file(csv_file, CSV)
+    assert first.inserted == ENTRIES
+    version = sync_version(db)
+
+    result = Importer(db, Crypto(), key).import_file(csv_file, CSV, policy, dry_run)
+
+    assert result.inserted == 0
+    assert result.conflicts == ENTRIES
+    assert sync_version(db) is not None and sync_version(db) >= version
+
+
+def test_add_no_passwords_succeeds(db):
+    assert db.add_passwords([])
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from config import ARGON2_PARAMS, ARGON2_MIN_MEMORY_KIB, ARGON2_MIN_TIME_COST
+from crypto import Crypto
+from manager import PasswordManager
+from sync import DirectoryRemote, Replica, Synchronizer
+
+PARAMS = dict(ARGON2_PARAMS, time_cost=ARGON2_MIN_TIME_COST, memory_cost=ARGON2_MIN_MEMORY_KIB, parallelism=1)
+ENTRIES = 50
+
+
+@pytest.fixture
+def synced(tmp_path):
+    """A vault synced once with a copy in a directory: (manager, keys, remote)."""
+    crypto = Crypto(str(tmp_path / "salt.bin"), str(tmp_path / "master.hash"), PARAMS)
+    manager = PasswordManager(str(tmp_path / "local.db"), crypto=crypto)
+    keys = manager.unlock("old password", crypto.get_salt())
+    passwords = [f"password{i}" for i in range(ENTRIES)]
+    manager.db.add_passwords([(f"site{i}", "user", encrypted, None, None)
+                              for i, encrypted in enumerate(crypto.encrypt_many(passwords, keys.enc_key))])
+    remote = DirectoryRemote(str(tmp_path / "remote"))
+    sync(manager, remote)
+    yield manager, keys, remote
+    manager.db.close()
+
+
+def sync(manager, remote):
+    remote_db = remote.open(manager.db, manager.crypto.salt_file, manager.crypto.master_hash_file)
+    try:
+        return Synchronizer(Replica(manager.db), Replica(remote_db)).run()
+    finally:
+        remote_db.close()
+
+
+def test_rekey_lets_sync_resume_after_password_change(synced):
+    manager, keys, remote = synced
+    crypto = manager.crypto
+    remote_db = remote.open(manager.db, crypto.salt_file, crypto.master_hash_file)
+    time.sleep(0.01)
+    remote_db.update_password("site3", crypto.encrypt_password("edited remotely", keys.enc_key))
+    remote_db.close()
+    ok, new_keys = manager.change_master_password(keys.enc_key, crypto.get_salt(), "new password")
+    assert ok
+    with pytest.raises(RuntimeError):
+        sync(manager, remote)
+
+    assert not remote.rekey(manager.db, crypto.salt_file, crypto.master_hash_file, crypto, new_keys.enc_key,
+                            "wrong password")
+    assert remote.rekey(manager.db, crypto.salt_file, crypto.master_hash_file, crypto, new_keys.enc_key,
+                        "old password")
+    report = sync(manager, remote)
+    # Only the entry edited in the copy differs; the rest took the local ciphertexts during the re-key
+    assert (report.pulled, report.pushed) == (1, 0)
+    entry = manager.db.get_password("site3")
+    assert crypto.decrypt_password(entry["encrypted_password"], new_keys.enc_key) == "edited remotely"
+    assert sync(manager, remote).compared == 0
+    remote_crypto = Crypto(remote.salt_file, remote.master_hash_file, PARAMS)
+    assert remote_crypto.unlock("new password", remote_crypto.get_salt()).enc_key == new_keys.enc_key
+
+
+def test_rekey_is_finished_by_running_it_again(synced):
+    manager, keys, remote = synced
+    crypto = manager.crypto
+    with open(remote.master_hash_file, "rb") as f:
+        old_verifier = f.read()
+    _, new_keys = manager.change_master_password(keys.enc_key, crypto.get_salt(), "new password")
+    assert remote.rekey(manager.db, crypto.salt_file, crypto.master_hash_file, crypto, new_keys.enc_key,
+                        "old password")
+    # A re-key interrupted after the ciphertexts were committed leaves the old verifier in the copy
+    with open(remote.master_hash_file, "wb") as f:
+        f.write(old_verifier)
+    with pytest.raises(RuntimeError):
+        sync(manager, remote)
+    assert remote.rekey(manager.db, crypto.salt_file, crypto.master_hash_file, crypto, new_keys.enc_key,
+                        "any password")
+    assert sync(manager, remote).pulled == 0
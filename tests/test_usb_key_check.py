@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from usb_key_check import (KEY_FILENAME, MAX_KEYFILE_SIZE, MountTable, find_keyfiles, parse_mountinfo,
+                           read_keyfile)
+
+DEVICES = {
+    "8:1": "devices/pci0000:00/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block/sda/sda1",
+    "8:17": "devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1:1.0/host6/target6:0:0/6:0:0:0/block/sdb/sdb1",
+    "8:33": "devices/pci0000:00/0000:00:14.0/usb2/2-2/2-2:1.0/host7/target7:0:0/7:0:0:0/block/sdc/sdc1",
+}
+
+
+def mount_line(mount_id: int, device: str, mount_point: str, fs_type: str) -> str:
+    escaped = mount_point.replace(" ", "\\040")
+    return f"{mount_id} 1 {device} / {escaped} rw,relatime shared:{mount_id} - {fs_type} /dev/x rw\n"
+
+
+class FakeSystem:
+    """A mountinfo file and a /sys/dev/block tree in a temporary directory."""
+
+    def __init__(self, root):
+        self.sysfs = str(root / "sys")
+        os.makedirs(os.path.join(self.sysfs, "dev", "block"))
+        for device, target in DEVICES.items():
+            os.makedirs(os.path.join(self.sysfs, target))
+            os.symlink(os.path.join(self.sysfs, target), os.path.join(self.sysfs, "dev", "block", device))
+        self.drive = str(root / "media" / "USB DRIVE")
+        self.second = str(root / "media" / "second")
+        for directory in (self.drive, self.second):
+            os.makedirs(directory)
+        self.mountinfo = str(root / "mountinfo")
+        self.base = [mount_line(21, "8:1", "/", "ext4"), mount_line(22, "0:45", "/run", "tmpfs")]
+        self.write(self.base + [mount_line(23, "8:17", self.drive, "vfat")])
+
+    def write(self, lines):
+        with open(self.mountinfo, "w") as f:
+            f.writelines(lines)
+
+    def table(self) -> MountTable:
+        return MountTable(self.mountinfo, self.sysfs)
+
+
+@pytest.fixture
+def system(tmp_path):
+    return FakeSystem(tmp_path)
+
+
+def test_parse_mountinfo_unescapes_mount_points():
+    assert parse_mountinfo(mount_line(23, "8:17", "/media/USB DRIVE", "vfat")) == [("8:17", "/media/USB DRIVE")]
+
+
+def test_only_usb_partitions_are_usb_mounts(system):
+    table = system.table()
+    assert table.usb_mounts() == [system.drive]
+    assert table.is_usb("8:17") and not table.is_usb("8:1")
+    table.close()
+
+
+def test_keyfile_is_found_on_the_drive(system):
+    with open(os.path.join(system.drive, KEY_FILENAME), "wb") as f:
+        f.write(os.urandom(64))
+    table = system.table()
+    assert find_keyfiles(table=table) == [os.path.join(system.drive, KEY_FILENAME)]
+    table.close()
+
+
+def test_unchanged_mount_table_is_not_read_again(system):
+    table = system.table()
+    assert table.usb_mounts() == [system.drive]
+    # Same inode, size and mtime: only a real mount change may make the table re-read the file
+    stat = os.stat(system.mountinfo)
+    system.write(system.base + [mount_line(23, "8:17", system.drive.replace("USB", "XYZ"), "vfat")])
+    os.utime(system.mountinfo, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert table.usb_mounts() == [system.drive]
+    table.close()
+
+
+def test_mount_and_unmount_invalidate_the_cache(system):
+    table = system.table()
+    assert table.usb_mounts() == [system.drive]
+    system.write(system.base + [mount_line(23, "8:17", system.drive, "vfat"),
+                                mount_line(24, "8:33", system.second, "exfat")])
+    assert table.usb_mounts() == [system.drive, system.second]
+    system.write(system.base)
+    assert table.usb_mounts() == []
+    table.close()
+
+
+def test_oversized_keyfile_is_rejected(system):
+    path = os.path.join(system.drive, KEY_FILENAME)
+    with open(path, "wb") as f:
+        f.truncate(MAX_KEYFILE_SIZE + 1)
+    with pytest.raises(RuntimeError):
+        read_keyfile(path)
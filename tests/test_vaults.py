@@ -0,0 +1,70 @@
+import base64
+
+import pytest
+
+from config import ARGON2_PARAMS, ARGON2_MIN_MEMORY_KIB, ARGON2_MIN_TIME_COST
+from crypto import Crypto
+from manager import PasswordManager
+from vaults import Keyring, Vault, requires_keyfile
+
+PARAMS = dict(ARGON2_PARAMS, time_cost=ARGON2_MIN_TIME_COST, memory_cost=ARGON2_MIN_MEMORY_KIB, parallelism=1)
+PASSWORD = "vault password"
+
+
+@pytest.fixture
+def vault(tmp_path):
+    directory = tmp_path / "work"
+    return Vault("work", str(directory / "passman.db"), str(directory / "salt.bin"),
+                 str(directory / "master.hash"), str(directory / "backups"), str(directory / "agent.sock"))
+
+
+@pytest.fixture
+def keyring(tmp_path):
+    keyring = Keyring(str(tmp_path / "keyring"), params=PARAMS)
+    assert keyring.unlock("keyring password")
+    return keyring
+
+
+def open_manager(vault, keyfile_path=None):
+    crypto = Crypto(vault.salt_file, vault.master_hash_file, PARAMS, keyfile_path=keyfile_path)
+    return PasswordManager(crypto=crypto, vault=vault)
+
+
+def test_enrolled_key_opens_vault(vault, keyring):
+    manager = open_manager(vault)
+    keys = manager.unlock(PASSWORD, manager.crypto.get_salt())
+    manager.db.close()
+    keyring.add(vault, keys.enc_key)
+    assert keyring.key_for(vault) == keys.enc_key
+
+
+def test_keyfile_vault_is_not_enrolled(vault, keyring, tmp_path):
+    keyfile = tmp_path / "passman.key"
+    keyfile.write_bytes(b"k" * 64)
+    manager = open_manager(vault)
+    salt = manager.crypto.get_salt()
+    keys = manager.set_keyfile(PASSWORD, salt, manager.unlock(PASSWORD, salt), keyfile.read_bytes())
+    manager.db.close()
+    assert requires_keyfile(vault)
+    with pytest.raises(RuntimeError):
+        keyring.add(vault, keys.enc_key)
+    assert keyring.names() == []
+
+
+def test_keyfile_vault_ignores_existing_enrolment(vault, keyring, tmp_path):
+    keyfile = tmp_path / "passman.key"
+    keyfile.write_bytes(b"k" * 64)
+    manager = open_manager(vault)
+    salt = manager.crypto.get_salt()
+    keys = manager.set_keyfile(PASSWORD, salt, manager.unlock(PASSWORD, salt), keyfile.read_bytes())
+    manager.db.close()
+    # A key enrolled before keyring enrolment of keyfile vaults was refused, with a current verifier
+    iv = b"\0" * 12
+    sealed = keyring._aead().encrypt(iv, keys.enc_key, vault.name.encode())
+    with open(vault.master_hash_file) as f:
+        verifier = f.read().strip()
+    keyring._save({vault.name: {"key": base64.b64encode(iv + sealed).decode(), "verifier": verifier}})
+    assert keyring.key_for(vault) is None
+    # The keyfile still opens the vault
+    crypto = Crypto(vault.salt_file, vault.master_hash_file, PARAMS, keyfile_path=str(keyfile))
+    assert crypto.unlock(PASSWORD, salt).enc_key == keys.enc_key
@@ -1,14 +1,31 @@
 import time
-import yaml
-import os
-from typing import List, Optional
+import datetime
+from typing import Callable, List, Optional, Tuple
 from rich.console import Console
 from rich.panel import Panel
 from rich.progress import Progress
 from rich.table import Table
 from questionary import select, prompt, Style, autocomplete
+from prompt_toolkit.completion import Completer, Completion
 import pyperclip
-from config import CONFIG_FILE, DEFAULT_CONFIG
+from config import WEAK_PASSWORD_BITS, STRONG_PASSWORD_BITS, settings
+from generator import estimate_entropy
+from metrics import timed, RENDER
+
+SearchFunction = Callable[[str], List[Tuple[str, str, Optional[str]]]]
+
+
+class SearchCompleter(Completer):
+    """Автодополнение, запрашивающее поисковый индекс при каждом вводе символа."""
+
+    def __init__(self, search: SearchFunction):
+        self.search = search
+
+    def get_completions(self, document, complete_event):
+        text = document.text_before_cursor
+        for service, username, category in self.search(text):
+            yield Completion(service, start_position=-len(text),
+                             display_meta=f"{username} · {category or 'Без категории'}")
 
 
 class UI:
@@ -16,11 +33,8 @@ class UI:
 
     def __init__(self):
         self.console = Console()
-        # Load configuration
-        self.config = DEFAULT_CONFIG
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, "r") as f:
-                self.config.update(yaml.safe_load(f) or {})
+        # A copy: the interface never changes the shared settings
+        self.config = {"ui": settings.section("ui")}
         self.messages = {
             "ru": {
                 "enter_master_password": "🔑 Введите мастер-пароль: ",
@@ -108,6 +122,7 @@ class UI:
                 {"name": "📤 Экспортировать данные (сохранить в JSON) [7]", "value": "export_data", "key": "7"},
                 {"name": "📥 Импортировать данные (загрузить из JSON) [8]", "value": "import_data", "key": "8"},
                 {"name": "ℹ️  Информация (показать справку) [9]", "value": "info", "key": "9"},
+                {"name": "🛡️  Аудит паролей (повторы и слабые пароли) [a]", "value": "audit", "key": "a"},
                 {"name": "🔥 Удалить все данные (очистить базу) [0]", "value": "delete_all", "key": "0"},
                 {"name": "♻️ Новая база данных (пересоздать базу) [n]", "value": "new_db", "key": "n"},
                 {"name": f"{self.messages['change_master_password']} [c]", "value": "change_master_password",
@@ -175,23 +190,23 @@ class UI:
             return None
         return data["new_password"]
 
-    def check_password_strength(self, password: str) -> str:
-        """Проверяет силу пароля и возвращает цветной результат."""
-        score = 0
-        if len(password) >= 8:
-            score += 1
-        if any(c.isupper() for c in password):
-            score += 1
-        if any(c.isdigit() for c in password):
-            score += 1
-        if any(c in "!@#$%^&*" for c in password):
-            score += 1
-        if score == 1:
-            return "[red]Слабый[/red]"
-        elif score == 2:
-            return "[yellow]Средний[/yellow]"
-        return "[green]Сильный[/green]"
+    def check_password_strength(self, password: str, bits: float = None) -> str:
+        """Возвращает цветную оценку силы пароля с энтропией в битах.
+
+        Для сгенерированных паролей передается точная энтропия политики, для
+        введенных вручную она оценивается по использованным классам символов.
+        """
+        if bits is None:
+            bits = estimate_entropy(password)
+        if bits < WEAK_PASSWORD_BITS:
+            label = "[red]Слабый[/red]"
+        elif bits < STRONG_PASSWORD_BITS:
+            label = "[yellow]Средний[/yellow]"
+        else:
+            label = "[green]Сильный[/green]"
+        return f"{label} ({bits:.0f} бит)"
 
+    @timed(RENDER)
     def display_services(self, services: List[str], usernames: List[str], categories: List[str]):
         """Отображает список сервисов в виде таблицы."""
         table = Table(title="Доступные сервисы", show_header=True, header_style="bold cyan")
@@ -202,15 +217,50 @@ class UI:
             table.add_row(service, username, category or "Без категории")
         self.console.print(table)
 
-    def select_service(self, services: List[str], usernames: List[str], categories: List[str]) -> Optional[str]:
-        """Запрашивает у пользователя выбор сервиса с использованием автодополнения."""
-        if not services:
+    @timed(RENDER)
+    def display_audit(self, report, threshold: float):
+        """Отображает отчет аудита: группы повторяющихся паролей и слабые пароли."""
+        self.console.print(f"Записей: {report.total}")
+        table = Table(title=f"Повторно используемые пароли: {report.reused_entries}", show_header=True,
+                      header_style="bold cyan")
+        table.add_column("Группа", style="yellow")
+        table.add_column("Сервис", style="cyan")
+        table.add_column("Имя пользователя", style="green")
+        table.add_column("Категория", style="magenta")
+        for number, group in enumerate(report.reused, start=1):
+            for service, username, category in group:
+                table.add_row(str(number), service, username, category or "Без категории")
+        self.console.print(table)
+        if report.weak is None:
+            return
+        table = Table(title=f"Слабые пароли (менее {threshold:.0f} бит): {len(report.weak)}", show_header=True,
+                      header_style="bold cyan")
+        table.add_column("Сервис", style="cyan")
+        table.add_column("Имя пользователя", style="green")
+        table.add_column("Категория", style="magenta")
+        table.add_column("Энтропия", style="red", justify="right")
+        for service, username, category, bits in report.weak:
+            table.add_row(service, username, category or "Без категории", f"{bits:.0f} бит")
+        self.console.print(table)
+
+    def select_service(self, search: SearchFunction, total: int) -> Optional[str]:
+        """Запрашивает у пользователя выбор сервиса с поиском по мере ввода.
+
+        Таблица показывает только первую страницу результатов, остальные записи
+        находятся через автодополнение.
+        """
+        if not total:
             self.console.print(Panel(self.messages["no_data"], border_style="red"))
             return None
-        self.display_services(services, usernames, categories)
+        first_page = search("")
+        self.display_services([row[0] for row in first_page], [row[1] for row in first_page],
+                              [row[2] for row in first_page])
+        if total > len(first_page):
+            self.console.print(f"[dim]Показано {len(first_page)} из {total}, начните вводить для поиска[/dim]")
         return autocomplete(
             message="📋 Введите название сервиса:",
-            choices=services,
+            choices=[],
+            completer=SearchCompleter(search),
             style=self.style,
             qmark="➤"
         ).ask()
@@ -222,6 +272,7 @@ class UI:
             choices=[
                 {"name": "🔍 Просмотреть", "value": "view"},
                 {"name": "✏️ Редактировать", "value": "edit"},
+                {"name": "🕘 Предыдущие версии", "value": "history"},
                 {"name": "🗑️ Удалить", "value": "delete"},
                 {"name": "⬅️ Назад", "value": "back"}
             ],
@@ -229,6 +280,31 @@ class UI:
             qmark="➤"
         ).ask()
 
+    def select_version(self, versions: List[Tuple[int, float]]) -> Optional[int]:
+        """Предлагает выбрать предыдущую версию пароля; возвращает ее id или None."""
+        choices = [{"name": f"🕘 Заменен {datetime.datetime.fromtimestamp(changed_at):%Y-%m-%d %H:%M:%S}",
+                    "value": version_id} for version_id, changed_at in versions]
+        choices.append({"name": "⬅️ Назад", "value": None})
+        return select(
+            message=f"[bold]Предыдущие версии ({len(versions)}):[/bold]",
+            choices=choices,
+            style=self.style,
+            qmark="➤"
+        ).ask()
+
+    def version_menu(self) -> str:
+        """Отображает действия с предыдущей версией пароля."""
+        return select(
+            message="[bold]Действия с версией:[/bold]",
+            choices=[
+                {"name": "🔍 Показать", "value": "show"},
+                {"name": "♻️ Восстановить", "value": "restore"},
+                {"name": "⬅️ Назад", "value": "back"}
+            ],
+            style=self.style,
+            qmark="➤"
+        ).ask()
+
     def select_category(self, categories: List[str]) -> Optional[str]:
         """Запрашивает выбор категории."""
         categories = ["Без категории"] + categories
@@ -247,14 +323,17 @@ class UI:
             style=self.style
         ).ask() == "Да"
 
+    @timed(RENDER)
     def display_success(self, message: str):
         """Отображает сообщение об успешной операции."""
         self.console.print(Panel.fit(message, border_style="green"))
 
+    @timed(RENDER)
     def display_error(self, error: str):
         """Отображает сообщение об ошибке."""
         self.console.print(Panel(self.messages["error"].format(error=error), border_style="red"))
 
+    @timed(RENDER)
     def display_password(self, service: str, username: str, password: str, category: str = None):
         """Отображает информацию о пароле и копирует его в буфер обмена."""
         pyperclip.copy(password)
@@ -1,70 +1,145 @@
 import os
-import subprocess
-import glob
+import re
+import select
+import logging
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 KEY_FILENAME = "keyfile.pmk"
+# Bytes of random data in a new keyfile
+KEYFILE_SIZE = 64
+# Keyfiles are small; anything larger is not one of ours
+MAX_KEYFILE_SIZE = 1024 * 1024
+MOUNTINFO_FILE = "/proc/self/mountinfo"
+SYSFS_DIR = "/sys"
+
+_ESCAPE = re.compile(r"\\([0-7]{3})")
 
 
-def find_usb_mounts():
-    """Находит все смонтированные USB-устройства"""
+def parse_mountinfo(text: str) -> List[Tuple[str, str]]:
+    """Возвращает пары (MAJOR:MINOR, точка монтирования) из содержимого mountinfo.
+
+    Пробелы и другие служебные символы в путях ядро записывает как \\ooo.
+    """
     mounts = []
+    for line in text.splitlines():
+        fields = line.split(" ")
+        # id, parent, MAJOR:MINOR, root, mount point, options, optional fields..., "-", fs type, source, options
+        if len(fields) < 10 or "-" not in fields[6:]:
+            continue
+        mounts.append((fields[2], _ESCAPE.sub(lambda match: chr(int(match.group(1), 8)), fields[4])))
+    return mounts
+
+
+class MountTable:
+    """Точки монтирования USB-накопителей, прочитанные из mountinfo без запуска lsblk.
+
+    Шина устройства определяется по ссылке /sys/dev/block/MAJOR:MINOR: у
+    накопителей, подключенных по USB, ее путь проходит через USB-контроллер.
+    Список кэшируется и перечитывается только после изменения таблицы
+    монтирования: для файла из /proc ядро сообщает о монтировании и
+    размонтировании через poll (POLLPRI), для обычного файла сравниваются
+    время изменения и размер. Поэтому проверка при каждой разблокировке
+    стоит одного системного вызова.
+    """
+
+    def __init__(self, mountinfo: str = MOUNTINFO_FILE, sysfs: str = SYSFS_DIR):
+        self.mountinfo = mountinfo
+        self.sysfs = sysfs
+        self._mounts: Optional[List[str]] = None
+        self._stamp: Optional[Tuple[int, int, int]] = None
+        self._file = None
+        self._poller = None
+
+    def _file_stamp(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.mountinfo)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _changed(self) -> bool:
+        if self._mounts is None:
+            return True
+        if self._poller is not None:
+            return bool(self._poller.poll(0))
+        return self._file_stamp() != self._stamp
+
+    def _read(self) -> str:
+        if self.mountinfo.startswith("/proc/"):
+            if self._file is None:
+                self._file = open(self.mountinfo, "r")
+                self._poller = select.poll()
+                self._poller.register(self._file, select.POLLPRI | select.POLLERR)
+            self._file.seek(0)
+            return self._file.read()
+        self._stamp = self._file_stamp()
+        with open(self.mountinfo, "r") as f:
+            return f.read()
+
+    def is_usb(self, device: str) -> bool:
+        """Проверяет, подключено ли блочное устройство MAJOR:MINOR по USB."""
+        return "/usb" in os.path.realpath(os.path.join(self.sysfs, "dev", "block", device))
+
+    def usb_mounts(self) -> List[str]:
+        """Возвращает точки монтирования USB-накопителей, перечитывая таблицу только после ее изменения."""
+        if self._changed():
+            try:
+                mounts = parse_mountinfo(self._read())
+            except OSError as e:
+                logger.error(f"Mount table read failed: {e}")
+                return []
+            self._mounts = [mount_point for device, mount_point in mounts
+                            if not device.startswith("0:") and self.is_usb(device)]
+        return list(self._mounts)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file, self._poller = None, None
+        self._mounts = None
+
+
+_table = MountTable()
+
+
+def find_usb_mounts() -> List[str]:
+    """Находит все смонтированные USB-накопители."""
+    return _table.usb_mounts()
+
+
+def find_keyfiles(filename: str = KEY_FILENAME, table: Optional[MountTable] = None) -> List[str]:
+    """Возвращает пути файлов-ключей в корне смонтированных USB-накопителей."""
+    mounts = (table or _table).usb_mounts()
+    return [path for path in (os.path.join(mount, filename) for mount in mounts) if os.path.isfile(path)]
+
+
+def read_keyfile(path: str) -> bytes:
+    """Читает содержимое файла-ключа."""
     try:
-        # Используем lsblk для поиска USB-устройств
-        result = subprocess.run(
-            ['lsblk', '-o', 'MOUNTPOINT,TRAN'],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-
-        # Проверка вывода lsblk и фильтрация USB-устройств
-        for line in result.stdout.splitlines():
-            parts = line.split()
-            if len(parts) >= 2 and "*" in parts[1].lower():
-                mounts.append(parts[0])
-
-        # Дополнительно проверяем стандартные пути монтирования
-        standard_paths = [
-            f"/media/{os.getenv('USER')}/*",
-            "/run/media/*/*",
-            "/mnt/*"
-        ]
-
-        for path in standard_paths:
-            for mount in glob.glob(path):
-                if os.path.ismount(mount) and mount not in mounts:
-                    mounts.append(mount)
-
-        return list(set(mounts))  # Убираем дубликаты
-
-    except Exception as e:
-        print(f"Ошибка при поиске USB: {e}")
-        return []
-
-
-def save_key_to_usb(mount_path, key, filename=KEY_FILENAME):
-    """Сохраняет ключ на USB-устройство"""
-    try:
-        key_path = os.path.join(mount_path, filename)
-        with open(key_path, 'w') as f:
-            f.write(key)
-        print(f"Ключ сохранён в {key_path}")
-        return True
-    except PermissionError:
-        print(f"Ошибка: Нет прав для записи на устройство {mount_path}")
-    except Exception as e:
-        print(f"Ошибка сохранения ключа: {e}")
-    return False
-
-
-def read_key_from_usb(filename=KEY_FILENAME):
-    """Читает ключ с USB-устройства"""
+        with open(path, "rb") as f:
+            data = f.read(MAX_KEYFILE_SIZE + 1)
+    except OSError as e:
+        raise RuntimeError(f"Keyfile read failed: {e}")
+    if not data or len(data) > MAX_KEYFILE_SIZE:
+        raise RuntimeError(f"{path} is not a keyfile")
+    return data
+
+
+def create_keyfile(directory: str, filename: str = KEY_FILENAME) -> str:
+    """Записывает новый случайный файл-ключ в каталог (обычно корень USB-накопителя) и возвращает его путь.
+
+    Существующий файл не перезаписывается: он может защищать другое хранилище.
+    """
+    path = os.path.join(directory, filename)
     try:
-        for mount in find_usb_mounts():
-            key_path = os.path.join(mount, filename)
-            if os.path.isfile(key_path):
-                with open(key_path, 'r') as f:
-                    return f.read().strip()
-    except Exception as e:
-        print(f"Ошибка чтения ключа: {e}")
-    return None
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(KEYFILE_SIZE))
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        raise RuntimeError(f"Keyfile write failed: {e}")
+    logger.info(f"Keyfile written: {path}")
+    return path
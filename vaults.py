@@ -0,0 +1,242 @@
+import os
+import re
+import json
+import base64
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from config import (DB_PATH, SALT_FILE, MASTER_HASH_FILE, BACKUP_DIR, AGENT_SOCKET, VAULTS_DIR, KEYRING_DIR,
+                    DEFAULT_VAULT, SEARCH_LIMIT, VAULT_SEARCH_WORKERS)
+from db import Database
+from search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+VAULT_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+
+VaultResult = Tuple[str, str, str, Optional[str]]
+
+
+class Vault(NamedTuple):
+    """Files of one vault: each has its own database, salt and verifier."""
+    name: str
+    db_path: str
+    salt_file: str
+    master_hash_file: str
+    backup_dir: str
+    agent_socket: str
+
+    def exists(self) -> bool:
+        return os.path.exists(self.master_hash_file) or os.path.exists(self.db_path)
+
+    def create_dir(self):
+        os.makedirs(os.path.dirname(self.db_path), mode=0o700, exist_ok=True)
+
+
+def get_vault(name: str = None) -> Vault:
+    """Returns the vault called name; None and DEFAULT_VAULT give the original single vault in the home directory."""
+    if name is None or name == DEFAULT_VAULT:
+        return Vault(DEFAULT_VAULT, DB_PATH, SALT_FILE, MASTER_HASH_FILE, BACKUP_DIR, AGENT_SOCKET)
+    if not VAULT_NAME.fullmatch(name):
+        raise ValueError(f"Invalid vault name: {name}")
+    directory = os.path.join(VAULTS_DIR, name)
+    return Vault(name, os.path.join(directory, "passman.db"), os.path.join(directory, "salt.bin"),
+                 os.path.join(directory, "master.hash"), os.path.join(directory, "backups"),
+                 os.path.join(directory, "agent.sock"))
+
+
+def list_vaults() -> List[Vault]:
+    """Returns the default vault, if it was ever used, followed by the named vaults in name order."""
+    vaults = [get_vault()] if get_vault().exists() else []
+    if os.path.isdir(VAULTS_DIR):
+        for name in sorted(os.listdir(VAULTS_DIR)):
+            if name != DEFAULT_VAULT and VAULT_NAME.fullmatch(name) and get_vault(name).exists():
+                vaults.append(get_vault(name))
+    return vaults
+
+
+class Keyring:
+    """Encryption keys of several vaults behind one master password.
+
+    The keyring has a salt and verifier of its own, so unlocking it costs one
+    Argon2 run however many vaults it covers. Each enrolled vault key is
+    sealed with AES-GCM under the keyring key, with the vault name as
+    associated data so sealed keys cannot be swapped between vaults. The
+    vault's verifier record is stored next to its key: after the vault's
+    master password or Argon2 parameters change, the records differ and the
+    stored key is reported as stale instead of being used.
+
+    Vaults that require a keyfile are never enrolled: their key already
+    includes the keyfile, so the keyring would open them with its password
+    alone.
+    """
+
+    def __init__(self, directory: str = None, params: Optional[dict] = None):
+        self.directory = directory or KEYRING_DIR
+        self.keys_file = os.path.join(self.directory, "keys.json")
+        self.params = params
+        self._crypto = None
+        self._key: Optional[bytes] = None
+
+    @property
+    def crypto(self):
+        if self._crypto is None:
+            from crypto import Crypto
+            self._crypto = Crypto(os.path.join(self.directory, "salt.bin"),
+                                  os.path.join(self.directory, "master.hash"), self.params)
+        return self._crypto
+
+    def exists(self) -> bool:
+        return os.path.exists(self.crypto.master_hash_file)
+
+    @property
+    def locked(self) -> bool:
+        return self._key is None
+
+    def unlock(self, master_password: str) -> bool:
+        """Verifies the keyring password, creating the keyring on first use."""
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        keys = self.crypto.unlock(master_password, self.crypto.get_salt())
+        if keys is None:
+            return False
+        self._key = keys.enc_key
+        return True
+
+    def lock(self):
+        self._key = None
+
+    def names(self) -> List[str]:
+        """Returns the names of the enrolled vaults."""
+        return sorted(self._load())
+
+    def add(self, vault: Vault, key: bytes):
+        """Enrolls the encryption key of an unlocked vault, replacing an earlier one."""
+        if requires_keyfile(vault):
+            raise RuntimeError(f"Vault {vault.name} requires a keyfile and cannot be enrolled in the keyring")
+        iv = os.urandom(12)
+        sealed = self._aead().encrypt(iv, key, vault.name.encode())
+        entries = self._load()
+        entries[vault.name] = {"key": base64.b64encode(iv + sealed).decode(), "verifier": _read_verifier(vault)}
+        self._save(entries)
+
+    def remove(self, name: str) -> bool:
+        entries = self._load()
+        if entries.pop(name, None) is None:
+            return False
+        self._save(entries)
+        return True
+
+    def is_stale(self, vault: Vault) -> bool:
+        """Checks whether the vault was re-keyed after its key was enrolled."""
+        entry = self._load().get(vault.name)
+        return entry is not None and entry["verifier"] != _read_verifier(vault)
+
+    def key_for(self, vault: Vault) -> Optional[bytes]:
+        """Returns the vault's encryption key, or None when it is not enrolled or stale."""
+        return self.keys([vault]).get(vault.name)
+
+    def keys(self, vaults: List[Vault]) -> Dict[str, bytes]:
+        """Returns the encryption keys of the given vaults that are enrolled and current."""
+        entries = self._load()
+        aead = self._aead()
+        keys = {}
+        for vault in vaults:
+            entry = entries.get(vault.name)
+            if entry is None:
+                continue
+            if entry["verifier"] != _read_verifier(vault):
+                logger.warning(f"Keyring key of vault {vault.name} is stale; enroll it again")
+                continue
+            if requires_keyfile(vault):
+                logger.warning(f"Vault {vault.name} requires a keyfile; its keyring key is ignored")
+                continue
+            data = base64.b64decode(entry["key"])
+            try:
+                keys[vault.name] = aead.decrypt(data[:12], data[12:], vault.name.encode())
+            except Exception as e:
+                raise RuntimeError(f"Keyring decryption failed for vault {vault.name}: {e}")
+        return keys
+
+    def _aead(self):
+        if self._key is None:
+            raise RuntimeError("Keyring is locked")
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        return AESGCM(self._key)
+
+    def _load(self) -> Dict[str, dict]:
+        if not os.path.exists(self.keys_file):
+            return {}
+        try:
+            with open(self.keys_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"Keyring read failed: {e}")
+
+    def _save(self, entries: Dict[str, dict]):
+        tmp_file = self.keys_file + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.keys_file)
+
+
+def _read_verifier(vault: Vault) -> Optional[str]:
+    if not os.path.exists(vault.master_hash_file):
+        return None
+    with open(vault.master_hash_file, "r") as f:
+        return f.read().strip()
+
+
+def requires_keyfile(vault: Vault) -> bool:
+    """Checks whether the vault's verifier record names a keyfile."""
+    from crypto import KEYFILE_VERIFIER_PREFIX
+    verifier = _read_verifier(vault)
+    return verifier is not None and verifier.startswith(KEYFILE_VERIFIER_PREFIX + "$")
+
+
+class VaultSet:
+    """Read-only lookups across several vaults at once.
+
+    Every vault keeps its own database and SearchIndex, queried from a thread
+    pool. SQLite releases the GIL while it steps through a query, so the
+    lookups overlap instead of running one vault after another. Each vault
+    ranks its own matches; merged results take every vault's best match
+    first, then every vault's second, and so on, so one large vault does not
+    crowd out the rest. Attaching the vaults to a single connection would
+    serialize them on that connection and bypass the per-vault ranking.
+    """
+
+    def __init__(self, vaults: List[Vault], workers: int = VAULT_SEARCH_WORKERS):
+        self.vaults = [vault for vault in vaults if os.path.exists(vault.db_path)]
+        self.databases = [Database(vault.db_path) for vault in self.vaults]
+        for db in self.databases:
+            db.init_db()
+        self.indexes = [SearchIndex(db) for db in self.databases]
+        workers = min(max(1, workers), len(self.vaults))
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vaults") if workers > 1 else None
+
+    def _map(self, func, items: list) -> list:
+        if self._pool is None:
+            return [func(item) for item in items]
+        return list(self._pool.map(func, items))
+
+    def search(self, text: str, category: str = None, limit: int = SEARCH_LIMIT) -> List[VaultResult]:
+        """Returns up to limit (vault, service, username, category) matches, best first."""
+        results = self._map(lambda index: index.search(text, category, limit), self.indexes)
+        merged = []
+        for rank in range(max((len(rows) for rows in results), default=0)):
+            for vault, rows in zip(self.vaults, results):
+                if rank < len(rows):
+                    merged.append((vault.name,) + tuple(rows[rank]))
+        return merged[:limit]
+
+    def get_password(self, service: str, category: str = None) -> List[Tuple[Vault, dict]]:
+        """Returns (vault, entry) for every vault holding the service in the category."""
+        entries = self._map(lambda db: db.get_password(service, category), self.databases)
+        return [(vault, entry) for vault, entry in zip(self.vaults, entries) if entry is not None]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+        for db in self.databases:
+            db.close()